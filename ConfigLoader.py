@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import os
+import configparser
+from functools import lru_cache
+
+
+# 預設讀取目前目錄的 Config.ini, 可由環境變數 RETRIEVAL_CONFIG 指定其他路徑
+config_path = os.environ.get("RETRIEVAL_CONFIG", "Config.ini")
+# 目前目錄沒有 Config.ini 時, 依序使用本模組旁的 Config.ini / config.ini (Linux 檔名區分大小寫)
+fallback_paths = [os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in ("Config.ini", "config.ini")]
+
+
+def resolve_config_path(path:str = None) -> str:
+    """path 為 None 時使用 config_path; 以 RETRIEVAL_CONFIG 或 path 明確指定的檔案不會改用 fallback_paths"""
+    if path is not None or "RETRIEVAL_CONFIG" in os.environ:
+        return path or config_path
+    for candidate in [config_path] + fallback_paths:
+        if os.path.exists(candidate):
+            return candidate
+    return config_path
+
+
+'''**
+* 共用的設定檔: 每個 process 只讀取一次, DatabaseProcess / EmbeddingFunction / RetrievalService 等模組共用同一個 ConfigParser
+* @params: path - 設定檔路徑, None 代表 resolve_config_path()
+* @return: configparser.ConfigParser
+*'''
+@lru_cache(maxsize=None)
+def load_config(path:str = None) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read(resolve_config_path(path))
+    return config
@@ -1,14 +1,27 @@
 # -*- coding: utf-8 -*-
 import os
+import io
+import re
 import ast
+import time
+import struct
+import hashlib
+import weakref
+import uuid
 import psycopg2
-import configparser
+import threading
+import numpy as np
+import Metrics
+import ConfigLoader
 import EmbeddingFunction
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.pool import PoolError
 from psycopg2.extras import execute_values
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, AsIs, new_type, register_adapter, register_type
 
 
-config=configparser.ConfigParser()
-config.read("Config.ini")
+config = ConfigLoader.load_config()
 
 ## default pg setting
 pg_setting = {
@@ -19,16 +32,321 @@ pg_setting = {
     'port': config['POSTGRES_DB']['port']
 }
 
+## default pool setting (None 代表不使用 pool, 每次呼叫都重新連線)
+pool_setting = {
+    'minconn': config.getint('POSTGRES_POOL', 'minconn', fallback=1),
+    'maxconn': config.getint('POSTGRES_POOL', 'maxconn', fallback=10),
+    'timeout': config.getfloat('POSTGRES_POOL', 'timeout', fallback=30.0),
+    'max_idle': config.getfloat('POSTGRES_POOL', 'max_idle', fallback=300.0),
+    'health_check_interval': config.getfloat('POSTGRES_POOL', 'health_check_interval', fallback=30.0)
+} if config.getboolean('POSTGRES_POOL', 'enable', fallback=False) else None
+
 embed_dim = EmbeddingFunction.embed_dim
+embed_short_dim = EmbeddingFunction.embed_short_dim
+
+# pgvector 的 HNSW / IVFFlat 索引: vector 最多 2000 維, halfvec 最多 4000 維
+VECTOR_INDEX_MAX_DIM = 2000
+HALFVEC_INDEX_MAX_DIM = 4000
+# hnsw.ef_search 的上限, 超過時 set_config 會失敗
+HNSW_MAX_EF_SEARCH = 1000
+# PostgreSQL 識別字上限 (bytes), 超過的名稱會被直接截斷
+PG_IDENTIFIER_MAX_BYTES = 63
+# 有設定短向量時預設使用 two-stage 查詢; overfetch 為第一階段多取的倍數
+default_strategy = "two_stage" if embed_short_dim else "ann"
+default_index_column = "embedding_short" if embed_short_dim else "embedding"
+DEFAULT_OVERFETCH = {"two_stage": 5, "binary": 10, "hybrid": 5}
+# 距離: metric -> (operator, opclass 後綴); 新建 table 使用 default_metric, 記錄於 vector_table_setting
+METRIC_OPS = {
+    "l2": ("<->", "l2_ops"),
+    "ip": ("<#>", "ip_ops"),
+    "cosine": ("<=>", "cosine_ops")
+}
+default_metric = config.get('VECTOR_SEARCH', 'metric', fallback='l2')
+# 有過濾條件的查詢使用 pgvector 0.8+ 的 iterative index scan, 確保過濾後仍回傳 top_k 筆 (off: 不使用)
+# 舊版 pgvector 沒有 hnsw.iterative_scan / ivfflat.iterative_scan 參數, 依 extversion 略過 (見 get_vector_version)
+iterative_scan = config.get('VECTOR_SEARCH', 'iterative_scan', fallback='relaxed_order')
+ITERATIVE_SCAN_MIN_VERSION = (0, 8)
+max_scan_tuples = config.getint('VECTOR_SEARCH', 'max_scan_tuples', fallback=20000)
+# hybrid 查詢: chunk_context 的全文檢索設定 (建立 chunk_tsv 時使用) 與 reciprocal rank fusion 的 k
+text_search_config = config.get('VECTOR_SEARCH', 'text_search_config', fallback='english')
+rrf_k = config.getint('VECTOR_SEARCH', 'rrf_k', fallback=60)
+# scope -> 查詢方法, 供 query_scope_nearest / search_all 使用
+SCOPE_QUERIES = {
+    "jssdk": "query_jssdk_nearest",
+    "spec": "query_spec_nearest",
+    "manual": "query_manual_nearest",
+    "benchmark": "query_benchmark_nearest_by_identity"
+}
+# scope -> metadata 過濾欄位 (query_*_nearest 的參數名稱); benchmark 沒有 metadata 欄位, 只依 identity 過濾
+SCOPE_FILTERS = {
+    "jssdk": "class_name",
+    "spec": "model",
+    "manual": "class_name"
+}
+# benchmark identity -> 過濾欄位
+IDENTITY_FLAGS = {
+    "customer": "customer_flag",
+    "distributor": "distributor_flag"
+}
+
+
+'''**
+* numpy <-> pgvector 轉換
+* 1. np.ndarray 參數以精簡文字 '[x,y,...]' 傳送 (float32 以 9 位有效數字即可完整表示),
+*    psycopg2 不會展開成 ARRAY[...], server 端也不需先轉 numeric[] 再 cast
+* 2. 查詢結果的 vector / halfvec 直接解析為 np.float32 array
+* psycopg2 只支援文字參數, 無法以 binary 傳送查詢參數; 大量寫入請用 bulk_load (COPY binary)
+*'''
+def to_vector_param(vec) -> np.ndarray:
+    return np.asarray(vec, dtype=np.float32)
+
+
+def adapt_ndarray(arr:np.ndarray):
+    values = arr.astype(np.float32, copy=False).ravel().tolist()
+    return AsIs("'[" + ",".join(["%.9g"] * len(values)) % tuple(values) + "]'")
+
+
+def cast_vector(value, cur):
+    if value is None:
+        return None
+    return np.fromstring(value[1:-1], dtype=np.float32, sep=",")
+
+
+register_adapter(np.ndarray, adapt_ndarray)
+
+
+'''**
+* Thread-safe psycopg2 connection pool
+* 1. 預先建立 minconn 條連線, 最多 maxconn 條
+* 2. 連線用完時等待歸還 (最多 timeout 秒), 逾時 raise PoolError
+* 3. 閒置超過 health_check_interval 的連線在借出前先 SELECT 1 檢查
+* 4. 閒置超過 max_idle 且多於 minconn 的連線會被回收
+* 5. stats() 回傳等待時間與飽和度, 用來決定 pool 大小
+*'''
+class PGConnectionPool:
+
+    def __init__(self, pg_setting, minconn=1, maxconn=10, timeout=30.0,
+                 max_idle=300.0, health_check_interval=30.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"invalid pool size: minconn={minconn}, maxconn={maxconn}")
+        self.pg_setting = pg_setting
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self._cond = threading.Condition()
+        self._idle = [] # list of (conn, last_used), 後進先出讓常用連線保持溫熱
+        self._size = 0 # 已開啟 (含建立中) 的連線數
+        self._in_use = 0
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "total_wait_sec": 0.0,
+            "max_wait_sec": 0.0,
+            "peak_in_use": 0,
+            "connects": 0,
+            "health_check_failures": 0,
+            "recycled": 0
+        }
+        for _ in range(minconn):
+            conn = self._connect()
+            with self._cond:
+                self._size += 1
+                self._idle.append((conn, time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.pg_setting)
+        with self._cond:
+            self._stats["connects"] += 1
+        return conn
+
+    def _is_healthy(self, conn, last_used) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _recycle_idle_locked(self):
+        """回收閒置過久的連線 (呼叫前須持有 lock)"""
+        now = time.monotonic()
+        keep = []
+        for conn, last_used in self._idle:
+            if self._size > self.minconn and now - last_used > self.max_idle:
+                conn.close()
+                self._size -= 1
+                self._stats["recycled"] += 1
+            else:
+                keep.append((conn, last_used))
+        self._idle = keep
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        conn, last_used = None, None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError("connection pool is closed")
+                self._recycle_idle_locked()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolError(f"connection pool exhausted: no connection available after {self.timeout} sec")
+                waited = True
+                self._cond.wait(remaining)
+            wait_sec = time.monotonic() - start
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+            self._stats["waits"] += int(waited)
+            self._stats["total_wait_sec"] += wait_sec
+            self._stats["max_wait_sec"] = max(self._stats["max_wait_sec"], wait_sec)
+            self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._in_use)
+
+        # 建立連線與健康檢查時不持有 lock, 避免卡住其他 thread
+        try:
+            if conn is not None and not self._is_healthy(conn, last_used):
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                conn.close()
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, close=False):
+        # 未結束的 transaction 先 rollback, 避免下一位使用者拿到髒連線
+        if not close and not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        with self._cond:
+            self._in_use -= 1
+            if close or conn.closed or self._closed:
+                conn.close()
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                conn.close()
+                self._size -= 1
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            checkouts = self._stats["checkouts"]
+            stats.update({
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "maxconn": self.maxconn,
+                "saturation": self._in_use / self.maxconn,
+                "peak_saturation": self._stats["peak_in_use"] / self.maxconn,
+                "avg_wait_sec": self._stats["total_wait_sec"] / checkouts if checkouts else 0.0
+            })
+        return stats
 
 
 class PGVector:
-    
-    def __init__(self, pg_setting):
+
+    def __init__(self, pg_setting, pool_setting=None):
         self.pg_setting = pg_setting
-    
+        # pool_setting 為 None 時維持每次呼叫重新連線
+        self._vector_oids = None # (vector oid, halfvec oid), 第一次連線時查詢
+        self._configured_conns = weakref.WeakSet() # 已註冊 vector 型別轉換的連線
+        self.pool = PGConnectionPool(pg_setting, **pool_setting) if pool_setting else None
+        # (table_name, cols) -> column type names, 供 COPY 編碼使用
+        self._column_type_cache = {}
+        # table_name -> metric, 見 get_table_metric
+        self._table_metric_cache = {}
+        # table_name -> embedding 維度, 見 get_table_dim
+        self._table_dim_cache = {}
+        # 已安裝的 pgvector 版本, 見 get_vector_version
+        self._vector_version = None
+        # 查詢超過此毫秒數時記錄 EXPLAIN (ANALYZE, BUFFERS), 0 代表不記錄 (見 Metrics.slow_query_ms)
+        self.slow_query_ms = Metrics.slow_query_ms
+        # search_all 的 thread pool, 第一次使用時建立
+        self._search_executor = None
+        self._search_executor_lock = threading.Lock()
+
+    @contextmanager
     def get_connection(self):
-        return psycopg2.connect(**self.pg_setting)
+        """借出一條連線, 離開 with 區塊後歸還 pool (未啟用 pool 則關閉); 取得連線的時間記錄為 db_connect"""
+        start_time = time.perf_counter()
+        if self.pool is None:
+            conn = psycopg2.connect(**self.pg_setting)
+            self._configure_connection(conn)
+            Metrics.metrics.observe("db_connect", time.perf_counter() - start_time, pool="off")
+            try:
+                yield conn
+            finally:
+                conn.close()
+        else:
+            conn = self.pool.getconn()
+            # pool 中的連線可能在 CREATE EXTENSION 之前建立, 借出時再補註冊
+            if conn not in self._configured_conns:
+                self._configure_connection(conn)
+            Metrics.metrics.observe("db_connect", time.perf_counter() - start_time, pool="on")
+            try:
+                yield conn
+            finally:
+                self.pool.putconn(conn)
+
+    def _configure_connection(self, conn):
+        """在連線上註冊 vector / halfvec -> np.ndarray 的型別轉換"""
+        if self._vector_oids is None:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regtype('vector')::oid, to_regtype('halfvec')::oid")
+                oids = cur.fetchone()
+            conn.rollback()
+            if oids[0] is None:
+                return # 尚未 CREATE EXTENSION vector
+            self._vector_oids = oids
+        vector_oid, halfvec_oid = self._vector_oids
+        register_type(new_type((vector_oid,), "VECTOR", cast_vector), conn)
+        if halfvec_oid is not None:
+            register_type(new_type((halfvec_oid,), "HALFVEC", cast_vector), conn)
+        self._configured_conns.add(conn)
+    
+    def pool_stats(self) -> dict:
+        """回傳 pool 等待時間與飽和度, 未啟用 pool 時回傳空 dict"""
+        return self.pool.stats() if self.pool is not None else {}
+
+    def close(self):
+        if self._search_executor is not None:
+            self._search_executor.shutdown(wait=True)
+        if self.pool is not None:
+            self.pool.closeall()
     
     def upsert_data(self, tbl_names:str, col_names:str, pairs:list[tuple]):
         """批次寫入"""
@@ -37,6 +355,131 @@ class PGVector:
             execute_values(cur, sql, pairs)
             conn.commit()
     
+    '''**
+    * COPY 欄位編碼 (binary format)
+    * 每個 field: int32 長度 + 內容, NULL 為長度 -1
+    * vector: uint16 dim + uint16 unused + float4 * dim (big-endian); halfvec 則為 float2 * dim
+    *'''
+    @staticmethod
+    def _binary_encoder(type_name:str):
+        if type_name in ("text", "varchar", "bpchar", "name"):
+            return lambda value: str(value).encode("utf-8")
+        if type_name in ("int2", "int4", "int8", "float4", "float8"):
+            fmt = {"int2": ">h", "int4": ">i", "int8": ">q", "float4": ">f", "float8": ">d"}[type_name]
+            cast = float if type_name.startswith("float") else int
+            return lambda value: struct.pack(fmt, cast(value))
+        if type_name == "bool":
+            return lambda value: b"\x01" if value else b"\x00"
+        if type_name in ("vector", "halfvec"):
+            dtype = ">f4" if type_name == "vector" else ">f2"
+            def encode_vector(value):
+                value = np.asarray(value, dtype=dtype)
+                return struct.pack(">HH", len(value), 0) + value.tobytes()
+            return encode_vector
+        return None
+
+    @staticmethod
+    def _text_encoder(type_name:str):
+        if type_name in ("vector", "halfvec"):
+            return lambda value: adapt_ndarray(to_vector_param(value)).getquoted().decode("ascii")[1:-1]
+        # COPY text format 需跳脫反斜線與分隔字元
+        return lambda value: (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+                              .replace("\n", "\\n").replace("\r", "\\r"))
+
+    def _get_column_types(self, cur, table_name:str, cols:list[str]) -> list[str]:
+        key = (table_name, tuple(cols))
+        if key not in self._column_type_cache:
+            cur.execute("""
+                SELECT a.attname, t.typname
+                FROM pg_attribute a JOIN pg_type t ON a.atttypid = t.oid
+                WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+                """, (table_name,))
+            type_map = dict(cur.fetchall())
+            missing = [col for col in cols if col not in type_map]
+            if missing:
+                raise ValueError(f"columns {missing} not found in {table_name}")
+            self._column_type_cache[key] = [type_map[col] for col in cols]
+        return self._column_type_cache[key]
+
+    def _encode_copy_batch(self, rows:list[tuple], type_names:list[str], binary:bool) -> io.BytesIO:
+        buf = io.BytesIO()
+        if binary:
+            encoders = [self._binary_encoder(type_name) for type_name in type_names]
+            buf.write(b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0))
+            field_cnt = struct.pack(">h", len(encoders))
+            for row in rows:
+                buf.write(field_cnt)
+                for encoder, value in zip(encoders, row):
+                    if value is None:
+                        buf.write(b"\xff\xff\xff\xff")
+                    else:
+                        data = encoder(value)
+                        buf.write(struct.pack(">i", len(data)))
+                        buf.write(data)
+            buf.write(struct.pack(">h", -1))
+        else:
+            encoders = [self._text_encoder(type_name) for type_name in type_names]
+            for row in rows:
+                line = "\t".join("\\N" if value is None else encoder(value) for encoder, value in zip(encoders, row))
+                buf.write((line + "\n").encode("utf-8"))
+        buf.seek(0)
+        return buf
+
+    def _copy_rows(self, cur, table_name:str, col_names:str, rows:list[tuple], upsert:bool = True, binary:bool = True,
+                   stage_table:str = None) -> int:
+        """以 COPY 寫入一批資料 (不 commit); upsert 時先 COPY 到 temp table 再 INSERT ... ON CONFLICT DO NOTHING
+        stage_table: 只 COPY 到此既有的 staging table (欄位型別依 table_name), 之後由呼叫端 INSERT 到 table_name"""
+        if not rows:
+            return 0
+        cols = [col.strip() for col in col_names.split(",")]
+        type_names = self._get_column_types(cur, table_name, cols)
+        # 有無法以 binary 編碼的型別時改用 text format
+        if binary and any(self._binary_encoder(type_name) is None for type_name in type_names):
+            binary = False
+        copy_format = "binary" if binary else "text"
+        with Metrics.metrics.timer("copy_encode", table=table_name):
+            buf = self._encode_copy_batch(rows, type_names, binary)
+        with Metrics.metrics.timer("copy_write", table=table_name):
+            if stage_table is not None:
+                cur.copy_expert(f"COPY {stage_table} ({col_names}) FROM STDIN WITH (FORMAT {copy_format})", buf)
+                return len(rows)
+            if not upsert:
+                cur.copy_expert(f"COPY {table_name} ({col_names}) FROM STDIN WITH (FORMAT {copy_format})", buf)
+                inserted_cnt = len(rows)
+            else:
+                stage = f"_copy_stage_{table_name}"
+                cur.execute(f"DROP TABLE IF EXISTS {stage}")
+                cur.execute(f"CREATE TEMP TABLE {stage} AS SELECT {col_names} FROM {table_name} WITH NO DATA")
+                cur.copy_expert(f"COPY {stage} ({col_names}) FROM STDIN WITH (FORMAT {copy_format})", buf)
+                cur.execute(f"INSERT INTO {table_name} ({col_names}) SELECT {col_names} FROM {stage} ON CONFLICT DO NOTHING")
+                inserted_cnt = cur.rowcount
+                cur.execute(f"DROP TABLE {stage}")
+        Metrics.metrics.inc("rows_written", inserted_cnt, table=table_name)
+        Metrics.metrics.inc("rows_skipped", len(rows) - inserted_cnt, table=table_name)
+        return inserted_cnt
+
+    '''**
+    * COPY ... FROM STDIN 大量寫入, 避免 execute_values 將向量轉成 SQL 文字再由 server 解析
+    * @params: table_name; col_names - 同 upsert_data; rows - iterable of tuple (可為 generator)
+    *          batch_size - 每批 COPY 的筆數, 每批 commit 一次; upsert - 已存在的資料略過 (ON CONFLICT DO NOTHING)
+    *          binary - 使用 binary format (vector/halfvec 以 pgvector binary 編碼)
+    * @return: 寫入筆數
+    *'''
+    def bulk_load(self, table_name:str, col_names:str, rows, batch_size:int = 5000, upsert:bool = True, binary:bool = True) -> int:
+        total_cnt = 0
+        with self.get_connection() as conn, conn.cursor() as cur:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    total_cnt += self._copy_rows(cur, table_name, col_names, batch, upsert, binary)
+                    conn.commit()
+                    batch = []
+            if batch:
+                total_cnt += self._copy_rows(cur, table_name, col_names, batch, upsert, binary)
+                conn.commit()
+        return total_cnt
+    
     def delete_tbl_data(self, tbl_name:str):
         """刪除資料"""
         sql = f"DELETE FROM {tbl_name}"
@@ -44,27 +487,769 @@ class PGVector:
             cur.execute(sql)
             conn.commit()
     
-    def get_conn_and_execute_sql_vec_search(self, sql, vec):
+    '''**
+    * 建立 ingest manifest table, 記錄每個來源檔案/網頁的 fingerprint 以便增量同步
+    * @params: NA
+    * @return: NA
+    *'''
+    def create_manifest_table(self):
+        ddl = """
+        CREATE TABLE IF NOT EXISTS ingest_manifest (
+            table_name varchar(128),
+            source_key varchar(512),
+            mtime double precision,
+            size bigint,
+            content_hash varchar(64),
+            chunk_cnt int,
+            updated_at timestamptz DEFAULT now(),
+            PRIMARY KEY (table_name, source_key)
+        );
+        -- 網頁來源的 HTTP validator, 用於 conditional GET
+        ALTER TABLE ingest_manifest ADD COLUMN IF NOT EXISTS etag varchar(256);
+        ALTER TABLE ingest_manifest ADD COLUMN IF NOT EXISTS last_modified varchar(64);
+        """
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(ddl)
+            conn.commit()
+    
+    def get_manifest(self, table_name:str) -> dict:
+        """回傳 {source_key: {mtime, size, content_hash, chunk_cnt, etag, last_modified}}"""
+        sql = """
+            SELECT source_key, mtime, size, content_hash, chunk_cnt, etag, last_modified
+            FROM ingest_manifest WHERE table_name = %s
+            """
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(sql, (table_name,))
+            rows = cur.fetchall()
+        return {row[0]: {"mtime": row[1], "size": row[2], "content_hash": row[3], "chunk_cnt": row[4],
+                         "etag": row[5], "last_modified": row[6]} for row in rows}
+    
+    @staticmethod
+    def _upsert_manifest(cur, table_name:str, source_key:str, fingerprint:dict):
+        cur.execute("""
+            INSERT INTO ingest_manifest (table_name, source_key, mtime, size, content_hash, chunk_cnt, etag, last_modified, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, now())
+            ON CONFLICT (table_name, source_key) DO UPDATE SET
+                mtime = EXCLUDED.mtime, size = EXCLUDED.size, content_hash = EXCLUDED.content_hash,
+                chunk_cnt = COALESCE(EXCLUDED.chunk_cnt, ingest_manifest.chunk_cnt),
+                etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified, updated_at = now()
+            """, (table_name, source_key, fingerprint.get("mtime"), fingerprint.get("size"),
+                  fingerprint.get("content_hash"), fingerprint.get("chunk_cnt"),
+                  fingerprint.get("etag"), fingerprint.get("last_modified")))
+    
+    def upsert_manifest(self, table_name:str, source_key:str, fingerprint:dict):
+        """只更新 fingerprint (例如 mtime 改變但內容相同)"""
+        with self.get_connection() as conn, conn.cursor() as cur:
+            self._upsert_manifest(cur, table_name, source_key, fingerprint)
+            conn.commit()
+    
+    def get_chunk_hashes(self, table_name:str, key_col:str, source_key:str) -> set:
+        """回傳某個來源目前在 table 中的 chunk_hash"""
+        sql = f"SELECT chunk_hash FROM {table_name} WHERE {key_col} = %s AND chunk_hash IS NOT NULL"
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(sql, (source_key,))
+            return {row[0] for row in cur.fetchall()}
+    
+    '''**
+    * 在同一個 transaction 內替換某個來源的 chunks 並更新 manifest
+    * 1. 刪除 chunk_hash 不在 keep_hashes 的舊 chunk (含舊版沒有 chunk_hash 的資料)
+    * 2. 以 COPY 寫入新 chunk, (key_col, chunk_hash) 已存在者略過
+    * 3. 更新 manifest
+    * @params: table_name; key_col - 來源欄位 (source / filename); source_key - 來源值
+    *          col_names, pairs - 同 upsert_data; keep_hashes - 本次來源的所有 chunk_hash; fingerprint - manifest 資訊
+    * @return: (寫入 chunk 數, 刪除 chunk 數); 寫入數不含 ON CONFLICT 略過的 chunk
+    *'''
+    def replace_source_chunks(self, table_name:str, key_col:str, source_key:str, col_names:str,
+                              pairs:list[tuple], keep_hashes:list[str], fingerprint:dict) -> tuple[int, int]:
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                DELETE FROM {table_name}
+                WHERE {key_col} = %s AND (chunk_hash IS NULL OR chunk_hash <> ALL(%s))
+                """, (source_key, list(keep_hashes)))
+            deleted_cnt = cur.rowcount
+            inserted_cnt = self._copy_rows(cur, table_name, col_names, pairs)
+            self._upsert_manifest(cur, table_name, source_key, fingerprint)
+            conn.commit()
+        return inserted_cnt, deleted_cnt
+    
+    '''**
+    * replace_source_chunks 的串流版本: 逐批寫入 chunks, 全部寫入後才刪除舊 chunk 並更新 manifest
+    * 1. 每批先 COPY 到此來源專用的 UNLOGGED staging table, 每批只短暫借用連線並立即 commit;
+    *    row_batches 產生下一批 (解析與轉換 Embedding) 時不佔用連線, 也沒有開啟中的 transaction
+    * 2. 全部寫入後在一個短 transaction 內刪除舊 chunk, 由 staging table INSERT 新 chunk 並更新 manifest
+    *    中途失敗時 table 與 manifest 都不變 (staging table 會刪除), 不會留下一半的資料
+    * @params: row_batches - iterator of (pairs, hashes), hashes 為該批所有 chunk 的 chunk_hash (含已存在者)
+    *          fingerprint - manifest 資訊, 在 row_batches 全部寫入後才寫入 (可由 row_batches 更新), chunk_cnt 依 hashes 計算
+    * @return: (寫入 chunk 數, 刪除 chunk 數); 寫入數不含 ON CONFLICT 略過的 chunk
+    *'''
+    def replace_source_chunks_stream(self, table_name:str, key_col:str, source_key:str, col_names:str,
+                                     row_batches, fingerprint:dict) -> tuple[int, int]:
+        # 不同 process 可能同時同步相同來源, staging table 名稱每次呼叫都不同
+        stage = f"_stream_stage_{uuid.uuid4().hex[:16]}"
+        keep_hashes = []
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"CREATE UNLOGGED TABLE {stage} AS SELECT {col_names} FROM {table_name} WITH NO DATA")
+            conn.commit()
+        try:
+            for pairs, hashes in row_batches:
+                keep_hashes.extend(hashes)
+                if pairs:
+                    with self.get_connection() as conn, conn.cursor() as cur:
+                        self._copy_rows(cur, table_name, col_names, pairs, stage_table=stage)
+                        conn.commit()
+            with self.get_connection() as conn, conn.cursor() as cur:
+                cur.execute(f"""
+                    DELETE FROM {table_name}
+                    WHERE {key_col} = %s AND (chunk_hash IS NULL OR chunk_hash <> ALL(%s))
+                    """, (source_key, keep_hashes))
+                deleted_cnt = cur.rowcount
+                cur.execute(f"INSERT INTO {table_name} ({col_names}) SELECT {col_names} FROM {stage} ON CONFLICT DO NOTHING")
+                inserted_cnt = cur.rowcount
+                self._upsert_manifest(cur, table_name, source_key, dict(fingerprint, chunk_cnt=len(keep_hashes)))
+                conn.commit()
+        finally:
+            try:
+                with self.get_connection() as conn, conn.cursor() as cur:
+                    cur.execute(f"DROP TABLE IF EXISTS {stage}")
+                    conn.commit()
+            except psycopg2.Error as e:
+                # 不覆蓋原本的例外; 殘留的 _stream_stage_* 可手動刪除
+                print(f"drop staging table {stage} fail because {e}")
+        Metrics.metrics.inc("rows_written", inserted_cnt, table=table_name)
+        return inserted_cnt, deleted_cnt
+    
+    def delete_source(self, table_name:str, key_col:str, source_key:str) -> int:
+        """來源已不存在: 刪除其 chunks 與 manifest 記錄"""
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {table_name} WHERE {key_col} = %s", (source_key,))
+            deleted_cnt = cur.rowcount
+            cur.execute("DELETE FROM ingest_manifest WHERE table_name = %s AND source_key = %s", (table_name, source_key))
+            conn.commit()
+        return deleted_cnt
+    
+    '''**
+    * 每個 table 的距離 metric 記錄於 vector_table_setting, 建立 table 時寫入
+    * 查詢與建立索引時依此選擇運算子與 operator class (見 METRIC_OPS)
+    * 未記錄的 table (此設定之前建立) 視為 l2
+    *'''
+    def create_table_setting(self):
+        ddl = """
+        CREATE TABLE IF NOT EXISTS vector_table_setting (
+            table_name varchar(128) PRIMARY KEY,
+            metric varchar(16) NOT NULL,
+            updated_at timestamptz DEFAULT now()
+        );
+        """
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(ddl)
+            conn.commit()
+    
+    def table_exists(self, table_name:str) -> bool:
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+            return cur.fetchone()[0]
+    
+    @staticmethod
+    def check_metric(metric:str):
+        if metric not in METRIC_OPS:
+            raise ValueError(f"unsupported metric: {metric}, use one of {list(METRIC_OPS)}")
+    
+    def set_table_metric(self, table_name:str, metric:str, overwrite:bool = False):
+        """overwrite=False: 已有記錄時保留原 metric (既有索引與資料以原 metric 建立)"""
+        self.check_metric(metric)
+        self.create_table_setting()
+        conflict = "DO UPDATE SET metric = EXCLUDED.metric, updated_at = now()" if overwrite else "DO NOTHING"
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                INSERT INTO vector_table_setting (table_name, metric) VALUES (%s, %s)
+                ON CONFLICT (table_name) {conflict}
+                """, (table_name, metric))
+            conn.commit()
+        self._table_metric_cache.pop(table_name, None)
+    
+    def get_table_metric(self, table_name:str) -> str:
+        metric = self._table_metric_cache.get(table_name)
+        if metric is None:
+            with self.get_connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT to_regclass('vector_table_setting') IS NOT NULL")
+                row = None
+                if cur.fetchone()[0]:
+                    cur.execute("SELECT metric FROM vector_table_setting WHERE table_name = %s", (table_name,))
+                    row = cur.fetchone()
+            metric = row[0] if row else "l2"
+            self._table_metric_cache[table_name] = metric
+        return metric
+    
+    def get_table_dim(self, table_name:str) -> int:
+        """embedding 欄位的維度 (vector(n) 的 typmod), 查詢表示式須與該 table 的索引一致; table 不存在時回傳 embed_dim"""
+        table_dim = self._table_dim_cache.get(table_name)
+        if table_dim is None:
+            with self.get_connection() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    SELECT atttypmod FROM pg_attribute
+                    WHERE attrelid = to_regclass(%s) AND attname = 'embedding' AND NOT attisdropped
+                    """, (table_name,))
+                row = cur.fetchone()
+            if row is None or row[0] <= 0:
+                return int(embed_dim)
+            table_dim = row[0]
+            self._table_dim_cache[table_name] = table_dim
+        return table_dim
+    
+    def get_vector_version(self) -> tuple:
+        """已安裝的 pgvector 版本 e.g. (0, 8, 0), 只查詢一次; 不支援 iterative index scan 時印出一次警告"""
+        if self._vector_version is None:
+            with self.get_connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+                row = cur.fetchone()
+            if row is None:
+                return () # 尚未 CREATE EXTENSION vector, 下次再查詢
+            self._vector_version = tuple(int(part) for part in re.findall(r"\d+", row[0]))
+            if iterative_scan != "off" and self._vector_version < ITERATIVE_SCAN_MIN_VERSION:
+                print(f"pgvector {row[0]} does not support iterative index scans (requires 0.8+), "
+                      f"iterative_scan={iterative_scan} is ignored and filtered queries may return fewer than top_k rows")
+        return self._vector_version
+    
+    def add_chunk_hash_key(self, table_name:str, key_col:str = "source"):
+        """為既有 table 補上 chunk_hash 欄位與 (key_col, chunk_hash) 唯一索引"""
+        ddl = f"""
+        ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS chunk_hash varchar(64);
+        CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_{key_col}_chunk_hash_key ON {table_name} ({key_col}, chunk_hash);
+        """
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(ddl)
+            conn.commit()
+    
+    def get_conn_and_execute_sql_vec_search(self, sql, vec, search_setting:dict = None, params:dict = None):
         results = []
+        # 查詢向量為 %(vec)s, 其他參數 (例如 two-stage 的短向量) 由 params 傳入
+        query_params = {"vec": to_vector_param(vec)}
+        query_params.update(params or {})
         with self.get_connection() as conn, conn.cursor() as cur:
-            cur.execute(sql, (vec,))
-            rows = cur.fetchall() # 獲取所有查詢結果
+            # 只在此 transaction 生效 (SET LOCAL), 不影響 pool 中其他查詢
+            for name, value in (search_setting or {}).items():
+                cur.execute("SELECT set_config(%s, %s, true)", (name, str(value)))
+            start_time = time.perf_counter()
+            cur.execute(sql, query_params)
+            execute_sec = time.perf_counter() - start_time
+            Metrics.metrics.observe("sql_execute", execute_sec, op="search")
+            with Metrics.metrics.timer("sql_fetch", op="search"):
+                rows = cur.fetchall() # 獲取所有查詢結果
             columns = [desc[0] for desc in cur.description] # 獲取欄位名稱
             # 將結果輸出為 list[dict]
-            results = [dict(zip(columns, row)) for row in rows]
+            with Metrics.metrics.timer("result_build", op="search"):
+                results = [dict(zip(columns, row)) for row in rows]
+            Metrics.metrics.inc("rows_returned", len(rows), op="search")
+            # 仍在同一個 transaction 內, EXPLAIN 會套用相同的 set_config 查詢設定
+            if self.slow_query_ms and execute_sec * 1000.0 >= self.slow_query_ms:
+                self._explain_slow_query(cur, sql, query_params, execute_sec, search_setting, "search")
+
+        return results
+
+    '''**
+    * 慢查詢: 以 EXPLAIN (ANALYZE, BUFFERS) 重新執行一次並記錄執行計畫 (Metrics.log_slow_query)
+    * 須在原查詢的 transaction 內呼叫; 失敗時只印出錯誤, 不影響已取得的查詢結果
+    * @params: cur - 原查詢的 cursor; sql, query_params - 原查詢; elapsed_sec - 原查詢的執行時間
+    *          search_setting - 查詢設定; op - search / search_batch
+    *'''
+    def _explain_slow_query(self, cur, sql:str, query_params:dict, elapsed_sec:float, search_setting:dict, op:str):
+        Metrics.metrics.inc("slow_queries", op=op)
+        try:
+            cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql.strip(), query_params)
+            plan = "\n".join(row[0] for row in cur.fetchall())
+        except psycopg2.Error as e:
+            print(f"explain slow query fail because {e}")
+            return
+        # 向量參數很長, 只記錄純量參數與所有參數名稱
+        params = {name: value for name, value in query_params.items()
+                  if isinstance(value, (str, int, float, bool, type(None)))}
+        Metrics.log_slow_query({"op": op, "elapsed_ms": elapsed_sec * 1000.0, "sql": sql.strip(),
+                                "params": params, "param_names": sorted(query_params),
+                                "search_setting": search_setting or {}, "plan": plan})
+    
+    '''**
+    * 取得 embedding 欄位與查詢向量的 SQL 表示式
+    * 超過 2000 維時 vector 無法建立 HNSW / IVFFlat, 改用 halfvec 表示式 (最多 4000 維)
+    * 索引與查詢必須使用相同表示式, 查詢才會走索引
+    * @params: embed_dim - length of embedding; column - embedding or embedding_short
+    * @return: (embedding 表示式, 查詢參數 cast, opclass 前綴)
+    *'''
+    @staticmethod
+    def get_vector_expr(embed_dim = embed_dim, column = "embedding") -> tuple[str, str, str]:
+        embed_dim = int(embed_dim)
+        if embed_dim <= VECTOR_INDEX_MAX_DIM:
+            return column, "::vector", "vector"
+        if embed_dim <= HALFVEC_INDEX_MAX_DIM:
+            return f"({column}::halfvec({embed_dim}))", f"::halfvec({embed_dim})", "halfvec"
+        raise ValueError(f"embed_dim {embed_dim} exceeds {HALFVEC_INDEX_MAX_DIM}, cannot build ANN index")
+    
+    @staticmethod
+    def get_binary_expr(embed_dim = embed_dim, column = "embedding") -> str:
+        """binary quantization 表示式: 每一維依正負取 1 bit, 以 Hamming distance (<~>) 比較 (需要 pgvector 0.7+)"""
+        return f"(binary_quantize({column})::bit({int(embed_dim)}))"
+    
+    @staticmethod
+    def get_search_setting(ef_search = None, probes = None) -> dict:
+        """查詢時的 ANN 參數: hnsw.ef_search 越大 recall 越高; ivfflat.probes 越大 recall 越高"""
+        search_setting = {}
+        if ef_search is not None:
+            search_setting["hnsw.ef_search"] = min(int(ef_search), HNSW_MAX_EF_SEARCH)
+        if probes is not None:
+            search_setting["ivfflat.probes"] = int(probes)
+        return search_setting
+    
+    '''**
+    * 回傳的 distance 統一換算為 cosine distance (1 - cos), 不同 metric 的結果可直接比較
+    * OpenAI embedding 為單位向量: l2 距離 d 時 1 - cos = d^2 / 2; <#> 回傳 -內積, 1 - cos = 1 + (<#>)
+    * 換算為單調遞增, 排序結果不變; ORDER BY 仍使用原運算子才會走索引
+    * @params: metric - l2 / ip / cosine; raw_expr - 以該 metric 運算子計算的距離
+    * @return: SQL 表示式
+    *'''
+    @staticmethod
+    def get_distance_expr(metric:str, raw_expr:str) -> str:
+        if metric == "l2":
+            return f"(({raw_expr}) ^ 2) / 2"
+        if metric == "ip":
+            return f"(1 + ({raw_expr}))"
+        return raw_expr
+    
+    def get_nearest_sql(self, select_cols:str, table_name:str, top_k:int, where_condition:str = "", embed_dim = embed_dim,
+                        vec_expr:str = "%(vec)s", resort:bool = False, metric:str = "l2") -> str:
+        """組合 nearest 查詢, ORDER BY 與索引使用相同表示式; resort: iterative scan (relaxed_order) 的結果需重新排序"""
+        embedding_expr, vec_cast, _ = self.get_vector_expr(embed_dim)
+        #  PostgreSQL 無法自動進行型別轉換，須明確地進行型別轉換 ::vector
+        raw_expr = f"{embedding_expr} {METRIC_OPS[metric][0]} {vec_expr}{vec_cast}"
+        sql = f"""
+            SELECT {select_cols},
+                {self.get_distance_expr(metric, raw_expr)} AS distance
+            FROM   {table_name}
+            {where_condition}
+            ORDER BY {raw_expr} ASC
+            LIMIT {int(top_k)}
+            """
+        if resort:
+            sql = f"""
+            SELECT * FROM ({sql}) AS relaxed_results
+            ORDER BY distance ASC
+            """
+        return sql + ";"
+    
+    def get_exact_sql(self, select_cols:str, table_name:str, top_k:int, where_condition:str = "",
+                      vec_expr:str = "%(vec)s", metric:str = "l2") -> str:
+        """以完整精度的 embedding 計算距離 (不走 ANN 索引), 作為 recall 的基準"""
+        return f"""
+            SELECT {select_cols},
+                {self.get_distance_expr(metric, f"embedding {METRIC_OPS[metric][0]} {vec_expr}::vector")} AS distance
+            FROM   {table_name}
+            {where_condition}
+            ORDER BY distance ASC
+            LIMIT {int(top_k)};
+            """
+    
+    '''**
+    * two-stage 查詢: 同一個 SQL 內先以短向量 ANN 取出 candidates 筆, 再以完整 embedding 精確排序
+    * @params: candidates - 第一階段取出筆數 (top_k * overfetch); short_dim - 短向量維度
+    * 查詢參數: vec_expr 完整向量 (預設 %(vec)s), short_vec_expr 縮短並正規化後的向量 (預設 %(vec_short)s)
+    *'''
+    def get_two_stage_sql(self, select_cols:str, table_name:str, top_k:int, candidates:int, where_condition:str = "",
+                          short_dim = embed_short_dim, vec_expr:str = "%(vec)s", short_vec_expr:str = "%(vec_short)s",
+                          metric:str = "l2") -> str:
+        short_expr, short_cast, _ = self.get_vector_expr(short_dim, "embedding_short")
+        operator = METRIC_OPS[metric][0]
+        return f"""
+            SELECT {select_cols},
+                {self.get_distance_expr(metric, f"embedding {operator} {vec_expr}::vector")} AS distance
+            FROM (
+                SELECT {select_cols}, embedding
+                FROM   {table_name}
+                {where_condition}
+                ORDER BY {short_expr} {operator} {short_vec_expr}{short_cast}
+                LIMIT {int(candidates)}
+            ) AS candidates
+            ORDER BY distance ASC
+            LIMIT {int(top_k)};
+            """
+    
+    '''**
+    * binary 查詢: 同一個 SQL 內先以 Hamming distance 取出 candidates 筆, 再以完整 embedding 精確排序
+    * bit 索引只有 float32 向量的 1/32 大小, 可完整放進 shared_buffers; 精確度由 rerank 補回
+    * @params: candidates - 第一階段取出筆數 (top_k * overfetch); embed_dim - length of embedding
+    *'''
+    def get_binary_sql(self, select_cols:str, table_name:str, top_k:int, candidates:int, where_condition:str = "",
+                       embed_dim = embed_dim, vec_expr:str = "%(vec)s", metric:str = "l2") -> str:
+        return f"""
+            SELECT {select_cols},
+                {self.get_distance_expr(metric, f"embedding {METRIC_OPS[metric][0]} {vec_expr}::vector")} AS distance
+            FROM (
+                SELECT {select_cols}, embedding
+                FROM   {table_name}
+                {where_condition}
+                ORDER BY {self.get_binary_expr(embed_dim)} <~> binary_quantize({vec_expr}::vector)
+                LIMIT {int(candidates)}
+            ) AS candidates
+            ORDER BY distance ASC
+            LIMIT {int(top_k)};
+            """
+    
+    '''**
+    * 查詢文字 -> tsquery: 以 to_tsvector 斷詞後的 lexeme 以 OR 組合
+    * plainto_tsquery 為 AND, 整句問題 (e.g. "please show me the spec of cMT2158X") 幾乎不會有 chunk 全部符合
+    * lexeme 依 tsquery 的規則加引號 (\\ 與 '' 跳脫); quote_literal 遇到反斜線會產生 E'...', 不是合法的 tsquery
+    *'''
+    @staticmethod
+    def get_tsquery_expr(text_expr:str = "%(query_text)s", text_config = text_search_config) -> str:
+        return f"""
+            array_to_string(ARRAY(
+                SELECT '''' || replace(replace(lexeme, '\\', '\\\\'), '''', '''''') || ''''
+                FROM unnest(tsvector_to_array(to_tsvector('{text_config}'::regconfig, {text_expr}))) AS lexeme
+            ), ' | ')::tsquery"""
+    
+    '''**
+    * hybrid 查詢: 向量與全文檢索各取 candidates 筆, 以 reciprocal rank fusion 合併
+    * rrf_score = sum(1 / (rrf_k + rank)), 只出現在一邊的 chunk 只計算該邊
+    * 向量排名使用 ANN 索引 (有短向量時使用 embedding_short), 全文排名使用 chunk_tsv 的 GIN 索引
+    * 回傳的 distance 仍為完整 embedding 的距離, 依 rrf_score 由大到小排序
+    *'''
+    def get_hybrid_sql(self, select_cols:str, table_name:str, top_k:int, candidates:int, where_condition:str = "",
+                       embed_dim = embed_dim, vec_expr:str = "%(vec)s", short_vec_expr:str = "%(vec_short)s",
+                       text_expr:str = "%(query_text)s", metric:str = "l2") -> str:
+        operator = METRIC_OPS[metric][0]
+        if embed_short_dim:
+            rank_expr, rank_cast, _ = self.get_vector_expr(embed_short_dim, "embedding_short")
+            rank_vec_expr = short_vec_expr
+        else:
+            rank_expr, rank_cast, _ = self.get_vector_expr(embed_dim)
+            rank_vec_expr = vec_expr
+        text_condition = f"{where_condition} AND" if where_condition else "WHERE"
+        return f"""
+            WITH text_query AS (
+                SELECT {self.get_tsquery_expr(text_expr)} AS tsq
+            ),
+            vector_hits AS (
+                SELECT id, row_number() OVER (ORDER BY raw_distance) AS vector_rank
+                FROM (
+                    SELECT id, {rank_expr} {operator} {rank_vec_expr}{rank_cast} AS raw_distance
+                    FROM   {table_name}
+                    {where_condition}
+                    ORDER BY {rank_expr} {operator} {rank_vec_expr}{rank_cast}
+                    LIMIT {int(candidates)}
+                ) AS nearest
+            ),
+            text_hits AS (
+                SELECT id, row_number() OVER (ORDER BY text_score DESC) AS text_rank
+                FROM (
+                    SELECT id, ts_rank_cd(chunk_tsv, text_query.tsq) AS text_score
+                    FROM   {table_name}, text_query
+                    {text_condition} chunk_tsv @@ text_query.tsq
+                    ORDER BY text_score DESC
+                    LIMIT {int(candidates)}
+                ) AS matched
+            ),
+            fused AS (
+                SELECT id,
+                    (COALESCE(1.0 / ({int(rrf_k)} + vector_rank), 0)
+                     + COALESCE(1.0 / ({int(rrf_k)} + text_rank), 0))::float8 AS rrf_score
+                FROM vector_hits FULL OUTER JOIN text_hits USING (id)
+                ORDER BY rrf_score DESC
+                LIMIT {int(top_k)}
+            )
+            SELECT {select_cols},
+                {self.get_distance_expr(metric, f"embedding {operator} {vec_expr}::vector")} AS distance,
+                fused.rrf_score
+            FROM fused JOIN {table_name} USING (id)
+            ORDER BY fused.rrf_score DESC;
+            """
+    
+    '''**
+    * 依 strategy 組合查詢 SQL, 並補上 strategy 需要的查詢參數至 search_setting
+    * @params: vec_expr / short_vec_expr / text_expr - 查詢向量與查詢文字的 SQL 表示式 (批次查詢時為 LATERAL 中的欄位)
+    * @return: sql
+    *'''
+    def get_strategy_sql(self, select_cols:str, table_name:str, top_k:int, where_condition:str, strategy:str,
+                         overfetch, search_setting:dict, vec_expr:str = "%(vec)s", short_vec_expr:str = "%(vec_short)s",
+                         text_expr:str = "%(query_text)s") -> str:
+        metric = self.get_table_metric(table_name)
+        table_dim = self.get_table_dim(table_name)
+        if strategy == "exact":
+            search_setting["enable_indexscan"] = "off"
+            return self.get_exact_sql(select_cols, table_name, top_k, where_condition, vec_expr=vec_expr, metric=metric)
+        if strategy != "ann" and strategy not in DEFAULT_OVERFETCH:
+            raise ValueError(f"unsupported search strategy: {strategy}")
+        # 有過濾條件時, ANN 索引掃描到的資料可能被過濾掉: 繼續掃描直到滿足 LIMIT
+        resort = False
+        if where_condition and iterative_scan != "off" and self.get_vector_version() >= ITERATIVE_SCAN_MIN_VERSION:
+            search_setting.setdefault("hnsw.iterative_scan", iterative_scan)
+            search_setting.setdefault("hnsw.max_scan_tuples", max_scan_tuples)
+            # ivfflat 只支援 relaxed_order
+            search_setting.setdefault("ivfflat.iterative_scan", "relaxed_order")
+            resort = True
+        if strategy == "ann":
+            return self.get_nearest_sql(select_cols, table_name, top_k, where_condition, embed_dim=table_dim,
+                                        vec_expr=vec_expr, resort=resort, metric=metric)
+        candidates = int(top_k) * int(overfetch or DEFAULT_OVERFETCH[strategy])
+        # HNSW 最多回傳 ef_search 筆, 須不小於 candidates (但不超過 pgvector 的上限)
+        search_setting.setdefault("hnsw.ef_search", min(max(candidates, 40), HNSW_MAX_EF_SEARCH))
+        if strategy == "hybrid":
+            return self.get_hybrid_sql(select_cols, table_name, top_k, candidates, where_condition, embed_dim=table_dim,
+                                       vec_expr=vec_expr, short_vec_expr=short_vec_expr, text_expr=text_expr, metric=metric)
+        if strategy == "binary":
+            return self.get_binary_sql(select_cols, table_name, top_k, candidates, where_condition, embed_dim=table_dim,
+                                       vec_expr=vec_expr, metric=metric)
+        if not embed_short_dim:
+            raise ValueError("two_stage search requires embed_short_dim in Config.ini")
+        return self.get_two_stage_sql(select_cols, table_name, top_k, candidates, where_condition,
+                                      vec_expr=vec_expr, short_vec_expr=short_vec_expr, metric=metric)
+    
+    '''**
+    * 依 strategy 查詢最近的 K 筆
+    * @params: select_cols - 回傳欄位; where_condition - WHERE 子句
+    *          ef_search, probes - ANN 查詢參數
+    *          strategy - ann: 索引查詢; exact: 完整精度逐筆比對; two_stage: 短向量 ANN + 完整向量 rerank
+    *                     binary: binary quantization Hamming ANN + 完整向量 rerank
+    *                     hybrid: 向量與全文檢索 (chunk_tsv) 以 reciprocal rank fusion 合併, 需提供 query_text
+    *          overfetch - two_stage / binary / hybrid 第一階段取出 top_k * overfetch 筆
+    *          where_params - where_condition 中的查詢參數 (見 get_filter_condition)
+    *          query_text - 查詢文字 (hybrid 使用)
+    * @return: list of dict, 依 distance 排序 (hybrid 依 rrf_score 排序)
+    *'''
+    def query_nearest(self, vec, select_cols:str, table_name:str, top_k = 10, where_condition:str = "",
+                      ef_search = None, probes = None, strategy = default_strategy, overfetch = None, where_params:dict = None,
+                      query_text:str = None):
+        search_setting = self.get_search_setting(ef_search, probes)
+        sql = self.get_strategy_sql(select_cols, table_name, top_k, where_condition, strategy, overfetch, search_setting)
+        params = dict(where_params or {})
+        if strategy == "hybrid":
+            if not query_text:
+                raise ValueError("hybrid search requires query_text")
+            params["query_text"] = query_text
+        if strategy == "two_stage" or (strategy == "hybrid" and embed_short_dim):
+            params["vec_short"] = to_vector_param(EmbeddingFunction.shorten_embedding(vec, embed_short_dim))
+        return self.get_conn_and_execute_sql_vec_search(sql, vec, search_setting, params)
+    
+    '''**
+    * 批次查詢: 多個查詢向量以 unnest + LATERAL join 在一個 SQL 內完成, 每批共用同一個連線
+    * @params: vecs - list of query embedding 或 2-D np.ndarray; batch_size - 每個 SQL 的查詢數
+    *          query_texts - 與 vecs 對應的查詢文字 (hybrid 使用); 其餘參數同 query_nearest
+    * @return: list of list[dict], 與 vecs 順序一致
+    *'''
+    def query_nearest_batch(self, vecs, select_cols:str, table_name:str, top_k = 10, where_condition:str = "",
+                            ef_search = None, probes = None, strategy = default_strategy, overfetch = None,
+                            batch_size = 256, where_params:dict = None, query_texts:list[str] = None) -> list[list[dict]]:
+        search_setting = self.get_search_setting(ef_search, probes)
+        # two_stage 的短向量在 SQL 內由完整向量計算
+        short_vec_expr = f"l2_normalize(subvector(q.vec, 1, {int(embed_short_dim)}))" if embed_short_dim else ""
+        inner_sql = self.get_strategy_sql(select_cols, table_name, top_k, where_condition, strategy, overfetch,
+                                          search_setting, vec_expr="q.vec", short_vec_expr=short_vec_expr,
+                                          text_expr="q.query_text")
+        vecs = [to_vector_param(vec) for vec in vecs]
+        if strategy == "hybrid" and (query_texts is None or len(query_texts) != len(vecs)):
+            raise ValueError("hybrid search requires one query_text per vec")
+        order_by = "r.rrf_score DESC" if strategy == "hybrid" else "r.distance"
+        sql = f"""
+            SELECT q.query_idx, r.*
+            FROM   unnest(%(vecs)s::vector[], %(query_texts)s::text[]) WITH ORDINALITY AS q(vec, query_text, query_idx)
+            CROSS JOIN LATERAL ({inner_sql.strip().rstrip(";")}) AS r
+            ORDER BY q.query_idx, {order_by};
+            """
+        query_texts = list(query_texts) if query_texts is not None else [None] * len(vecs)
+        results = [[] for _ in vecs]
+        with self.get_connection() as conn, conn.cursor() as cur:
+            for name, value in search_setting.items():
+                cur.execute("SELECT set_config(%s, %s, true)", (name, str(value)))
+            for start in range(0, len(vecs), batch_size):
+                query_params = dict(where_params or {}, vecs=vecs[start:start + batch_size],
+                                    query_texts=query_texts[start:start + batch_size])
+                start_time = time.perf_counter()
+                cur.execute(sql, query_params)
+                execute_sec = time.perf_counter() - start_time
+                Metrics.metrics.observe("sql_execute", execute_sec, op="search_batch")
+                columns = [desc[0] for desc in cur.description][1:]
+                with Metrics.metrics.timer("sql_fetch", op="search_batch"):
+                    rows = cur.fetchall()
+                with Metrics.metrics.timer("result_build", op="search_batch"):
+                    for row in rows:
+                        # query_idx 由 1 開始
+                        results[start + row[0] - 1].append(dict(zip(columns, row[1:])))
+                Metrics.metrics.inc("rows_returned", len(rows), op="search_batch")
+                # 一批有多個查詢向量, 門檻以每個查詢的平均執行時間判斷
+                if self.slow_query_ms and execute_sec * 1000.0 / len(query_params["vecs"]) >= self.slow_query_ms:
+                    self._explain_slow_query(cur, sql, query_params, execute_sec, search_setting, "search_batch")
+        return results
+    
+    '''**
+    * 新增短向量欄位 embedding_short = l2_normalize(embedding 前 short_dim 維)
+    * generated column 由資料庫計算, 寫入流程不需改變; 既有資料會在 ALTER 時一併計算 (需要 pgvector 0.7+)
+    * @params: table_name - table name; short_dim - 短向量維度
+    *'''
+    def add_short_embedding(self, table_name:str, short_dim = embed_short_dim):
+        sql = f"""
+            ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS embedding_short vector({int(short_dim)})
+            GENERATED ALWAYS AS (l2_normalize(subvector(embedding, 1, {int(short_dim)}))::vector({int(short_dim)})) STORED;
+            """
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(sql)
+            conn.commit()
+    
+    '''**
+    * 新增全文檢索欄位 chunk_tsv = to_tsvector(chunk_context) 與 GIN 索引, 供 hybrid 查詢使用
+    * generated column 隨 chunk_context 寫入時更新; 既有資料會在 ALTER 時一併計算 (需重寫整個 table)
+    * @params: table_name - table name; text_config - 全文檢索設定, 查詢時須相同 (見 text_search_config)
+    *'''
+    def add_text_search(self, table_name:str, text_config = text_search_config):
+        sql = f"""
+            ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS chunk_tsv tsvector
+            GENERATED ALWAYS AS (to_tsvector('{text_config}'::regconfig, coalesce(chunk_context, ''))) STORED;
+            CREATE INDEX IF NOT EXISTS {table_name}_chunk_tsv_idx ON {table_name} USING gin (chunk_tsv);
+            """
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(sql)
+            conn.commit()
+    
+    @staticmethod
+    def get_index_name(table_name:str, column:str, index_type:str, name_suffix:str = "") -> str:
+        """ANN 索引名稱 {table}_{column}{suffix}_{type}_idx; 超過 63 bytes 時 suffix 改為整個名稱的 md5, 避免被 PostgreSQL 截斷"""
+        index_name = f"{table_name}_{column}{name_suffix}_{index_type}_idx"
+        if len(index_name.encode("utf-8")) <= PG_IDENTIFIER_MAX_BYTES:
+            return index_name
+        tail = f"_{hashlib.md5(index_name.encode('utf-8')).hexdigest()[:12]}_{index_type}_idx"
+        prefix = f"{table_name}_{column}".encode("utf-8")[:PG_IDENTIFIER_MAX_BYTES - len(tail)]
+        return prefix.decode("utf-8", errors="ignore") + tail
+
+    '''**
+    * 在 embedding 欄位建立 ANN 索引
+    * @params: table_name - table name; index_type - hnsw or ivfflat; embed_dim - length of embedding
+    *          m, ef_construction - HNSW 建立參數; lists - IVFFlat 分群數 (None: 依資料筆數估算)
+    *          maintenance_work_mem - 建立索引時可用記憶體, 例如 "2GB"
+    *          column - embedding; embedding_short (two_stage 查詢使用, 維度為 embed_short_dim);
+    *                   embedding_binary (binary 查詢使用, binary_quantize(embedding) 的 Hamming 索引)
+    *          where_condition, name_suffix - partial index 的條件與索引名稱後綴 (見 create_filtered_vector_indexes)
+    * @return: dict(status, error_reason, index_name)
+    * 建議在資料寫入完成後建立 (IVFFlat 需依現有資料分群)
+    **'''
+    def create_vector_index(self, table_name:str, index_type = "hnsw", embed_dim = embed_dim,
+                            m = 16, ef_construction = 64, lists = None, maintenance_work_mem = None,
+                            column = default_index_column, where_condition = "", name_suffix = "") -> dict:
+        index_name = self.get_index_name(table_name, column, index_type, name_suffix)
+        return_json = {
+            "status":"fail",
+            "error_reason":"",
+            "index_name":index_name
+        }
+        try:
+            if column == "embedding_binary":
+                embedding_expr, opclass = self.get_binary_expr(embed_dim), "bit_hamming_ops"
+            else:
+                if column == "embedding_short":
+                    embed_dim = embed_short_dim
+                embedding_expr, _, opclass_prefix = self.get_vector_expr(embed_dim, column)
+                # 與查詢相同的 metric, 查詢的 ORDER BY 運算子才會使用此索引
+                opclass = f"{opclass_prefix}_{METRIC_OPS[self.get_table_metric(table_name)][1]}"
+            with self.get_connection() as conn, conn.cursor() as cur:
+                if maintenance_work_mem:
+                    cur.execute("SELECT set_config('maintenance_work_mem', %s, true)", (maintenance_work_mem,))
+                if index_type == "hnsw":
+                    with_params = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+                elif index_type == "ivfflat":
+                    if lists is None:
+                        # pgvector 建議: 1M 筆以下 rows/1000, 以上 sqrt(rows)
+                        cur.execute(f"SELECT count(*) FROM {table_name}")
+                        rows = cur.fetchone()[0]
+                        lists = max(1, rows // 1000) if rows <= 1000000 else int(rows ** 0.5)
+                    with_params = f"lists = {int(lists)}"
+                else:
+                    raise ValueError(f"unsupported index_type: {index_type}")
+                cur.execute(f"""
+                    CREATE INDEX IF NOT EXISTS {index_name} ON {table_name}
+                    USING {index_type} ({embedding_expr} {opclass})
+                    WITH ({with_params})
+                    {where_condition};
+                    """)
+                conn.commit()
             
+            return_json["status"] = "success"
+        
+        except Exception as e:
+            error_reason = f"create {index_type} index on {table_name} fail because {e}"
+            return_json["error_reason"] = error_reason
+            print(error_reason)
+        
+        return return_json
+    
+    '''**
+    * 依過濾欄位的值建立 partial ANN 索引, 過濾後的查詢只掃描該值的索引
+    * 1. 另建立過濾欄位的 btree 索引: 資料少的值由 planner 直接以 btree 取出後精確排序
+    * 2. 只有資料筆數 >= min_rows 的值建立 partial index (資料少時 partial index 沒有效益)
+    * @params: table_name; filter_column - e.g. model, class_name, customer_flag; values - None: 依資料中的值
+    *          min_rows - 建立 partial index 的最少筆數; index_kwargs - 同 create_vector_index
+    * @return: list of create_vector_index 的結果
+    *'''
+    def create_filtered_vector_indexes(self, table_name:str, filter_column:str, values = None, min_rows = 1000,
+                                       index_type = "hnsw", **index_kwargs) -> list[dict]:
+        with self.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_{filter_column}_idx ON {table_name} ({filter_column})")
+            if values is None:
+                cur.execute(f"""
+                    SELECT {filter_column} FROM {table_name}
+                    WHERE {filter_column} IS NOT NULL
+                    GROUP BY {filter_column} HAVING count(*) >= %s
+                    """, (int(min_rows),))
+                values = [row[0] for row in cur.fetchall()]
+            # 與 get_filter_condition 相同的條件文字, 查詢才會使用 partial index
+            conditions = [cur.mogrify(f"WHERE {filter_column} = %s", (value,)).decode("utf-8") for value in values]
+            conn.commit()
+        results = []
+        for value, where_condition in zip(values, conditions):
+            name_suffix = f"_{filter_column}_{hashlib.md5(str(value).encode('utf-8')).hexdigest()[:8]}"
+            results.append(self.create_vector_index(table_name, index_type, where_condition=where_condition,
+                                                    name_suffix=name_suffix, **index_kwargs))
         return results
     
+    '''**
+    * 刪除 create_vector_index 建立的索引
+    * 預設連同 create_filtered_vector_indexes 建立的 partial 索引一併刪除, 變更 metric / opclass 或索引類型後不會留下舊的 partial 索引
+    * 依 catalog 的索引方法與索引表示式比對, 不依名稱 (被截斷的舊索引名稱也能刪除); embedding 不會誤刪 embedding_short 的索引
+    * @params: name_suffix - 只刪除此 suffix 的索引 ("" 為完整索引); None 代表完整索引與所有 partial 索引
+    * @return: 刪除的索引名稱
+    *'''
+    def drop_vector_index(self, table_name:str, index_type = "hnsw", column = default_index_column,
+                          name_suffix:str = None) -> list[str]:
+        with self.get_connection() as conn, conn.cursor() as cur:
+            if name_suffix is not None:
+                index_names = [self.get_index_name(table_name, column, index_type, name_suffix)]
+            else:
+                cur.execute("""
+                    SELECT c.relname, pg_get_indexdef(i.indexrelid, 1, true)
+                    FROM   pg_index i
+                    JOIN   pg_class c ON c.oid = i.indexrelid
+                    JOIN   pg_am am ON am.oid = c.relam
+                    WHERE  i.indrelid = to_regclass(%s) AND am.amname = %s
+                    """, (table_name, index_type))
+                # embedding_binary 的索引表示式為 binary_quantize(embedding), 其他為欄位本身或 halfvec cast
+                binary = column == "embedding_binary"
+                key_pattern = re.compile(rf"\b{re.escape('embedding' if binary else column)}\b")
+                index_names = sorted(index_name for index_name, index_key in cur.fetchall()
+                                     if ("binary_quantize(" in index_key) == binary and key_pattern.search(index_key))
+            for index_name in index_names:
+                cur.execute(f"DROP INDEX IF EXISTS {index_name}")
+            conn.commit()
+        return index_names
+    
     '''* create jssdk table in postgres
     * @params: embed_dim - length of embedding; table_name - your customized table name
+    *          short_dim - two-stage 查詢用短向量維度 (0: 不建立 embedding_short)
+    *          metric - l2 / ip / cosine, 只對新建立的 table 生效
     * @return: dict(status, error_reason)
     **'''
-    def create_jssdk_table(self, embed_dim = embed_dim, table_name = "jssdk") -> dict:
+    def create_jssdk_table(self, embed_dim = embed_dim, table_name = "jssdk", short_dim = embed_short_dim,
+                          metric = default_metric) -> dict:
         return_json = {
             "status":"fail",
             "error_reason":""
         }
         try:
+            self.check_metric(metric)
+            # 既有 table 未記錄 metric 時, 其資料與索引以 l2 建立
+            existed = self.table_exists(table_name)
             ddl = f"""
             CREATE EXTENSION IF NOT EXISTS vector;
             CREATE TABLE IF NOT EXISTS {table_name} (
@@ -75,12 +1260,19 @@ class PGVector:
                 class_name varchar(256),
                 description text,
                 chunk_context text,
+                chunk_hash varchar(64),
                 embedding vector({embed_dim})
             );
             """
             with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute(ddl)
                 conn.commit()
+            # (source, chunk_hash) 唯一, 重跑 ETL 不會重複寫入
+            self.add_chunk_hash_key(table_name, "source")
+            if short_dim:
+                self.add_short_embedding(table_name, short_dim)
+            self.add_text_search(table_name)
+            self.set_table_metric(table_name, "l2" if existed else metric)
         
             return_json["status"] = "success"
         
@@ -91,29 +1283,38 @@ class PGVector:
         
         return return_json
     
-    def query_jssdk_nearest(self, vec, table_name = "jssdk", top_k = 10):
-        """回傳與 vec 最近的 K 筆"""
-        #  PostgreSQL 無法自動進行型別轉換，須明確地進行型別轉換 ::vector
-        sql = f"""
-            SELECT url, class_name, description, chunk_context,
-                embedding <-> %s::vector AS distance
-            FROM   {table_name}
-            ORDER BY distance ASC
-            LIMIT {top_k};
-            """
-        results = self.get_conn_and_execute_sql_vec_search(sql, vec)            
+    def query_jssdk_nearest(self, vec, table_name = "jssdk", top_k = 10, ef_search = None, probes = None,
+                             strategy = default_strategy, overfetch = None, class_name = None, query_text = None):
+        """回傳與 vec 最近的 K 筆; class_name - 過濾條件, 單一值或 list"""
+        where_condition, where_params = self.get_filter_condition("class_name", class_name)
+        results = self.query_nearest(vec, "url, class_name, description, chunk_context", table_name, top_k, where_condition,
+                                     ef_search, probes, strategy, overfetch, where_params=where_params, query_text=query_text)
+        return results
+    
+    def query_jssdk_nearest_batch(self, vecs, table_name = "jssdk", top_k = 10, ef_search = None, probes = None,
+                                  strategy = default_strategy, overfetch = None, class_name = None, query_texts = None):
+        """批次版本: 回傳每個 vec 最近的 K 筆; class_name - 過濾條件, 單一值或 list"""
+        where_condition, where_params = self.get_filter_condition("class_name", class_name)
+        results = self.query_nearest_batch(vecs, "url, class_name, description, chunk_context", table_name, top_k, where_condition,
+                                           ef_search, probes, strategy, overfetch, where_params=where_params, query_texts=query_texts)
         return results
     
     '''* create spec table in postgres
     * @params: embed_dim - length of embedding; table_name - your customized table name
+    *          short_dim - two-stage 查詢用短向量維度 (0: 不建立 embedding_short)
+    *          metric - l2 / ip / cosine, 只對新建立的 table 生效
     * @return: dict(status, error_reason)
     **'''
-    def create_spec_table(self, embed_dim = embed_dim, table_name = "spec") -> dict:
+    def create_spec_table(self, embed_dim = embed_dim, table_name = "spec", short_dim = embed_short_dim,
+                          metric = default_metric) -> dict:
         return_json = {
             "status":"fail",
             "error_reason":""
         }
         try:
+            self.check_metric(metric)
+            # 既有 table 未記錄 metric 時, 其資料與索引以 l2 建立
+            existed = self.table_exists(table_name)
             ddl = f"""
             CREATE EXTENSION IF NOT EXISTS vector;
             CREATE TABLE IF NOT EXISTS {table_name} (
@@ -121,12 +1322,19 @@ class PGVector:
                 source varchar(256),
                 model varchar(256),
                 chunk_context text,
+                chunk_hash varchar(64),
                 embedding vector({embed_dim})
             );
             """
             with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute(ddl)
                 conn.commit()
+            # (source, chunk_hash) 唯一, 重跑 ETL 不會重複寫入
+            self.add_chunk_hash_key(table_name, "source")
+            if short_dim:
+                self.add_short_embedding(table_name, short_dim)
+            self.add_text_search(table_name)
+            self.set_table_metric(table_name, "l2" if existed else metric)
         
             return_json["status"] = "success"
         
@@ -137,29 +1345,38 @@ class PGVector:
         
         return return_json
     
-    def query_spec_nearest(self, vec, table_name = "spec", top_k = 10):
-        """回傳與 vec 最近的 K 筆"""
-        #  PostgreSQL 無法自動進行型別轉換，須明確地進行型別轉換 ::vector
-        sql = f"""
-            SELECT source, model, chunk_context,
-                embedding <-> %s::vector AS distance
-            FROM   {table_name}
-            ORDER BY distance ASC
-            LIMIT {top_k};
-            """
-        results = self.get_conn_and_execute_sql_vec_search(sql, vec)
+    def query_spec_nearest(self, vec, table_name = "spec", top_k = 10, ef_search = None, probes = None,
+                             strategy = default_strategy, overfetch = None, model = None, query_text = None):
+        """回傳與 vec 最近的 K 筆; model - 過濾條件, 單一值或 list"""
+        where_condition, where_params = self.get_filter_condition("model", model)
+        results = self.query_nearest(vec, "source, model, chunk_context", table_name, top_k, where_condition,
+                                     ef_search, probes, strategy, overfetch, where_params=where_params, query_text=query_text)
+        return results
+    
+    def query_spec_nearest_batch(self, vecs, table_name = "spec", top_k = 10, ef_search = None, probes = None,
+                                 strategy = default_strategy, overfetch = None, model = None, query_texts = None):
+        """批次版本: 回傳每個 vec 最近的 K 筆; model - 過濾條件, 單一值或 list"""
+        where_condition, where_params = self.get_filter_condition("model", model)
+        results = self.query_nearest_batch(vecs, "source, model, chunk_context", table_name, top_k, where_condition,
+                                           ef_search, probes, strategy, overfetch, where_params=where_params, query_texts=query_texts)
         return results
     
     '''* create manual table in postgres
     * @params: embed_dim - length of embedding; table_name - your customized table name
+    *          short_dim - two-stage 查詢用短向量維度 (0: 不建立 embedding_short)
+    *          metric - l2 / ip / cosine, 只對新建立的 table 生效
     * @return: dict(status, error_reason)
     **'''
-    def create_manual_table(self, embed_dim = embed_dim, table_name = "manual") -> dict:
+    def create_manual_table(self, embed_dim = embed_dim, table_name = "manual", short_dim = embed_short_dim,
+                          metric = default_metric) -> dict:
         return_json = {
             "status":"fail",
             "error_reason":""
         }
         try:
+            self.check_metric(metric)
+            # 既有 table 未記錄 metric 時, 其資料與索引以 l2 建立
+            existed = self.table_exists(table_name)
             ddl = f"""
             CREATE EXTENSION IF NOT EXISTS vector;
             CREATE TABLE IF NOT EXISTS {table_name} (
@@ -171,12 +1388,19 @@ class PGVector:
                 class_name varchar(20),
                 class_desc text,
                 chunk_context text,
+                chunk_hash varchar(64),
                 embedding vector({embed_dim})
             );
             """
             with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute(ddl)
                 conn.commit()
+            # 不同資料夾可能有相同檔名, 以完整路徑 filename 作為來源: (filename, chunk_hash) 唯一
+            self.add_chunk_hash_key(table_name, "filename")
+            if short_dim:
+                self.add_short_embedding(table_name, short_dim)
+            self.add_text_search(table_name)
+            self.set_table_metric(table_name, "l2" if existed else metric)
         
             return_json["status"] = "success"
         
@@ -187,30 +1411,39 @@ class PGVector:
         
         return return_json
     
-    def query_manual_nearest(self, vec, table_name = "manual", top_k = 10):
-        """回傳與 vec 最近的 K 筆"""
-        #  PostgreSQL 無法自動進行型別轉換，須明確地進行型別轉換 ::vector
-        sql = f"""
-            SELECT source, chunk_context,
-                embedding <-> %s::vector AS distance
-            FROM   {table_name}
-            ORDER BY distance ASC
-            LIMIT {top_k};
-            """
-        results = self.get_conn_and_execute_sql_vec_search(sql, vec)
+    def query_manual_nearest(self, vec, table_name = "manual", top_k = 10, ef_search = None, probes = None,
+                             strategy = default_strategy, overfetch = None, class_name = None, query_text = None):
+        """回傳與 vec 最近的 K 筆; class_name - 過濾條件, 單一值或 list"""
+        where_condition, where_params = self.get_filter_condition("class_name", class_name)
+        results = self.query_nearest(vec, "source, chunk_context", table_name, top_k, where_condition,
+                                     ef_search, probes, strategy, overfetch, where_params=where_params, query_text=query_text)
+        return results
+    
+    def query_manual_nearest_batch(self, vecs, table_name = "manual", top_k = 10, ef_search = None, probes = None,
+                                   strategy = default_strategy, overfetch = None, class_name = None, query_texts = None):
+        """批次版本: 回傳每個 vec 最近的 K 筆; class_name - 過濾條件, 單一值或 list"""
+        where_condition, where_params = self.get_filter_condition("class_name", class_name)
+        results = self.query_nearest_batch(vecs, "source, chunk_context", table_name, top_k, where_condition,
+                                           ef_search, probes, strategy, overfetch, where_params=where_params, query_texts=query_texts)
         return results
 
     '''
     * create wtk_benchmark table in postgres
     * @params: embed_dim - length of embedding; table_name - your customized table name
+    *          short_dim - two-stage 查詢用短向量維度 (0: 不建立 embedding_short)
+    *          metric - l2 / ip / cosine, 只對新建立的 table 生效
     * @return: dict(status, error_reason)
     '''
-    def create_benchmark_table(self, embed_dim = embed_dim, table_name = "wtk_benchmark") -> dict:
+    def create_benchmark_table(self, embed_dim = embed_dim, table_name = "wtk_benchmark", short_dim = embed_short_dim,
+                          metric = default_metric) -> dict:
         return_json = {
             "status":"fail",
             "error_reason":""
         }
         try:
+            self.check_metric(metric)
+            # 既有 table 未記錄 metric 時, 其資料與索引以 l2 建立
+            existed = self.table_exists(table_name)
             ddl = f"""
             CREATE EXTENSION IF NOT EXISTS vector;
             CREATE TABLE IF NOT EXISTS {table_name} (
@@ -231,6 +1464,10 @@ class PGVector:
             with self.get_connection() as conn, conn.cursor() as cur:
                 cur.execute(ddl)
                 conn.commit()
+            if short_dim:
+                self.add_short_embedding(table_name, short_dim)
+            self.add_text_search(table_name)
+            self.set_table_metric(table_name, "l2" if existed else metric)
         
             return_json["status"] = "success"
         
@@ -241,27 +1478,131 @@ class PGVector:
         
         return return_json
 
-    def query_benchmark_nearest_by_identity(self, vec, table_name = "wtk_benchmark", top_k = 10, identity = "customer"):
+    def query_benchmark_nearest_by_identity(self, vec, table_name = "wtk_benchmark", top_k = 10, identity = "customer",
+                                            ef_search = None, probes = None, strategy = default_strategy, overfetch = None,
+                                            query_text = None):
         """回傳與 vec 最近的 K 筆 for customer or distributor"""
-        where_condition = ""
-        if identity == "customer":
-            where_condition = "WHERE customer_flag = 1"
-        elif identity == "distributor":
-            where_condition = "WHERE distributor_flag = 1"
-        #  PostgreSQL 無法自動進行型別轉換，須明確地進行型別轉換 ::vector
-        sql = f"""
-            SELECT chunk_context,
-                embedding <-> %s::vector AS distance
-            FROM   {table_name}
-            {where_condition}
-            ORDER BY distance ASC
-            LIMIT {top_k};
-            """
-        results = self.get_conn_and_execute_sql_vec_search(sql, vec)
+        results = self.query_nearest(vec, "chunk_context", table_name, top_k, self.get_identity_condition(identity),
+                                     ef_search, probes, strategy, overfetch, query_text=query_text)
+        return results
+    
+    def query_benchmark_nearest_by_identity_batch(self, vecs, table_name = "wtk_benchmark", top_k = 10, identity = "customer",
+                                                  ef_search = None, probes = None, strategy = default_strategy, overfetch = None,
+                                                  query_texts = None):
+        """批次版本: 回傳每個 vec 最近的 K 筆 for customer or distributor"""
+        results = self.query_nearest_batch(vecs, "chunk_context", table_name, top_k, self.get_identity_condition(identity),
+                                           ef_search, probes, strategy, overfetch, query_texts=query_texts)
         return results
+    
+    '''**
+    * metadata 過濾條件
+    * @params: column - 欄位名稱; value - 單一值 (=) 或 list (= ANY), None 代表不過濾
+    * @return: (where_condition, where_params)
+    * 查詢參數在 client 端代入, 單一值的條件與 create_filtered_vector_indexes 的 partial index 條件相同, 查詢可使用該索引
+    *'''
+    @staticmethod
+    def get_filter_condition(column:str, value) -> tuple[str, dict]:
+        if value is None:
+            return "", {}
+        if isinstance(value, (list, tuple, set)):
+            return f"WHERE {column} = ANY(%(filter_value)s)", {"filter_value": list(value)}
+        return f"WHERE {column} = %(filter_value)s", {"filter_value": value}
+    
+    @staticmethod
+    def get_identity_condition(identity:str) -> str:
+        """benchmark 的 customer / distributor 條件; 其他值拋出 ValueError, 不會變成不過濾"""
+        if identity not in IDENTITY_FLAGS:
+            raise ValueError(f"unsupported identity: {identity}, use one of {list(IDENTITY_FLAGS)}")
+        return f"WHERE {IDENTITY_FLAGS[identity]} = 1"
+    
+    '''**
+    * scope 的 metadata 過濾參數
+    * @params: scope - SCOPE_QUERIES 中的名稱
+    *          filter_value - 單一值 / list: 套用在此 scope 的 SCOPE_FILTERS 欄位
+    *                         dict scope -> 值: 只套用此 scope 的值, 其他 scope 不過濾
+    * @return: dict(query_*_nearest 的參數名稱 -> 值), 不過濾時為空 dict
+    * benchmark 沒有 metadata 欄位 (identity 另外指定), 對 benchmark 指定 filter_value 時拋出 ValueError
+    *'''
+    @staticmethod
+    def get_scope_filter(scope:str, filter_value) -> dict:
+        if isinstance(filter_value, dict):
+            unknown = sorted(set(filter_value) - set(SCOPE_FILTERS))
+            if unknown:
+                raise ValueError(f"no metadata filter for scopes {unknown}, use one of {list(SCOPE_FILTERS)}")
+            filter_value = filter_value.get(scope)
+        if filter_value is None:
+            return {}
+        if scope not in SCOPE_FILTERS:
+            raise ValueError(f"no metadata filter for scope {scope}, use identity for benchmark")
+        return {SCOPE_FILTERS[scope]: filter_value}
+    
+    def query_scope_nearest(self, scope:str, vec, top_k = 10, identity = "customer", filter_value = None, **search_kwargs):
+        """依 scope 呼叫對應的 query_*_nearest; filter_value 見 get_scope_filter; search_kwargs 為 ef_search, probes, strategy, overfetch, query_text"""
+        if scope not in SCOPE_QUERIES:
+            raise ValueError(f"unsupported scope: {scope}")
+        search_kwargs.update(self.get_scope_filter(scope, filter_value))
+        if scope == "benchmark":
+            search_kwargs["identity"] = identity
+        return getattr(self, SCOPE_QUERIES[scope])(vec=vec, top_k=top_k, **search_kwargs)
+    
+    def query_scope_nearest_batch(self, scope:str, vecs, top_k = 10, identity = "customer", filter_value = None, **search_kwargs):
+        """query_scope_nearest 的批次版本, 回傳 list of list[dict]"""
+        if scope not in SCOPE_QUERIES:
+            raise ValueError(f"unsupported scope: {scope}")
+        search_kwargs.update(self.get_scope_filter(scope, filter_value))
+        if scope == "benchmark":
+            search_kwargs["identity"] = identity
+        return getattr(self, SCOPE_QUERIES[scope] + "_batch")(vecs=vecs, top_k=top_k, **search_kwargs)
+    
+    '''**
+    * 同時查詢多個 scope 並合併排序
+    * 1. query 只轉換一次 embedding
+    * 2. 各 scope 在不同 thread 執行, 各自自 pool 借用連線, 總時間約等於最慢的 table
+    * 3. 依 distance 合併為一個排序結果 (hybrid 依 rrf_score), 每筆加上 scope 欄位; 單一 scope 失敗時略過該 scope
+    * @params: query - 查詢文字 (需提供 embed_func) 或 query embedding; scopes - SCOPE_QUERIES 中的名稱
+    *          embed_func - text -> embedding, e.g. AzureOpenAIEmbeddings.get_query_embedding
+    *          identity - benchmark 使用; filter_value - dict scope -> 值, 只過濾對應的 scope (各 scope 欄位不同, 不接受單一值)
+    *          search_kwargs - ef_search, probes, strategy, overfetch, query_text
+    * @return: list of dict, 全部 scope 中最近的 top_k 筆
+    *'''
+    def search_all(self, query, scopes = tuple(SCOPE_QUERIES), top_k = 10, embed_func = None,
+                   identity = "customer", filter_value:dict = None, **search_kwargs) -> list[dict]:
+        # 參數錯誤在查詢前拋出, 不會被當成單一 scope 失敗而略過
+        if filter_value is not None and not isinstance(filter_value, dict):
+            raise ValueError(f"filter_value for all scopes must be a dict of scope -> value, one of {list(SCOPE_FILTERS)}")
+        for scope in scopes:
+            if scope not in SCOPE_QUERIES:
+                raise ValueError(f"unsupported scope: {scope}")
+            self.get_scope_filter(scope, filter_value)
+        if "benchmark" in scopes:
+            self.get_identity_condition(identity)
+        if isinstance(query, str):
+            vec = embed_func(query)
+            search_kwargs.setdefault("query_text", query)
+        else:
+            vec = query
+        if vec is None:
+            raise ValueError("failed to get embedding for query")
+        with self._search_executor_lock:
+            if self._search_executor is None:
+                self._search_executor = ThreadPoolExecutor(max_workers=len(SCOPE_QUERIES), thread_name_prefix="search-all")
+        futures = {scope: self._search_executor.submit(self.query_scope_nearest, scope, vec, top_k, identity, filter_value,
+                                                       **search_kwargs)
+                   for scope in scopes}
+        merged = []
+        for scope, future in futures.items():
+            try:
+                merged.extend(dict(row, scope=scope) for row in future.result())
+            except Exception as e:
+                print(f"search {scope} fail because {e}")
+        if search_kwargs.get("strategy") == "hybrid":
+            merged.sort(key=lambda row: -row["rrf_score"])
+        else:
+            merged.sort(key=lambda row: row["distance"])
+        return merged[:int(top_k)]
            
 if __name__ == "__main__":
-    pg_vector = PGVector(pg_setting)
+    pg_vector = PGVector(pg_setting, pool_setting)
     # create jssdk
     # ret_json = pg_vector.create_jssdk_table(embed_dim=embed_dim)
     # print(ret_json)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import os
+import queue
+import zipfile
+import threading
+from xml.etree import ElementTree
+
+
+# docx (WordprocessingML) 的 namespace
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+'''**
+* 逐頁讀取 PDF, 每次只保留一頁的文字
+* @params: filename - pdf 路徑
+* @return: generator of page text
+*'''
+def iter_pdf_pages(filename:str):
+    from langchain_community.document_loaders import PyPDFLoader
+    # lazy_load 逐頁解析, 不會一次載入整份文件
+    for page in PyPDFLoader(filename).lazy_load():
+        yield page.page_content
+
+
+'''**
+* 以 iterparse 逐段讀取 docx 的 word/document.xml, 每次只保留一個段落
+* 文字規則與 docx2txt 相同: w:tab -> \t, w:br / w:cr -> \n, 段落結尾 -> \n\n (不含頁首頁尾)
+* @params: filename - docx 路徑
+* @return: generator of paragraph text
+*'''
+def iter_docx_paragraphs(filename:str):
+    with zipfile.ZipFile(filename) as docx, docx.open("word/document.xml") as xml:
+        parts = []
+        for event, elem in ElementTree.iterparse(xml, events=("end",)):
+            if elem.tag == W_NS + "t":
+                parts.append(elem.text or "")
+            elif elem.tag == W_NS + "tab":
+                parts.append("\t")
+            elif elem.tag in (W_NS + "br", W_NS + "cr"):
+                parts.append("\n")
+            elif elem.tag == W_NS + "p":
+                parts.append("\n\n")
+                yield "".join(parts)
+                parts = []
+                # 已處理的段落不再保留在 tree 中
+                elem.clear()
+        if parts:
+            yield "".join(parts)
+
+
+def iter_document_pages(filename:str, extension:str):
+    """依副檔名逐頁 (pdf) 或逐段 (docx) 讀取文字"""
+    if extension.lower() == "docx":
+        return iter_docx_paragraphs(filename)
+    return iter_pdf_pages(filename)
+
+
+'''**
+* 逐頁切割: 累積到 flush_size 字元後切割, 輸出除最後一個 chunk 外的所有 chunk
+* 最後一個 chunk 可能被頁尾截斷, 從它的起點保留到下一次切割, 與已輸出的 chunk 仍保有 splitter 的 overlap
+* 記憶體用量約為 flush_size + 一頁, 與文件大小無關
+* @params: pages - iterable of text (頁與頁之間以空白相接); splitter - 有 split_text 的 text splitter
+*          flush_size - 每次切割的字元數 (至少需大於 2 個 chunk)
+* @return: generator of chunk
+*'''
+def iter_chunks(pages, splitter, flush_size:int = 20000):
+    parts, size = [], 0
+    for page in pages:
+        parts.append(page + " ")
+        size += len(page) + 1
+        if size < flush_size:
+            continue
+        buffer = "".join(parts)
+        chunks = splitter.split_text(buffer)
+        if len(chunks) < 2:
+            continue
+        # 最後一個 chunk 為 buffer 的結尾 (splitter 會去除前後空白), 由結尾往回找出它的起點
+        tail = buffer.rstrip()
+        start = tail.rfind(chunks[-1])
+        if start < 0:
+            start = max(0, len(tail) - len(chunks[-1]))
+        yield from chunks[:-1]
+        buffer = buffer[start:]
+        parts, size = [buffer], len(buffer)
+    buffer = "".join(parts)
+    if buffer.strip():
+        yield from splitter.split_text(buffer)
+
+
+'''**
+* 在背景 thread 執行 generator, 最多預先產生 max_ahead 筆
+* 用於讓 PDF 解析與 Embedding 轉換同時進行; generator 的 exception 會在取值時拋出
+* @params: iterable - e.g. iter_chunks(...); max_ahead - queue 大小
+* @return: generator
+*'''
+def prefetch(iterable, max_ahead:int = 512):
+    items = queue.Queue(maxsize=max_ahead)
+    stop = threading.Event()
+    done = object()
+
+    def put(value) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    worker = threading.Thread(target=produce, name="prefetch", daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # consumer 提前結束 (例如寫入失敗) 時停止背景 thread
+        stop.set()
+
+
+'''**
+* 以 token 數計算長度的 RecursiveCharacterTextSplitter, chunk 大小與 embedding 模型的 token 上限一致
+* 長度以 EmbeddingFunction 中快取的 tiktoken encoder 計算
+* @params: chunk_tokens - 每個 chunk 最多 token 數; overlap_tokens - 相鄰 chunk 重疊的 token 數
+*          encoding_name - embedding 模型的 encoding
+* @return: text splitter
+*'''
+def get_token_splitter(chunk_tokens:int, overlap_tokens:int, encoding_name:str = "cl100k_base"):
+    import EmbeddingFunction
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(
+        chunk_size = chunk_tokens,
+        chunk_overlap = overlap_tokens,
+        length_function = lambda text: EmbeddingFunction.num_tokens_from_string_embed(text, encoding_name),
+        is_separator_regex=False
+    )
+
+
+'''**
+* 逐頁讀取並切割 manual 文件 (PDF / DOCX)
+* @params: filename; extension - pdf or docx; chunk_tokens, overlap_tokens - 見 get_token_splitter
+* @return: generator of chunk
+*'''
+def iter_document_chunks(filename:str, extension:str, chunk_tokens:int = 300, overlap_tokens:int = 90):
+    text_splitter = get_token_splitter(chunk_tokens, overlap_tokens)
+    return iter_chunks(iter_document_pages(filename, extension), text_splitter)
+
+
+def chunk_document(filename:str, extension:str, chunk_tokens:int = 300, overlap_tokens:int = 90) -> list[str]:
+    """process pool 使用: 回傳整份文件的 chunks"""
+    return list(iter_document_chunks(filename, extension, chunk_tokens, overlap_tokens))
+
+
+'''**
+* 讀取 spec datasheet 並將表格資訊抽出，組成特定格式的chunk text
+* @params: file_path - 檔案路徑
+* @return: text_and_tables - 檔案特定格式的chunk text
+*'''
+def read_spec_docx(file_path:str) -> str:
+    import docx
+    doc = docx.Document(file_path)
+    parts = ['This is the ' + os.path.splitext(os.path.basename(file_path))[0] + ' Specification datasheet.' + "\n"]
+    
+    # Read paragraphs
+    for para in doc.paragraphs:
+        parts.append(para.text + "\n")
+
+    # Read tables
+    for table in doc.tables:
+        parts.append("Table: \n")
+        for row in table.rows:
+            parts.append("\t".join(cell.text for cell in row.cells) + "\n")
+
+    return "".join(parts)
+
+
+'''**
+* 讀取並切割 spec datasheet: 每個 chunk 盡量接近 embedding 模型的 token 上限 (8191)
+* 多數 datasheet 不超過 chunk_tokens, 整份為一個 chunk; 切割時只 tokenize 一次, 不需先計算整份的 token 數
+* @params: file_path; chunk_tokens, overlap_tokens - 見 get_token_splitter
+* @return: list of chunk
+*'''
+def chunk_spec_docx(file_path:str, chunk_tokens:int = 8000, overlap_tokens:int = 400) -> list[str]:
+    return get_token_splitter(chunk_tokens, overlap_tokens).split_text(read_spec_docx(file_path))
+
+
+'''**
+* 以 process pool 平行解析與切割多個檔案, 依完成順序回傳
+* 1. 同時最多 max_pending 個檔案在處理中 (預設 workers * 2), 記憶體不會隨檔案數增加
+* 2. 單一檔案失敗時回傳錯誤訊息, 不影響其他檔案
+* func 須為本模組等可被 import 的函式 (Windows 以 spawn 啟動 worker, 不會執行 run_*.py 的全域程式)
+* @params: func - e.g. chunk_document, chunk_spec_docx; tasks - iterable of (key, args); workers - process 數
+* @return: generator of (key, result, error)
+*'''
+def parse_in_pool(func, tasks, workers:int, max_pending:int = None):
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    max_pending = max_pending or workers * 2
+    tasks = iter(tasks)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        while True:
+            for key, args in tasks:
+                pending[executor.submit(func, *args)] = key
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                try:
+                    yield key, future.result(), None
+                except Exception as e:
+                    yield key, None, str(e)
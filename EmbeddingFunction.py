@@ -1,13 +1,38 @@
 # -*- coding: utf-8 -*-
 import os
-import tiktoken
-import configparser
-import openai
-from openai import AzureOpenAI, OpenAIError
+import time
+import random
+import sqlite3
+import asyncio
+import hashlib
+import threading
+import unicodedata
+import Metrics
+import ConfigLoader
+from array import array
+from functools import lru_cache
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
 
 
-config=configparser.ConfigParser()
-config.read("Config.ini")
+# openai 與 tiktoken 載入較慢, 在建立 client / encoder 時才 import
+config = ConfigLoader.load_config()
+
+
+'''Tokenizer cache
+* encoder 建立時需載入 BPE 檔案, 每個 encoding / model 只建立一次
+* 計算 token 數使用 encode_ordinary: 文字中的 <|endoftext|> 等特殊字串視為一般文字, 不會拋出錯誤
+**'''
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = "cl100k_base"):
+    import tiktoken
+    return tiktoken.get_encoding(encoding_name)
+
+
+@lru_cache(maxsize=None)
+def get_model_encoding(model_name: str):
+    import tiktoken
+    return tiktoken.encoding_for_model(model_name)
 
 
 '''Token Calculator for LLM
@@ -16,10 +41,7 @@ config.read("Config.ini")
 **'''
 def num_tokens_from_string_llm(text: str, model_name: str = "gpt-4o") -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.encoding_for_model(model_name)
-    tokens = encoding.encode(text)
-    num_tokens = len(tokens)
-    return num_tokens
+    return len(get_model_encoding(model_name).encode_ordinary(text))
 
 
 '''Token Calculator for Embedding
@@ -29,9 +51,18 @@ def num_tokens_from_string_llm(text: str, model_name: str = "gpt-4o") -> int:
 **'''
 def num_tokens_from_string_embed(string: str, encoding_name: str="cl100k_base") -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return len(get_encoding(encoding_name).encode_ordinary(string))
+
+
+'''Token Calculator for many texts
+* tiktoken 在 thread pool 中批次 encode (BPE 在 Rust 中執行, 不受 GIL 限制)
+* @params: texts - list of text; encoding_name - model encoding name; num_threads - thread 數
+* @return: list of number of tokens
+**'''
+def num_tokens_from_strings_embed(texts: list[str], encoding_name: str="cl100k_base", num_threads: int = 8) -> list[int]:
+    if len(texts) < 2:
+        return [num_tokens_from_string_embed(text, encoding_name) for text in texts]
+    return [len(tokens) for tokens in get_encoding(encoding_name).encode_ordinary_batch(list(texts), num_threads=num_threads)]
 
 
 
@@ -45,30 +76,586 @@ chat_model = config['AOAI_DEFAULT']['chat_model']
 embed_model = config['AOAI_DEFAULT']['embed_model']
 embed_dim = config['AOAI_DEFAULT']['embed_dim']
 api_type = config['AOAI_DEFAULT']['api_type']
+# embedding 使用的 endpoint / api key, 未設定時與 endpoint / api_key1 相同 (可指向 run_fake_embed_server.py 等本機服務)
+embed_endpoint = config.get('AOAI_DEFAULT', 'embed_endpoint', fallback=endpoint)
+embed_api_key = config.get('AOAI_DEFAULT', 'embed_api_key', fallback=api_key1)
+# 批次 embedding 上限: 每個 request 的 input 筆數與 token 總數
+embed_batch_size = config.getint('AOAI_DEFAULT', 'embed_batch_size', fallback=256)
+embed_batch_tokens = config.getint('AOAI_DEFAULT', 'embed_batch_tokens', fallback=100000)
+# embedding 限流: requests / tokens per minute (0 代表不限制), 同時送出的 request 數與重試次數
+embed_rpm = config.getint('AOAI_DEFAULT', 'embed_rpm', fallback=0)
+embed_tpm = config.getint('AOAI_DEFAULT', 'embed_tpm', fallback=0)
+embed_concurrency = config.getint('AOAI_DEFAULT', 'embed_concurrency', fallback=8)
+embed_max_retries = config.getint('AOAI_DEFAULT', 'embed_max_retries', fallback=6)
+# two-stage 查詢用的短向量維度 (取 embedding 前 n 維再正規化), 0 代表不使用
+embed_short_dim = config.getint('AOAI_DEFAULT', 'embed_short_dim', fallback=0)
+# 持久化 embedding cache
+embed_cache_enable = config.getboolean('EMBED_CACHE', 'enable', fallback=False)
+embed_cache_path = config.get('EMBED_CACHE', 'path', fallback='./embedding_cache.sqlite')
+embed_cache_max_mb = config.getfloat('EMBED_CACHE', 'max_size_mb', fallback=2048)
+# 查詢 embedding 的 in-process LRU cache
+query_cache_enable = config.getboolean('QUERY_CACHE', 'enable', fallback=False)
+query_cache_maxsize = config.getint('QUERY_CACHE', 'maxsize', fallback=1024)
+query_cache_ttl = config.getfloat('QUERY_CACHE', 'ttl_sec', fallback=3600)
+
+
+
+'''**
+* text-embedding-3 系列支援 dimensions 參數 (Matryoshka), 可直接取得較短的 embedding
+* ada-002 不支援, 送出 dimensions 會回傳 400
+* @params: model - embedding model name; dimension - length of embedding
+* @return: embeddings.create 的額外參數
+*'''
+def dimension_kwargs(model, dimension) -> dict:
+    if dimension and str(model).startswith("text-embedding-3"):
+        return {"dimensions": int(dimension)}
+    return {}
+
+
+'''**
+* 將 embedding 縮短為前 dim 維並重新 L2 正規化, 結果與 API 以 dimensions=dim 取得的向量相同
+* @params: embedding - list of float; dim - 縮短後維度
+* @return: list of float
+*'''
+def shorten_embedding(embedding, dim:int) -> list:
+    head = [float(x) for x in embedding[:int(dim)]]
+    norm = sum(x * x for x in head) ** 0.5
+    return [x / norm for x in head] if norm > 0 else head
+
+
+'''**
+* 記錄一次成功的 embeddings request: input 數與 token 數 (優先使用 response.usage)
+* @params: client - sync / async; num_inputs - input 數; response - embeddings.create 的回傳; num_tokens - 本機計算的 token 數
+*'''
+def record_embed_usage(client:str, num_inputs:int, response, num_tokens:int = 0):
+    usage = getattr(response, "usage", None)
+    Metrics.metrics.inc("embed_requests", client=client, status="ok")
+    Metrics.metrics.inc("embed_inputs", num_inputs, client=client)
+    Metrics.metrics.inc("embed_tokens", getattr(usage, "prompt_tokens", None) or num_tokens, client=client)
+
+
+def error_status(error) -> str:
+    """metrics 的 status label: HTTP status code, 連線錯誤等沒有 status code 時為例外名稱"""
+    return str(getattr(error, "status_code", None) or type(error).__name__)
+
+
+'''**
+* 持久化 embedding cache (SQLite, float32 blob)
+* 1. key = sha256(embed_model, dimension, chunk text), 相同文字不再重複呼叫 API
+* 2. 超過 max_size_mb 時依最後存取時間 (LRU) 刪除至 90%
+* 3. hits / misses 計數, 於每次執行結束時印出
+*'''
+class EmbeddingCache:
+
+    def __init__(self, path=embed_cache_path, max_size_mb=embed_cache_max_mb):
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                key TEXT PRIMARY KEY,
+                vec BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embedding_cache_last_access_idx ON embedding_cache (last_access)")
+        self._size_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embedding_cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, dimension, text) -> str:
+        return hashlib.sha256(f"{model}\x00{int(dimension)}\x00{text}".encode("utf-8")).hexdigest()
+
+    def lookup(self, model, dimension, texts:list[str]) -> list:
+        """回傳與 texts 順序一致的 embedding, 未命中者為 None"""
+        keys = [self.make_key(model, dimension, text) for text in texts]
+        found = {}
+        with self._lock:
+            # SQLite 參數上限 999, 分段查詢
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                for key, vec in self._conn.execute(f"SELECT key, vec FROM embedding_cache WHERE key IN ({placeholders})", part):
+                    found[key] = array("f", vec).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embedding_cache SET last_access = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return [found.get(key) for key in keys]
+
+    def store(self, model, dimension, texts:list[str], embeddings:list):
+        """寫入成功取得的 embedding (None 略過)"""
+        now = time.time()
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            if embedding is None:
+                continue
+            blob = array("f", embedding).tobytes()
+            rows.append((self.make_key(model, dimension, text), blob, len(blob), now))
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO embedding_cache (key, vec, size, last_access) VALUES (?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+            self._size_bytes += sum(row[2] for row in rows)
+            if self._size_bytes > self.max_size_bytes:
+                self._evict_locked()
+
+    def _evict_locked(self):
+        # 重新計算實際大小 (INSERT OR REPLACE 可能覆蓋舊資料), 再刪除最久未使用的資料至 90%
+        self._size_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embedding_cache").fetchone()[0]
+        target = int(self.max_size_bytes * 0.9)
+        if self._size_bytes <= target:
+            return
+        removed = 0
+        cursor = self._conn.execute("SELECT key, size FROM embedding_cache ORDER BY last_access ASC")
+        evict_keys = []
+        for key, size in cursor:
+            if self._size_bytes - removed <= target:
+                break
+            evict_keys.append((key,))
+            removed += size
+        self._conn.execute("BEGIN")
+        self._conn.executemany("DELETE FROM embedding_cache WHERE key = ?", evict_keys)
+        self._conn.execute("COMMIT")
+        self._size_bytes -= removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": entries,
+                "size_mb": round(self._size_bytes / (1024 * 1024), 2)
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def load_embedding_cache():
+    """依 config [EMBED_CACHE] 建立 cache, 未啟用時回傳 None"""
+    if not embed_cache_enable:
+        return None
+    return EmbeddingCache(embed_cache_path, embed_cache_max_mb)
+
+
+
+'''**
+* 查詢 embedding 的 in-process LRU cache
+* 1. key = (embed_model, dimension, 正規化後的 query), 重複的查詢不再呼叫 API
+* 2. 超過 maxsize 時刪除最久未使用者; 超過 ttl_sec 的項目視為過期
+* 3. 未命中時由 AzureOpenAIEmbeddings.get_embedding 取得, 會經過 EmbeddingCache (共用的 on-disk tier)
+*'''
+class QueryEmbeddingCache:
+
+    def __init__(self, maxsize=query_cache_maxsize, ttl=query_cache_ttl):
+        self.maxsize = maxsize
+        # ttl: 秒數, 0 或 None 代表不過期
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def normalize(text:str) -> str:
+        """全形/半形統一 (NFKC), 去除前後空白並合併連續空白"""
+        return " ".join(unicodedata.normalize("NFKC", text).split())
+
+    def get(self, model, dimension, text:str):
+        key = (model, int(dimension), self.normalize(text))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, model, dimension, text:str, embedding):
+        if embedding is None:
+            return
+        key = (model, int(dimension), self.normalize(text))
+        with self._lock:
+            self._entries[key] = (embedding, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "maxsize": self.maxsize
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def load_query_cache():
+    """依 config [QUERY_CACHE] 建立 cache, 未啟用時回傳 None"""
+    if not query_cache_enable:
+        return None
+    return QueryEmbeddingCache(query_cache_maxsize, query_cache_ttl)
 
 
 
 class AzureOpenAIEmbeddings:
     
-    def __init__(self, model=embed_model, dimension=embed_dim):
+    def __init__(self, model=embed_model, dimension=embed_dim, cache=None, query_cache=None,
+                 endpoint=embed_endpoint, api_key=embed_api_key):
         self.model = model
         self.dimension = dimension
-        self.client = AzureOpenAI(
-            api_key=api_key1,
+        # cache: EmbeddingCache, None 代表不使用
+        self.cache = cache
+        # query_cache: QueryEmbeddingCache, 只用於 get_query_embedding
+        self.query_cache = query_cache
+        import openai
+        self.client = openai.AzureOpenAI(
+            api_key=api_key,
             api_version=api_version,
             azure_endpoint=endpoint
         )
 
     def get_embedding(self, text):
+        import openai
+        if self.cache is not None:
+            embedding = self.cache.lookup(self.model, self.dimension, [text])[0]
+            if embedding is not None:
+                return embedding
         try:
-            response = self.client.embeddings.create(input=text, model=self.model)
+            with Metrics.metrics.timer("embed_request", client="sync"):
+                response = self.client.embeddings.create(input=text, model=self.model,
+                                                         **dimension_kwargs(self.model, self.dimension))
+            record_embed_usage("sync", 1, response)
             embedding = response.data[0].embedding
+            if self.cache is not None:
+                self.cache.store(self.model, self.dimension, [text], [embedding])
             return embedding
-        except OpenAIError as e:
+        except openai.OpenAIError as e:
+            Metrics.metrics.inc("embed_requests", client="sync", status=error_status(e))
             print(f"Error getting embedding: {e}")
             return None
 
-    
+    def get_query_embedding(self, query:str):
+        """查詢用 embedding: 以正規化後的 query 轉換, 先查 query_cache"""
+        query = QueryEmbeddingCache.normalize(query)
+        if self.query_cache is not None:
+            embedding = self.query_cache.get(self.model, self.dimension, query)
+            if embedding is not None:
+                return embedding
+        embedding = self.get_embedding(query)
+        if self.query_cache is not None:
+            self.query_cache.put(self.model, self.dimension, query, embedding)
+        return embedding
+
+    '''**
+    * 依筆數與 token 總數將 texts 打包成多個 sub-batch
+    * @params: texts - list of text; max_batch_size - 每批最多筆數; max_batch_tokens - 每批最多 token 數
+    * @return: list of sub-batch, 每個 sub-batch 為 texts 的 index list (空字串不送出)
+    *'''
+    @staticmethod
+    def pack_batches(texts, max_batch_size=embed_batch_size, max_batch_tokens=embed_batch_tokens) -> list[list[int]]:
+        batches = []
+        batch, batch_tokens = [], 0
+        indices = [idx for idx, text in enumerate(texts) if text and text.strip()]
+        token_counts = num_tokens_from_strings_embed([texts[idx] for idx in indices])
+        for idx, num_tokens in zip(indices, token_counts):
+            if batch and (len(batch) >= max_batch_size or batch_tokens + num_tokens > max_batch_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(idx)
+            batch_tokens += num_tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    '''**
+    * 批次轉換 Embedding, 一個 request 送出多筆 input
+    * 1. 依筆數與 token 總數打包成 sub-batch
+    * 2. 只重試失敗的 sub-batch; 若 request 本身不合法 (例如某筆超過 token 上限) 則對半拆開, 找出有問題的 input
+    * @params: texts - list of text; max_retries - 每個 sub-batch 失敗重試次數; retry_interval - 重試間隔秒數
+    * @return: list of embedding, 與 texts 順序一致, 失敗者為 None
+    *'''
+    def get_embeddings(self, texts, max_batch_size=embed_batch_size, max_batch_tokens=embed_batch_tokens,
+                       max_retries=3, retry_interval=10) -> list:
+        if self.cache is None:
+            return self._get_embeddings_uncached(texts, max_batch_size, max_batch_tokens, max_retries, retry_interval)
+        # 先查 cache, 只對未命中的 text 呼叫 API
+        embeddings = self.cache.lookup(self.model, self.dimension, texts)
+        miss_idx = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        miss_texts = [texts[i] for i in miss_idx]
+        miss_embeddings = self._get_embeddings_uncached(miss_texts, max_batch_size, max_batch_tokens, max_retries, retry_interval)
+        self.cache.store(self.model, self.dimension, miss_texts, miss_embeddings)
+        for i, embedding in zip(miss_idx, miss_embeddings):
+            embeddings[i] = embedding
+        return embeddings
+
+    def _get_embeddings_uncached(self, texts, max_batch_size, max_batch_tokens, max_retries, retry_interval) -> list:
+        import openai
+        embeddings = [None] * len(texts)
+        pending = [(batch, 0) for batch in self.pack_batches(texts, max_batch_size, max_batch_tokens)]
+        while pending:
+            batch, attempt = pending.pop(0)
+            try:
+                with Metrics.metrics.timer("embed_request", client="sync"):
+                    response = self.client.embeddings.create(input=[texts[i] for i in batch], model=self.model,
+                                                             **dimension_kwargs(self.model, self.dimension))
+                record_embed_usage("sync", len(batch), response)
+                # response.data 依 index 對應 input 順序
+                for item in response.data:
+                    embeddings[batch[item.index]] = item.embedding
+            except openai.BadRequestError as e:
+                Metrics.metrics.inc("embed_requests", client="sync", status=error_status(e))
+                if len(batch) > 1:
+                    half = len(batch) // 2
+                    pending[:0] = [(batch[:half], attempt), (batch[half:], attempt)]
+                else:
+                    print(f"Error getting embedding for input {batch[0]}: {e}")
+            except openai.OpenAIError as e:
+                Metrics.metrics.inc("embed_requests", client="sync", status=error_status(e))
+                print(f"Error getting embeddings ({len(batch)} inputs, attempt {attempt + 1}/{max_retries}): {e}")
+                if attempt + 1 < max_retries:
+                    Metrics.metrics.inc("embed_retries", client="sync", status=error_status(e))
+                    time.sleep(retry_interval)
+                    pending.insert(0, (batch, attempt + 1))
+        return embeddings
+
+
+'''**
+* asyncio token bucket, 每分鐘補滿 per_minute 個 token
+* per_minute <= 0 代表不限制
+*'''
+class TokenBucket:
+
+    def __init__(self, per_minute:int):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0 # 每秒補充量
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount:int = 1):
+        if self.capacity <= 0:
+            return
+        # 單一 request 超過容量時, 最多等到桶子全滿
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+'''**
+* 非同步 embedding client (AsyncAzureOpenAI)
+* 1. Semaphore 限制同時送出的 request 數
+* 2. 依 requests-per-minute / tokens-per-minute 的 token bucket 控制送出速率
+* 3. 429 / 5xx / 連線錯誤以 jittered exponential backoff 重試, 有 Retry-After 時以其為準
+* 4. 收到 429 時所有 worker 一起暫停, 避免同時撞上限額
+*'''
+class AsyncAzureOpenAIEmbeddings:
+
+    def __init__(self, model=embed_model, dimension=embed_dim, rpm=embed_rpm, tpm=embed_tpm,
+                 max_concurrency=embed_concurrency, max_retries=embed_max_retries,
+                 base_delay=1.0, max_delay=60.0, cache=None, endpoint=embed_endpoint, api_key=embed_api_key):
+        self.model = model
+        self.dimension = dimension
+        self.cache = cache
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # 重試由本 class 處理, 關閉 SDK 內建重試
+        import openai
+        self.client = openai.AsyncAzureOpenAI(
+            api_key=api_key,
+            api_version=api_version,
+            azure_endpoint=endpoint,
+            max_retries=0
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._request_bucket = TokenBucket(rpm)
+        self._token_bucket = TokenBucket(tpm)
+        self._cooldown_until = 0.0
+
+    @staticmethod
+    def get_retry_after(error) -> float | None:
+        """讀取 retry-after-ms / retry-after header, 回傳秒數"""
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        headers = response.headers
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000.0
+            if headers.get("retry-after"):
+                value = headers["retry-after"]
+                try:
+                    return float(value)
+                except ValueError:
+                    retry_at = parsedate_to_datetime(value)
+                    return max(0.0, retry_at.timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+        return None
+
+    @staticmethod
+    def is_retryable(error) -> bool:
+        import openai
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and (error.status_code in (408, 409, 429) or error.status_code >= 500)
+
+    def get_retry_delay(self, error, attempt:int) -> float:
+        retry_after = self.get_retry_after(error)
+        if retry_after is not None:
+            return min(self.max_delay, retry_after) + random.uniform(0, self.base_delay)
+        # full jitter: 0 ~ base * 2^attempt
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def _wait_cooldown(self):
+        delay = self._cooldown_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def aembed_batch(self, texts:list[str]) -> list:
+        """送出單一 request, 可重試錯誤會重試; BadRequestError 直接拋出由呼叫端處理"""
+        import openai
+        num_tokens = sum(num_tokens_from_strings_embed(texts))
+        for attempt in range(self.max_retries + 1):
+            # 等待 429 冷卻, rpm / tpm 限流與併發上限的時間記錄為 embed_throttle
+            wait_start = time.perf_counter()
+            await self._wait_cooldown()
+            await self._request_bucket.acquire(1)
+            await self._token_bucket.acquire(num_tokens)
+            async with self._semaphore:
+                Metrics.metrics.observe("embed_throttle", time.perf_counter() - wait_start, client="async")
+                try:
+                    with Metrics.metrics.timer("embed_request", client="async"):
+                        response = await self.client.embeddings.create(input=texts, model=self.model,
+                                                                       **dimension_kwargs(self.model, self.dimension))
+                    record_embed_usage("async", len(texts), response, num_tokens)
+                    embeddings = [None] * len(texts)
+                    for item in response.data:
+                        embeddings[item.index] = item.embedding
+                    return embeddings
+                except openai.OpenAIError as e:
+                    Metrics.metrics.inc("embed_requests", client="async", status=error_status(e))
+                    if not self.is_retryable(e) or attempt == self.max_retries:
+                        raise
+                    Metrics.metrics.inc("embed_retries", client="async", status=error_status(e))
+                    delay = self.get_retry_delay(e, attempt)
+                    if isinstance(e, openai.RateLimitError) or getattr(e, "status_code", None) == 429:
+                        self._cooldown_until = max(self._cooldown_until, time.monotonic() + delay)
+                    print(f"Retry embedding ({len(texts)} inputs, attempt {attempt + 1}/{self.max_retries}) in {delay:.1f} sec: {e}")
+            await asyncio.sleep(delay)
+
+    async def _aembed_indices(self, texts:list[str], batch:list[int], embeddings:list):
+        import openai
+        try:
+            for idx, embedding in zip(batch, await self.aembed_batch([texts[i] for i in batch])):
+                embeddings[idx] = embedding
+        except openai.BadRequestError as e:
+            # 對半拆開找出不合法的 input, 其餘照常轉換
+            if len(batch) > 1:
+                half = len(batch) // 2
+                await asyncio.gather(self._aembed_indices(texts, batch[:half], embeddings),
+                                     self._aembed_indices(texts, batch[half:], embeddings))
+            else:
+                print(f"Error getting embedding for input {batch[0]}: {e}")
+        except openai.OpenAIError as e:
+            print(f"Error getting embeddings ({len(batch)} inputs): {e}")
+
+    async def aget_embedding(self, text):
+        embeddings = await self.aget_embeddings([text])
+        return embeddings[0]
+
+    async def aget_embeddings(self, texts, max_batch_size=embed_batch_size, max_batch_tokens=embed_batch_tokens) -> list:
+        """所有 sub-batch 併發送出, 回傳與 texts 順序一致, 失敗者為 None"""
+        embeddings = [None] * len(texts)
+        if self.cache is not None:
+            embeddings = self.cache.lookup(self.model, self.dimension, texts)
+        miss_idx = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        miss_texts = [texts[i] for i in miss_idx]
+        miss_embeddings = [None] * len(miss_texts)
+        batches = AzureOpenAIEmbeddings.pack_batches(miss_texts, max_batch_size, max_batch_tokens)
+        await asyncio.gather(*(self._aembed_indices(miss_texts, batch, miss_embeddings) for batch in batches))
+        if self.cache is not None:
+            self.cache.store(self.model, self.dimension, miss_texts, miss_embeddings)
+        for i, embedding in zip(miss_idx, miss_embeddings):
+            embeddings[i] = embedding
+        return embeddings
+
+
+'''**
+* AsyncAzureOpenAIEmbeddings 的同步包裝
+* 與 AzureOpenAIEmbeddings 相同介面 (get_embedding / get_embeddings), 既有 scanner 不需改寫
+* 內部在背景 thread 執行 event loop, client 與限流狀態在多次呼叫間共用
+*'''
+class ConcurrentAzureOpenAIEmbeddings:
+
+    def __init__(self, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="embedding-loop", daemon=True)
+        self._thread.start()
+        self.async_embed = self._run(self._create_client(**kwargs))
+        self.model = self.async_embed.model
+        self.dimension = self.async_embed.dimension
+        self.cache = self.async_embed.cache
+
+    @staticmethod
+    async def _create_client(**kwargs):
+        # 在背景 loop 內建立, asyncio 物件與 http client 都綁定同一個 loop
+        return AsyncAzureOpenAIEmbeddings(**kwargs)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def get_embedding(self, text):
+        return self._run(self.async_embed.aget_embedding(text))
+
+    def get_embeddings(self, texts, max_batch_size=embed_batch_size, max_batch_tokens=embed_batch_tokens) -> list:
+        return self._run(self.async_embed.aget_embeddings(texts, max_batch_size, max_batch_tokens))
+
+    def close(self):
+        self._run(self.async_embed.client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
     
 
 if __name__ == "__main__":
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import Metrics
+
+
+'''**
+* chunk 與檔案內容的 fingerprint
+* @params: text / path
+* @return: sha256 hex string
+*'''
+def chunk_hash(text:str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_hash(path:str, block_size:int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+'''**
+* 增量同步: 每個 table 一份 manifest (source_key, mtime, size, content_hash)
+* 1. check_file / check_content: 來源未改變則略過 (mtime+size 相同時不重新計算 hash)
+* 2. sync_sources: 只轉換新 chunk 的 Embedding, 刪除已不存在的 chunk, 並更新 manifest
+*    sync_source_stream: 同上, chunks 以 iterator 逐批處理 (大型文件)
+* 3. remove_missing: 刪除本次掃描未出現的來源之 chunks
+* 同一個 table 由多個 scanner 寫入時 (例如 manual), 需共用同一個 IngestManifest
+*'''
+class IngestManifest:
+
+    def __init__(self, pg_vector, table_name:str, key_col:str = "source", full_refresh:bool = False):
+        self.pg_vector = pg_vector
+        self.table_name = table_name
+        # table 中代表來源的欄位: jssdk/spec 為 source, manual 為 filename
+        self.key_col = key_col
+        self.pg_vector.create_manifest_table()
+        self.entries = self.pg_vector.get_manifest(table_name)
+        # full_refresh: 忽略 manifest, 所有來源都重新切割比對 (chunk 仍依 hash 比對, 不重複寫入)
+        self.full_refresh = full_refresh
+        self.seen = set()
+        self.skipped_cnt = 0
+
+    def mark_seen(self, source_key:str):
+        """標記來源仍存在 (即使本次處理失敗也不會被 remove_missing 刪除)"""
+        self.seen.add(source_key)
+
+    def _is_unchanged(self, source_key:str, content_hash:str) -> bool:
+        entry = self.entries.get(source_key)
+        return (not self.full_refresh) and entry is not None and entry["content_hash"] == content_hash
+
+    '''**
+    * 檢查檔案是否改變
+    * @params: path - 檔案路徑; source_key - manifest 與 table 中的來源值
+    * @return: (changed, fingerprint)
+    *'''
+    def check_file(self, path:str, source_key:str) -> tuple[bool, dict]:
+        self.seen.add(source_key)
+        stat = os.stat(path)
+        entry = self.entries.get(source_key)
+        if (not self.full_refresh and entry is not None and entry["content_hash"] is not None
+                and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size):
+            self.skipped_cnt += 1
+            return False, entry
+        fingerprint = {"mtime": stat.st_mtime, "size": stat.st_size, "content_hash": file_hash(path)}
+        if self._is_unchanged(source_key, fingerprint["content_hash"]):
+            # 內容相同只是 mtime 改變 (例如 svn checkout), 只更新 manifest
+            self.pg_vector.upsert_manifest(self.table_name, source_key, fingerprint)
+            self.skipped_cnt += 1
+            return False, fingerprint
+        return True, fingerprint
+
+    '''**
+    * 檢查非檔案來源 (例如網頁內容) 是否改變
+    * @params: source_key - 來源值; content - 來源內容
+    *          validators - 網頁的 {"etag", "last_modified"}, 內容未改變但 validator 改變時只更新 manifest
+    * @return: (changed, fingerprint)
+    *'''
+    def check_content(self, source_key:str, content:str, validators:dict = None) -> tuple[bool, dict]:
+        self.seen.add(source_key)
+        fingerprint = {"mtime": None, "size": len(content), "content_hash": chunk_hash(content)}
+        fingerprint.update(validators or {})
+        if self._is_unchanged(source_key, fingerprint["content_hash"]):
+            entry = self.entries[source_key]
+            if any(entry.get(key) != value for key, value in (validators or {}).items()):
+                self.pg_vector.upsert_manifest(self.table_name, source_key, fingerprint)
+            self.skipped_cnt += 1
+            return False, fingerprint
+        return True, fingerprint
+    
+    '''**
+    * 網頁來源的 conditional GET header (If-None-Match / If-Modified-Since)
+    * 上次同步未完成 (content_hash 為空) 或 full_refresh 時不送出, 確保重新抓取
+    * @params: source_key - 來源值
+    * @return: dict of request headers
+    *'''
+    def conditional_headers(self, source_key:str) -> dict:
+        entry = self.entries.get(source_key)
+        if self.full_refresh or entry is None or entry["content_hash"] is None:
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+    
+    def mark_not_modified(self, source_key:str):
+        """來源回傳 304 Not Modified: 略過"""
+        self.seen.add(source_key)
+        self.skipped_cnt += 1
+
+    '''**
+    * 同步多個已改變的來源, 只有新 chunk 需要轉換 Embedding (一次批次呼叫)
+    * 每個來源在各自的 transaction 內替換: 單一來源寫入失敗時記錄於 fail_list 並繼續下一個來源, 已寫入的來源不受影響
+    * Embedding 失敗等尚未寫入任何來源前的錯誤直接 raise
+    * @params: items - list of (source_key, fingerprint, metadata, chunks); embed_func - texts -> list of embedding
+    * @return: (寫入 chunk 數, 刪除 chunk 數, fail_list)
+    *'''
+    def sync_sources(self, items:list[tuple], embed_func) -> tuple[int, int, list]:
+        plans = []
+        new_chunks = []
+        for source_key, fingerprint, metadata, chunks in items:
+            hashes = [chunk_hash(chunk) for chunk in chunks]
+            existing = self.pg_vector.get_chunk_hashes(self.table_name, self.key_col, source_key)
+            new_idx = []
+            for i, h in enumerate(hashes):
+                # 同一來源內重複的 chunk 只轉換一次
+                if h not in existing:
+                    new_idx.append(i)
+                    existing.add(h)
+            plans.append((source_key, fingerprint, metadata, chunks, hashes, new_idx, len(new_chunks)))
+            new_chunks.extend(chunks[i] for i in new_idx)
+
+        embeddings = self._embed(embed_func, new_chunks, sum(len(plan[3]) for plan in plans))
+        inserted_cnt, deleted_cnt, synced_cnt, fail_list = 0, 0, 0, []
+        for source_key, fingerprint, metadata, chunks, hashes, new_idx, offset in plans:
+            col_names = ", ".join(list(metadata.keys()) + ["chunk_context", "chunk_hash", "embedding"])
+            pairs = []
+            failed_cnt = 0
+            for j, i in enumerate(new_idx):
+                embedding = embeddings[offset + j]
+                if embedding is None:
+                    failed_cnt += 1
+                    continue
+                pairs.append(tuple(list(metadata.values()) + [chunks[i], hashes[i], embedding]))
+            fingerprint = dict(fingerprint, chunk_cnt=len(chunks))
+            if failed_cnt:
+                # 有 chunk 轉換失敗時不記錄 content_hash, 下次執行會重試此來源
+                fingerprint["content_hash"] = None
+                fail_list.append((source_key, f"{failed_cnt} chunks failed to embed"))
+            try:
+                with Metrics.metrics.timer("ingest_write", table=self.table_name):
+                    source_inserted_cnt, source_deleted_cnt = self.pg_vector.replace_source_chunks(
+                        self.table_name, self.key_col, source_key, col_names, pairs, hashes, fingerprint)
+            except Exception as e:
+                print(f"write {source_key} fail because {e}")
+                fail_list.append((source_key, f"write fail because {e}"))
+                continue
+            inserted_cnt += source_inserted_cnt
+            deleted_cnt += source_deleted_cnt
+            synced_cnt += 1
+        Metrics.metrics.inc("sources_synced", synced_cnt, table=self.table_name)
+        Metrics.metrics.inc("rows_deleted", deleted_cnt, table=self.table_name)
+        return inserted_cnt, deleted_cnt, fail_list
+
+    def _embed(self, embed_func, texts:list[str], total_cnt:int) -> list:
+        """轉換新 chunk 的 Embedding 並記錄耗時; total_cnt - 本批全部 chunk 數 (含內容未改變而沿用者)"""
+        Metrics.metrics.inc("chunks_unchanged", total_cnt - len(texts), table=self.table_name)
+        if not texts:
+            return []
+        with Metrics.metrics.timer("ingest_embed", table=self.table_name):
+            embeddings = embed_func(texts)
+        Metrics.metrics.inc("chunks_embedded", len(texts), table=self.table_name)
+        Metrics.metrics.inc("chunks_embed_failed", sum(embedding is None for embedding in embeddings), table=self.table_name)
+        return embeddings
+
+    '''**
+    * 同步單一大型來源: chunks 為 iterator (例如 DocumentStream.iter_chunks), 每累積 batch_size 筆即轉換 Embedding 並寫入
+    * 只保留一批 chunk 與 Embedding 在記憶體中; 每批先 COPY 至 UNLOGGED 暫存 table 並立即 commit, Embedding 期間不佔用 transaction
+    * 全部批次完成後才在一個短 transaction 內刪除舊 chunk, 由暫存 table 寫入新 chunk 並更新 manifest; 中途失敗時原資料不變
+    * @params: source_key, fingerprint, metadata - 同 sync_sources; chunks - iterator of chunk; embed_func - texts -> list of embedding
+    *          batch_size - 每批 chunk 數
+    * @return: (寫入 chunk 數, 刪除 chunk 數, fail_list)
+    *'''
+    def sync_source_stream(self, source_key:str, fingerprint:dict, metadata:dict, chunks, embed_func,
+                           batch_size:int = 512) -> tuple[int, int, list]:
+        existing = self.pg_vector.get_chunk_hashes(self.table_name, self.key_col, source_key)
+        col_names = ", ".join(list(metadata.keys()) + ["chunk_context", "chunk_hash", "embedding"])
+        fingerprint = dict(fingerprint)
+        failed = [0]
+
+        def embed_batch(batch:list[str]) -> tuple[list, list]:
+            hashes = [chunk_hash(chunk) for chunk in batch]
+            new_idx = []
+            for i, h in enumerate(hashes):
+                # 同一來源內重複的 chunk 只轉換一次
+                if h not in existing:
+                    new_idx.append(i)
+                    existing.add(h)
+            embeddings = self._embed(embed_func, [batch[i] for i in new_idx], len(batch))
+            pairs = []
+            for i, embedding in zip(new_idx, embeddings):
+                if embedding is None:
+                    failed[0] += 1
+                    continue
+                pairs.append(tuple(list(metadata.values()) + [batch[i], hashes[i], embedding]))
+            return pairs, hashes
+
+        def row_batches():
+            batch = []
+            for chunk in chunks:
+                batch.append(chunk)
+                if len(batch) >= batch_size:
+                    yield embed_batch(batch)
+                    batch = []
+            if batch:
+                yield embed_batch(batch)
+            if failed[0]:
+                # 有 chunk 轉換失敗時不記錄 content_hash, 下次執行會重試此來源
+                fingerprint["content_hash"] = None
+
+        # 串流寫入時 Embedding 轉換在 row_batches 內進行, ingest_write 包含 ingest_embed 的時間
+        with Metrics.metrics.timer("ingest_write", table=self.table_name):
+            inserted_cnt, deleted_cnt = self.pg_vector.replace_source_chunks_stream(self.table_name, self.key_col, source_key,
+                                                                                   col_names, row_batches(), fingerprint)
+        Metrics.metrics.inc("sources_synced", 1, table=self.table_name)
+        Metrics.metrics.inc("rows_deleted", deleted_cnt, table=self.table_name)
+        fail_list = [(source_key, f"{failed[0]} chunks failed to embed")] if failed[0] else []
+        return inserted_cnt, deleted_cnt, fail_list
+
+    def remove_missing(self) -> list[str]:
+        """刪除 manifest 中有、本次掃描沒出現的來源, 回傳被刪除的 source_key"""
+        removed = []
+        # 本次掃描完全沒有來源時多半是路徑錯誤, 不刪除任何資料
+        if not self.seen:
+            return removed
+        for source_key in sorted(set(self.entries) - self.seen):
+            self.pg_vector.delete_source(self.table_name, self.key_col, source_key)
+            removed.append(source_key)
+        return removed
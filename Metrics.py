@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import threading
+import ConfigLoader
+from contextlib import contextmanager
+
+
+config = ConfigLoader.load_config()
+
+# 是否記錄各階段耗時與計數 (只在記憶體內累加, 成本為每次一個 lock)
+metrics_enable = config.getboolean('METRICS', 'enable', fallback=True)
+# scanner 結束時輸出的檔案: 副檔名 .prom 為 Prometheus text format, 其他為 JSON lines (附加一行); 空字串代表不輸出
+metrics_path = config.get('METRICS', 'path', fallback='')
+# 查詢超過 slow_query_ms 時以 EXPLAIN (ANALYZE, BUFFERS) 重新執行並記錄執行計畫 (0: 不記錄)
+# EXPLAIN ANALYZE 會再執行一次查詢, 只在排查效能問題時開啟
+slow_query_ms = config.getfloat('METRICS', 'slow_query_ms', fallback=0.0)
+slow_query_path = config.get('METRICS', 'slow_query_path', fallback='./slow_queries.jsonl')
+# Prometheus histogram 的 bucket 上限 (秒)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+'''**
+* 各階段耗時 (timer) 與計數 (counter) 的 registry, thread-safe
+* 1. timer: 依 (stage, labels) 累計次數, 總秒數, 最大值與 histogram bucket
+* 2. counter: 依 (name, labels) 累加, e.g. embed_tokens, rows_written, embed_retries
+* 3. 輸出為 Prometheus text format (to_prometheus) 或 JSON lines (write_jsonl)
+* enable 為 False 時 observe / inc 不做任何事
+*'''
+class MetricsRegistry:
+
+    def __init__(self, enable:bool = metrics_enable, buckets:tuple = DEFAULT_BUCKETS, prefix:str = "retrieval"):
+        self.enable = enable
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            # (stage, labels) -> [count, sum_sec, max_sec, bucket_counts]
+            self._timers = {}
+            # (name, labels) -> value
+            self._counters = {}
+
+    @staticmethod
+    def _key(name:str, labels:dict) -> tuple:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, stage:str, seconds:float, **labels):
+        """記錄一次 stage 的耗時 (秒)"""
+        if not self.enable:
+            return
+        key = self._key(stage, labels)
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                timer = self._timers[key] = [0, 0.0, 0.0, [0] * len(self.buckets)]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    timer[3][i] += 1
+                    break
+
+    @contextmanager
+    def timer(self, stage:str, **labels):
+        """with metrics.timer("sql_execute", op="search"): ... 記錄區塊耗時 (例外時也記錄)"""
+        if not self.enable:
+            yield
+            return
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time, **labels)
+
+    def inc(self, name:str, value = 1, **labels):
+        """counter 累加 value"""
+        if not self.enable or not value:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    '''**
+    * 目前累計值
+    * @return: dict(started_at, timers: list of dict(stage, labels, count, sum_sec, avg_ms, max_ms, buckets),
+    *               counters: list of dict(name, labels, value))
+    *'''
+    def snapshot(self) -> dict:
+        with self._lock:
+            timers = [(key, list(timer[:3]) + [list(timer[3])]) for key, timer in sorted(self._timers.items())]
+            counters = sorted(self._counters.items())
+        return {
+            "started_at": self.started_at,
+            "timers": [{
+                "stage": stage,
+                "labels": dict(labels),
+                "count": count,
+                "sum_sec": total,
+                "avg_ms": total / count * 1000.0 if count else 0.0,
+                "max_ms": max_sec * 1000.0,
+                "buckets": {f"{bound:g}": cnt for bound, cnt in zip(self.buckets, bucket_counts)}
+            } for (stage, labels), (count, total, max_sec, bucket_counts) in timers],
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in counters]
+        }
+
+    @staticmethod
+    def _format_labels(labels, extra:tuple = ()) -> str:
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escape = lambda value: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in pairs) + "}"
+
+    '''**
+    * Prometheus text exposition format
+    * timer 輸出為 histogram {prefix}_stage_seconds{stage=...}, counter 輸出為 {prefix}_{name}_total
+    *'''
+    def to_prometheus(self) -> str:
+        with self._lock:
+            timers = sorted((key, list(timer[:3]) + [list(timer[3])]) for key, timer in self._timers.items())
+            counters = sorted(self._counters.items())
+        metric = f"{self.prefix}_stage_seconds"
+        lines = [f"# HELP {metric} Time spent in each search / ingestion stage.", f"# TYPE {metric} histogram"]
+        for (stage, labels), (count, total, _, bucket_counts) in timers:
+            labels = (("stage", stage),) + labels
+            cumulative = 0
+            for bound, cnt in zip(self.buckets, bucket_counts):
+                cumulative += cnt
+                lines.append(f"{metric}_bucket{self._format_labels(labels, (('le', f'{bound:g}'),))} {cumulative}")
+            lines.append(f"{metric}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{metric}_sum{self._format_labels(labels)} {total:.6f}")
+            lines.append(f"{metric}_count{self._format_labels(labels)} {count}")
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f"{self.prefix}_{name}_total"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{metric}{self._format_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def write_jsonl(self, path:str, **extra):
+        """附加一行 JSON (ts, extra 欄位與 snapshot), 適合每次執行 scanner 後累積"""
+        record = dict({"ts": time.time()}, **extra, **self.snapshot())
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def write_prometheus(self, path:str):
+        """寫入 .prom 檔, 可由 node_exporter 的 textfile collector 讀取 (先寫暫存檔再 rename)"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def export(self, path:str = None, **extra) -> str:
+        """依副檔名輸出為 Prometheus text 或 JSON lines; path 為 None 時使用設定檔的 [METRICS] path"""
+        path = metrics_path if path is None else path
+        if not path or not self.enable:
+            return ""
+        if path.endswith(".prom"):
+            self.write_prometheus(path)
+        else:
+            self.write_jsonl(path, **extra)
+        return path
+
+    def summary(self) -> str:
+        """各 stage 的次數與平均 / 最大耗時, 以及 counter, 供 scanner 結束時印出"""
+        snapshot = self.snapshot()
+        lines = []
+        for timer in snapshot["timers"]:
+            labels = ",".join(f"{key}={value}" for key, value in timer["labels"].items())
+            name = f"{timer['stage']}[{labels}]" if labels else timer["stage"]
+            lines.append(f"    {name:<40} n={timer['count']:<8} total {timer['sum_sec']:.2f}s  "
+                         f"avg {timer['avg_ms']:.1f}ms  max {timer['max_ms']:.1f}ms")
+        for counter in snapshot["counters"]:
+            labels = ",".join(f"{key}={value}" for key, value in counter["labels"].items())
+            name = f"{counter['name']}[{labels}]" if labels else counter["name"]
+            lines.append(f"    {name:<40} {counter['value']:g}")
+        return "\n".join(lines)
+
+
+_slow_query_lock = threading.Lock()
+
+
+'''**
+* 慢查詢的執行計畫記錄 (JSON lines)
+* @params: record - dict(sql, elapsed_ms, search_setting, plan, ...); path - None 代表 slow_query_path
+*'''
+def log_slow_query(record:dict, path:str = None):
+    record = dict({"ts": time.time()}, **record)
+    with _slow_query_lock:
+        with open(path or slow_query_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+
+# process 內共用的 registry
+metrics = MetricsRegistry()
+
+
+def report(title:str = "metrics", **extra):
+    """scanner 結束時呼叫: 印出 summary, 有設定 [METRICS] path 時一併輸出"""
+    text = metrics.summary()
+    if text:
+        print(f"{title}:\n{text}")
+    path = metrics.export(**extra)
+    if path:
+        print(f"metrics saved to {path}")
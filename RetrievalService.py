@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import time
+import asyncio
+import Metrics
+import ConfigLoader
+import EmbeddingFunction
+from concurrent.futures import ThreadPoolExecutor
+
+
+config = ConfigLoader.load_config()
+
+## retrieval server setting
+server_host = config.get('RETRIEVAL_SERVER', 'host', fallback='127.0.0.1')
+server_port = config.getint('RETRIEVAL_SERVER', 'port', fallback=8600)
+# 在 batch_wait_ms 內抵達的查詢合併成一個 embedding request, 每批最多 max_batch 筆
+batch_wait_ms = config.getfloat('RETRIEVAL_SERVER', 'batch_wait_ms', fallback=5)
+batch_max_size = config.getint('RETRIEVAL_SERVER', 'max_batch', fallback=64)
+
+segment = "===================================================================="
+SCOPES = ("jssdk", "spec", "manual", "benchmark", "all")
+
+
+'''**
+* 查詢單一 scope, scope 為 all 時查詢所有 scope 並合併排序 (PGVector.search_all)
+* @params: pg_vector - PGVector; scope - jssdk / spec / manual / benchmark / all; vec - query embedding
+*          identity - benchmark 使用: customer or distributor
+*          search_kwargs - ef_search, probes, strategy, overfetch, filter_value, query_text (hybrid 使用)
+* @return: list of dict
+*'''
+def search_scope(pg_vector, scope:str, vec, top_k:int = 10, identity:str = "customer", **search_kwargs) -> list[dict]:
+    if scope == "all":
+        return pg_vector.search_all(vec, top_k=top_k, identity=identity, **search_kwargs)
+    return pg_vector.query_scope_nearest(scope, vec, top_k, identity, **search_kwargs)
+
+
+'''**
+* 組合 Working Context (LLM 使用)
+* @params: scope; results - search_scope 的結果 (scope 為 all 時依每筆的 scope 欄位組合)
+* @return: working context string
+*'''
+def format_working_context(scope:str, results:list[dict]) -> str:
+    return "\n".join([format_result(res.get("scope", scope), res) for res in results])
+
+
+def format_result(scope:str, res:dict) -> str:
+    if scope == "spec":
+        return segment + "\n" + "HMI model: " + res['model'] + "\n"+ res['chunk_context']
+    if scope == "manual":
+        return segment + "\n" + "Source: " + res['source'] + "\n"+ "Document Content: \n" + res['chunk_context']
+    return segment + "\n" + res['chunk_context']
+
+
+'''**
+* 合併短時間內同時抵達的查詢, 以一個 multi-input request 轉換 embedding
+* 1. 第一筆查詢抵達後等待 max_wait_ms, 或累積到 max_batch 筆時立即送出
+* 2. 相同查詢在送出前後都只送出一次; 先查 QueryEmbeddingCache, 命中者不進入批次
+* 須在 event loop 內使用 (embed 為 coroutine)
+*'''
+class MicroBatchEmbedder:
+
+    def __init__(self, async_embed, query_cache=None, max_wait_ms=batch_wait_ms, max_batch=batch_max_size):
+        # async_embed: EmbeddingFunction.AsyncAzureOpenAIEmbeddings
+        self.async_embed = async_embed
+        self.query_cache = query_cache
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch = max_batch
+        self._pending = []
+        # 等待中或送出中的查詢: query -> future, 相同查詢共用同一個 future
+        self._inflight = {}
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.batched_queries = 0
+        self.coalesced = 0
+
+    async def embed(self, query:str):
+        query = EmbeddingFunction.QueryEmbeddingCache.normalize(query)
+        if self.query_cache is not None:
+            embedding = self.query_cache.get(self.async_embed.model, self.async_embed.dimension, query)
+            if embedding is not None:
+                return embedding
+        future = self._inflight.get(query)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._inflight[query] = future
+            self._pending.append(query)
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.max_wait, self._flush)
+        # shield: 單一 client 斷線不影響共用此 future 的其他查詢
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._embed_batch(batch))
+            # 保留 task 參照, 避免執行中被回收
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _embed_batch(self, batch:list[str]):
+        self.batches += 1
+        self.batched_queries += len(batch)
+        try:
+            embeddings = await self.async_embed.aget_embeddings(batch)
+        except Exception as e:
+            for query in batch:
+                self._inflight.pop(query).set_exception(e)
+            return
+        for query, embedding in zip(batch, embeddings):
+            future = self._inflight.pop(query)
+            if embedding is None:
+                future.set_exception(RuntimeError(f"failed to get embedding for query: {query}"))
+                continue
+            if self.query_cache is not None:
+                self.query_cache.put(self.async_embed.model, self.async_embed.dimension, query, embedding)
+            future.set_result(embedding)
+
+    def stats(self) -> dict:
+        return {
+            "embed_requests": self.batches,
+            "batched_queries": self.batched_queries,
+            "coalesced_queries": self.coalesced,
+            "avg_batch_size": self.batched_queries / self.batches if self.batches else 0.0
+        }
+
+
+'''**
+* 常駐的 retrieval service: PGVector 與 embedding client 只建立一次
+* 1. 查詢 embedding 經 MicroBatchEmbedder 合併送出
+* 2. 向量查詢在 thread pool 執行, 每個 thread 自 PGVector 的 connection pool 借用連線
+* @params: pg_vector - PGVector; async_embed - AsyncAzureOpenAIEmbeddings; query_cache - QueryEmbeddingCache
+*          max_workers - 同時執行的向量查詢數 (建議與 POSTGRES_POOL maxconn 相同)
+*'''
+class RetrievalService:
+
+    def __init__(self, pg_vector, async_embed, query_cache=None, max_wait_ms=batch_wait_ms,
+                 max_batch=batch_max_size, max_workers=10):
+        self.pg_vector = pg_vector
+        self.embedder = MicroBatchEmbedder(async_embed, query_cache, max_wait_ms, max_batch)
+        self.query_cache = query_cache
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="retrieval")
+
+    '''**
+    * 查詢並組合 Working Context, 輸出與 run_inference.py 相同
+    * @return: dict(scope, query, results, working_context, embed_sec, search_sec)
+    *'''
+    async def search(self, scope:str, query:str, top_k:int = 10, identity:str = "customer", **search_kwargs) -> dict:
+        if scope not in SCOPES:
+            raise ValueError(f"unsupported scope: {scope}")
+        start_time = time.time()
+        query_embedding = await self.embedder.embed(query)
+        embed_time = time.time()
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(
+            self.executor, lambda: search_scope(self.pg_vector, scope, query_embedding, top_k, identity,
+                                                query_text=query, **search_kwargs))
+        end_time = time.time()
+        Metrics.metrics.observe("query_embed", embed_time - start_time, scope=scope)
+        Metrics.metrics.observe("query_search", end_time - embed_time, scope=scope)
+        return {
+            "scope": scope,
+            "query": query,
+            "results": results,
+            "working_context": format_working_context(scope, results),
+            "embed_sec": embed_time - start_time,
+            "search_sec": end_time - embed_time
+        }
+
+    def stats(self) -> dict:
+        stats = {"embedder": self.embedder.stats(), "pool": self.pg_vector.pool_stats()}
+        if self.query_cache is not None:
+            stats["query_cache"] = self.query_cache.stats()
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pg_vector.close()
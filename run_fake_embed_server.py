@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import base64
+import random
+import asyncio
+import hashlib
+import argparse
+import numpy as np
+
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                429: "Too Many Requests", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+'''**
+* 本機的 embedding 服務替身, 與 Azure OpenAI / OpenAI embeddings API 相同格式 (僅供 benchmark 與測試使用)
+* POST .../embeddings  body: {"input": str | list[str], "model": "...", "dimensions": null, "encoding_format": "float" | "base64"}
+*                     Azure: /openai/deployments/{deployment}/embeddings?api-version=..., OpenAI: /v1/embeddings
+* GET  /stats   回傳 request 數, input 數, token 數 (估算) 與各 status code 次數
+* POST /reset   清除統計
+* GET  /health  回傳 {"status": "ok"}
+* 1. 相同文字永遠回傳相同向量 (依 sha256(text) 產生 full_dim 維單位向量; 指定 dimensions 時取前 n 維再正規化)
+* 2. 每個 request 延遲 latency_ms + per_input_ms * input 數 (加上 +-jitter 比例)
+* 3. 依 error_429 / error_5xx 的比例回傳錯誤, 429 帶 retry-after header
+* 4. input 數超過 max_inputs, 空字串或超過 max_input_tokens 時回傳 400 (與 Azure 相同)
+*'''
+class FakeEmbeddingServer:
+
+    def __init__(self, full_dim:int = 3072, latency_ms:float = 50, per_input_ms:float = 0.2, jitter:float = 0.2,
+                 error_429:float = 0.0, error_5xx:float = 0.0, retry_after:float = 1.0, max_inputs:int = 2048,
+                 max_input_tokens:int = 8191, seed:int = 0):
+        self.full_dim = full_dim
+        self.latency_ms = latency_ms
+        self.per_input_ms = per_input_ms
+        self.jitter = jitter
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.retry_after = retry_after
+        self.max_inputs = max_inputs
+        self.max_input_tokens = max_input_tokens
+        self.random = random.Random(seed)
+        self.reset()
+
+    def reset(self):
+        self.started_at = time.time()
+        self.requests = 0
+        self.inputs = 0
+        self.tokens = 0
+        self.status_counts = {}
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "inputs": self.inputs,
+            "tokens": self.tokens,
+            "status": {str(status): count for status, count in sorted(self.status_counts.items())},
+            "uptime_sec": time.time() - self.started_at
+        }
+
+    @staticmethod
+    def count_tokens(text:str) -> int:
+        """估算 token 數 (約 4 字元一個 token), 不需載入 tiktoken"""
+        return max(1, len(text) // 4)
+
+    def embed(self, text:str, dimensions:int = None) -> np.ndarray:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vec = np.random.default_rng(seed).standard_normal(self.full_dim).astype(np.float32)
+        # 與 text-embedding-3 的 dimensions 參數相同: 取前 n 維再正規化
+        vec = vec[:dimensions] if dimensions else vec
+        return vec / np.linalg.norm(vec)
+
+    def error_response(self, status:int, message:str, code:str) -> tuple[int, dict, dict]:
+        headers = {"retry-after": f"{self.retry_after:g}"} if status == 429 else {}
+        return status, headers, {"error": {"code": code, "message": message}}
+
+    async def create_embeddings(self, request:dict) -> tuple[int, dict, dict]:
+        texts = request.get("input")
+        texts = [texts] if isinstance(texts, str) else texts
+        if not isinstance(texts, list) or not texts:
+            return self.error_response(400, "'input' is a required property", "invalid_request")
+        if len(texts) > self.max_inputs:
+            return self.error_response(400, f"Too many inputs. The max number of inputs is {self.max_inputs}.",
+                                       "invalid_request")
+        texts = [text if isinstance(text, str) else " ".join(map(str, text)) for text in texts]
+        tokens = [self.count_tokens(text) for text in texts]
+        if any(not text for text in texts):
+            return self.error_response(400, "'$.input' is invalid. Please check the API reference.", "invalid_request")
+        if max(tokens) > self.max_input_tokens:
+            return self.error_response(400, f"This model's maximum context length is {self.max_input_tokens} tokens.",
+                                       "context_length_exceeded")
+
+        delay = (self.latency_ms + self.per_input_ms * len(texts)) / 1000.0
+        await asyncio.sleep(max(0.0, delay * (1 + self.random.uniform(-self.jitter, self.jitter))))
+        draw = self.random.random()
+        if draw < self.error_429:
+            return self.error_response(429, "Requests to the Embeddings_Create Operation have exceeded call rate limit.",
+                                       "429")
+        if draw < self.error_429 + self.error_5xx:
+            return self.error_response(self.random.choice((500, 503)), "The server had an error while processing your request.",
+                                       "server_error")
+
+        dimensions = request.get("dimensions")
+        use_base64 = request.get("encoding_format") == "base64"
+        data = []
+        for idx, text in enumerate(texts):
+            vec = self.embed(text, dimensions)
+            embedding = base64.b64encode(vec.astype("<f4").tobytes()).decode("ascii") if use_base64 else vec.tolist()
+            data.append({"object": "embedding", "index": idx, "embedding": embedding})
+        self.inputs += len(texts)
+        self.tokens += sum(tokens)
+        return 200, {}, {"object": "list", "data": data, "model": request.get("model", "fake-embedding"),
+                         "usage": {"prompt_tokens": sum(tokens), "total_tokens": sum(tokens)}}
+
+    async def route(self, method:str, path:str, body:bytes) -> tuple[int, dict, dict]:
+        if path == "/health":
+            return 200, {}, {"status": "ok"}
+        if path == "/stats":
+            return 200, {}, self.stats()
+        if path == "/reset" and method == "POST":
+            self.reset()
+            return 200, {}, {"status": "ok"}
+        if not path.endswith("/embeddings"):
+            return 404, {}, {"error": {"code": "404", "message": f"unknown path: {path}"}}
+        if method != "POST":
+            return 405, {}, {"error": {"code": "405", "message": "use POST"}}
+        self.requests += 1
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError as e:
+            return self.error_response(400, f"invalid json: {e}", "invalid_request")
+        return await self.create_embeddings(request)
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        # 支援 keep-alive: 同一條連線可送出多個 request (http client 的 connection pool 會重複使用連線)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path = request_line.decode("latin-1").split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+                try:
+                    status, extra_headers, payload = await self.route(method.upper(), path.split("?")[0], body)
+                except Exception as e:
+                    print(f"request fail because {e}")
+                    status, extra_headers, payload = 500, {}, {"error": {"code": "500", "message": str(e)}}
+                if path.split("?")[0].endswith("/embeddings"):
+                    self.status_counts[status] = self.status_counts.get(status, 0) + 1
+                keep_alive = headers.get("connection", "").lower() != "close"
+                data = json.dumps(payload).encode("utf-8")
+                head = [f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}",
+                        "Content-Type: application/json",
+                        f"Content-Length: {len(data)}",
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+                head += [f"{name}: {value}" for name, value in extra_headers.items()]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host:str, port:int, fake_server:FakeEmbeddingServer):
+    server = await asyncio.start_server(fake_server.handle, host, port)
+    print(f"fake embedding server listening on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Azure OpenAI embeddings server (benchmark / test only)')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='listen host')
+    parser.add_argument('-p', '--port', type=int, default=8700, help='listen port')
+    parser.add_argument('--full_dim', type=int, default=3072, help='未指定 dimensions 時回傳的向量維度')
+    parser.add_argument('--latency_ms', type=float, default=50, help='每個 request 的基本延遲 (ms)')
+    parser.add_argument('--per_input_ms', type=float, default=0.2, help='每個 input 增加的延遲 (ms)')
+    parser.add_argument('--jitter', type=float, default=0.2, help='延遲的隨機變動比例')
+    parser.add_argument('--error_429', type=float, default=0.0, help='回傳 429 的比例 (0 ~ 1)')
+    parser.add_argument('--error_5xx', type=float, default=0.0, help='回傳 500 / 503 的比例 (0 ~ 1)')
+    parser.add_argument('--retry_after', type=float, default=1.0, help='429 的 retry-after 秒數')
+    parser.add_argument('--max_inputs', type=int, default=2048, help='每個 request 最多 input 數')
+    parser.add_argument('--seed', type=int, default=0, help='延遲與錯誤注入的 random seed')
+    args = parser.parse_args()
+
+    fake_server = FakeEmbeddingServer(args.full_dim, args.latency_ms, args.per_input_ms, args.jitter, args.error_429,
+                                      args.error_5xx, args.retry_after, args.max_inputs, seed=args.seed)
+    try:
+        asyncio.run(serve(args.host, args.port, fake_server))
+    except KeyboardInterrupt:
+        print("\nserver stopped")
@@ -1,121 +1,153 @@
 # -*- coding: utf-8 -*-
 import time
+import json
 import argparse
-import DatabaseProcess
-import EmbeddingFunction
+import urllib.request
+import urllib.error
+
+
+'''**
+* 送出查詢至 run_server.py 啟動的 retrieval server
+* @params: server - e.g. http://127.0.0.1:8600; payload - /search request body
+* @return: response dict (working_context, results, ...)
+* server 未啟動或無法連線時 raise ConnectionError
+*'''
+def search_on_server(server:str, payload:dict, timeout:float = 60) -> dict:
+    request = urllib.request.Request(server.rstrip("/") + "/search",
+                                     data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        # server 回傳的錯誤訊息
+        raise RuntimeError(json.loads(e.read().decode("utf-8")).get("error", str(e)))
+    except (urllib.error.URLError, OSError) as e:
+        # 連線被拒, DNS 錯誤, timeout 等
+        raise ConnectionError(f"server not reachable at {server}: {getattr(e, 'reason', e)}")
+
+
+'''**
+* 解析 -f 參數: "value" 套用在查詢的 scope 的 metadata 欄位, "scope=value" 只套用在該 scope (-a 時使用)
+* 同一 scope 指定多個值時為 list (= ANY)
+* @params: filters - -f 的值 (list of str), None 代表不過濾
+* @return: None, 單一值 / list, 或 dict scope -> 值 / list
+*'''
+def parse_filters(filters:list[str]):
+    if not filters:
+        return None
+    scoped = [item for item in filters if "=" in item]
+    if scoped and len(scoped) != len(filters):
+        raise ValueError("use either -f value or -f scope=value, not both")
+    if not scoped:
+        return filters[0] if len(filters) == 1 else filters
+    values = {}
+    for item in scoped:
+        scope, value = item.split("=", 1)
+        values.setdefault(scope.strip(), []).append(value)
+    return {scope: value[0] if len(value) == 1 else value for scope, value in values.items()}
 
 
 
 if __name__ == '__main__':
-    
+
     parser = argparse.ArgumentParser(description='Inference for chroma')
     parser.add_argument('-j','--js',type=str, help='jssdk inference, 請輸入query')
     parser.add_argument('-s','--spec', type=str, help='spec inference, 請輸入query')
     parser.add_argument('-m','--manual', type=str, help='manual inference, 請輸入query')
     parser.add_argument('-b','--benchmark', type=str, help='benchmark inference, 請輸入query')
+    parser.add_argument('-a','--all', type=str, help='同時查詢 jssdk, spec, manual, benchmark 並合併排序, 請輸入query')
     parser.add_argument('-i','--identity', type=str, help='benchmark identity: customer or distributor or empty str')
+    parser.add_argument('--ef_search', type=int, default=None, help='HNSW 查詢參數 hnsw.ef_search, 越大 recall 越高')
+    parser.add_argument('--probes', type=int, default=None, help='IVFFlat 查詢參數 ivfflat.probes, 越大 recall 越高')
+    parser.add_argument('--strategy', type=str, default=None, choices=["ann", "exact", "two_stage", "binary", "hybrid"],
+                        help='ann: 索引查詢; exact: 完整精度比對; two_stage / binary: 短向量 / binary quantization ANN 後以完整向量 rerank; '
+                             'hybrid: 向量與全文檢索以 reciprocal rank fusion 合併')
+    parser.add_argument('--overfetch', type=int, default=None, help='two_stage / binary 第一階段取出 top_k * overfetch 筆')
+    parser.add_argument('-f', '--filter', type=str, action='append', default=None,
+                        help='metadata 過濾: jssdk/manual 為 class_name, spec 為 model; 可重複指定, -a 時使用 scope=value (e.g. -f spec=MT8071iE)')
+    parser.add_argument('--server', type=str, default=None, help='retrieval server 位置, e.g. http://127.0.0.1:8600 (不指定則在本機查詢)')
+    parser.add_argument('--stages', action='store_true', help='本機查詢時印出各階段耗時 (embedding, 取得連線, SQL 執行, fetch, 組合結果)')
     args = parser.parse_args()
-    
-    # init working context and agent object
-    working_context = ""
-    segment = "===================================================================="
-    
-    # init db and embed func
-    pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting)
-    az_embed = EmbeddingFunction.AzureOpenAIEmbeddings()
-    
-    
+
+    try:
+        filter_value = parse_filters(args.filter)
+    except ValueError as e:
+        print(e)
+        exit()
+    # 查詢參數 (未指定者使用預設值)
+    search_kwargs = {name: value for name, value in dict(ef_search=args.ef_search, probes=args.probes,
+                                                         strategy=args.strategy, overfetch=args.overfetch,
+                                                         filter_value=filter_value).items()
+                     if value is not None}
+
+    '''**
+    * 要查詢的 scope: (scope, 顯示名稱, query)
+    * benchmark 需同時指定 identity: customer or distributor
+    *'''
+    scope_queries = []
     if args.js:
-        '''**
-        * js object demo
-        * 1. convert text to embedding
-        * 2. 組合並獲取 Working Context 
-        *'''
-        # query = "How to use mouse event in JS Object?"
-        query = args.js
-        if query.strip() == "":
-            print("query is empty")
-            exit()
-        # conver query into embedding
-        time_period_js_start_time = time.time()
-        query_embedding = az_embed.get_embedding(query)
-        # vector search
-        results = pg_vector.query_jssdk_nearest(vec=query_embedding, top_k=10)
-        time_period_js_end_time = time.time()
-        # working context for LLM later
-        working_context = "\n".join([segment + "\n" + res['chunk_context'] for res in results])
-        print(working_context)
-        print(f"\njs vector search time: {time_period_js_end_time - time_period_js_start_time} sec")
-    
+        scope_queries.append(("jssdk", "js", args.js))
     if args.spec:
-        '''**
-        * spec object demo
-        * 1. convert text to embedding
-        * 2. 組合並獲取 Working Context
-        *'''
-        query = args.spec
-        if query.strip() == "":
-            print("query is empty")
-            exit()
-        # conver query into embedding
-        time_period_spec_start_time = time.time()
-        query_embedding = az_embed.get_embedding(query)
-        # vector search
-        results = pg_vector.query_spec_nearest(vec=query_embedding, top_k=10)
-        time_period_spec_end_time = time.time()
-        # working context for LLM later
-        working_context = "\n".join([segment + "\n" + "HMI model: " + res['model'] + "\n"+ res['chunk_context'] for res in results])
-        print(working_context)
-        print(f"\nspec vector search time: {time_period_spec_end_time - time_period_spec_start_time} sec")
-        
-    
+        scope_queries.append(("spec", "spec", args.spec))
     if args.manual:
-        '''**
-        * manual object demo
-        * 1. convert text to embedding
-        * 2. 組合並獲取 Working Context
-        *'''
-        query = args.manual
-        if query.strip() == "":
-            print("query is empty")
-            exit()
-        # conver query into embedding
-        time_period_manual_start_time = time.time()
-        query_embedding = az_embed.get_embedding(query)
-        # vector search
-        results = pg_vector.query_manual_nearest(vec=query_embedding, top_k=10)
-        time_period_manual_end_time = time.time()
-        # working context for LLM later
-        working_context = "\n".join([segment + "\n" + "Source: " + res['source'] + "\n"+ "Document Content: \n" + res['chunk_context'] for res in results])
-        print(working_context)
-        print(f"\nmanual vector search time: {time_period_manual_end_time - time_period_manual_start_time} sec")
-    
-    
+        scope_queries.append(("manual", "manual", args.manual))
+    identity = "customer"
     if args.benchmark and args.identity:
+        scope_queries.append(("benchmark", "benchmark", args.benchmark))
+    if args.all:
+        # 只轉換一次 embedding, 各 table 併發查詢
+        scope_queries.append(("all", "all", args.all))
+    if args.identity is not None:
+        identity = args.identity.strip()
+        if identity not in ["customer","distributor"]:
+            print("identity is not one of customer or distributor, use customer as default")
+            identity = "customer"
+
+    if args.server is None:
+        # 本機查詢: 只有此模式需要載入 db 與 embedding client
+        import Metrics
+        import DatabaseProcess
+        import EmbeddingFunction
+        import RetrievalService
+        pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting, DatabaseProcess.pool_setting)
+        az_embed = EmbeddingFunction.AzureOpenAIEmbeddings(cache=EmbeddingFunction.load_embedding_cache(),
+                                                           query_cache=EmbeddingFunction.load_query_cache())
+
+    for scope, label, query in scope_queries:
         '''**
-        * benchmark object demo
         * 1. convert text to embedding
         * 2. 組合並獲取 Working Context
         *'''
-        query = args.benchmark
         if query.strip() == "":
             print("query is empty")
             exit()
-        
-        identity = args.identity
-        if identity.strip() not in ["customer","distributor"]:
-            print("identity is not one of customer or distributor, use customer as default")
-            identity = "customer"
-            
-        # conver query into embedding
-        time_period_benchmark_start_time = time.time()
-        query_embedding = az_embed.get_embedding(query)
-        # vector search
-        results = pg_vector.query_benchmark_nearest_by_identity(vec=query_embedding, 
-                                                                identity=identity, 
-                                                                top_k=10)
-        time_period_benchmark_end_time = time.time()
-        # working context for LLM later
-        working_context = "\n".join([segment + "\n" + res['chunk_context'] for res in results])
+        time_period_start_time = time.time()
+        try:
+            if args.server:
+                response = search_on_server(args.server, dict(scope=scope, query=query, top_k=10, identity=identity, **search_kwargs))
+                working_context = response["working_context"]
+            else:
+                # conver query into embedding
+                with Metrics.metrics.timer("query_embed", scope=scope):
+                    query_embedding = az_embed.get_query_embedding(query)
+                # vector search
+                results = RetrievalService.search_scope(pg_vector, scope, query_embedding, 10, identity,
+                                                        query_text=query, **search_kwargs)
+                # working context for LLM later
+                working_context = RetrievalService.format_working_context(scope, results)
+        except (ValueError, RuntimeError) as e:
+            # 參數錯誤, e.g. -a 時 -f 未指定 scope, 或對 benchmark 指定 -f
+            print(f"{label} search fail because {e}")
+            continue
+        except ConnectionError as e:
+            print(e)
+            exit(1)
+        time_period_end_time = time.time()
         print(working_context)
-        print(f"\nbenchmark vector search time: {time_period_benchmark_end_time - time_period_benchmark_start_time} sec")
\ No newline at end of file
+        print(f"\n{label} vector search time: {time_period_end_time - time_period_start_time} sec")
+
+    if args.server is None and az_embed.query_cache is not None:
+        print("query embedding cache:", az_embed.query_cache.stats())
+    if args.server is None and args.stages:
+        Metrics.report("search stages")
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import random
+import zipfile
+import argparse
+import subprocess
+import urllib.request
+from xml.sax.saxutils import escape
+import Metrics
+import DatabaseProcess
+import EmbeddingFunction
+import run_spec
+import run_manual
+import run_wtk_benchmark
+from IngestManifest import IngestManifest
+
+
+PIPELINES = ("spec", "manual", "benchmark")
+
+# 最小的 docx: python-docx 與 DocumentStream.iter_docx_paragraphs 皆可讀取
+DOCX_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+</Types>"""
+DOCX_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+
+def write_docx(path:str, paragraphs:list[str], tables:list[list[list[str]]] = ()):
+    """以 zipfile 寫出只有段落與表格的 docx, 不需安裝 python-docx"""
+    def para(text:str) -> str:
+        return f'<w:p><w:r><w:t xml:space="preserve">{escape(text)}</w:t></w:r></w:p>'
+    body = [para(text) for text in paragraphs]
+    for table in tables:
+        rows = "".join("<w:tr>" + "".join(f"<w:tc>{para(cell)}</w:tc>" for cell in row) + "</w:tr>" for row in table)
+        body.append(f"<w:tbl>{rows}</w:tbl>")
+    document = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                f'<w:body>{"".join(body)}</w:body></w:document>')
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+        docx.writestr("_rels/.rels", DOCX_RELS)
+        docx.writestr("word/document.xml", document)
+
+
+'''**
+* 產生測試文件 (相同 seed 產生相同內容)
+* spec: {directory}/spec/cMT{i}_Datasheet.docx, 段落 + 規格表
+* manual: {directory}/manual/DEM/Manual{i}_en.docx, 每份 manual_paragraphs 個段落
+* benchmark: {directory}/benchmark.xlsx, 與 Weinbot_Benchmark.xlsx 相同欄位 (需要 pandas + openpyxl)
+*'''
+class CorpusGenerator:
+
+    def __init__(self, directory:str, seed:int = 42):
+        self.directory = directory
+        self.random = random.Random(seed)
+        self.vocabulary = [f"{prefix}{suffix}" for prefix in ("screen", "panel", "driver", "macro", "tag", "alarm",
+                                                               "recipe", "trend", "event", "network", "serial", "port")
+                           for suffix in ("", "s", "ing", "ed", "er", "able", "ity", "ment")]
+
+    def sentence(self, words:int = 12) -> str:
+        return " ".join(self.random.choice(self.vocabulary) for _ in range(words)).capitalize() + "."
+
+    def paragraph(self, sentences:int = 5) -> str:
+        return " ".join(self.sentence(self.random.randint(8, 16)) for _ in range(sentences))
+
+    def spec(self, count:int, paragraphs:int = 20) -> str:
+        directory = os.path.join(self.directory, "spec")
+        os.makedirs(directory, exist_ok=True)
+        for i in range(count):
+            table = [["Item", "Value"]] + [[self.random.choice(self.vocabulary), str(self.random.randint(1, 9999))]
+                                           for _ in range(30)]
+            write_docx(os.path.join(directory, f"cMT{1000 + i}_Datasheet.docx"),
+                       [self.paragraph() for _ in range(paragraphs)], [table])
+        return directory
+
+    def manual(self, count:int, paragraphs:int = 200) -> str:
+        directory = os.path.join(self.directory, "manual")
+        os.makedirs(os.path.join(directory, "DEM"), exist_ok=True)
+        for i in range(count):
+            write_docx(os.path.join(directory, "DEM", f"Manual{i}_en.docx"), [self.paragraph() for _ in range(paragraphs)])
+        return directory
+
+    def benchmark(self, count:int) -> str:
+        import pandas as pd
+        path = os.path.join(self.directory, "benchmark.xlsx")
+        os.makedirs(self.directory, exist_ok=True)
+        notes = ["End Customer", "Distributor", "FAQ", "Feedback 1", "Ava"]
+        df = pd.DataFrame([{
+            "Order": i + 1, "Question": self.sentence(), "Summarize Agent Response GT": self.paragraph(3),
+            "Filter Agent Response GT": self.paragraph(2), "備註": self.random.choice(notes), "PIC": "bench",
+            "Robot Response": self.sentence(), "Feedback Advice": "", "Human Think Domain GT": "HMI",
+            "9-Class GT": "spec", "Planner GT": "spec"
+        } for i in range(count)])
+        # 與原始 excel 相同, 第一列為標題 (讀取時 skiprows=1)
+        df.to_excel(path, sheet_name="Datasets100", startrow=1, index=False)
+        return path
+
+
+'''**
+* 計算 COPY 寫入時間與筆數 (bulk_load / replace_source_chunks 都經由 _copy_rows 寫入)
+* 筆數使用 bulk_load / replace_source_chunks(_stream) 回傳的實際寫入數, 不含 ON CONFLICT 略過與 staging 中的 chunk
+*'''
+class TimedPGVector(DatabaseProcess.PGVector):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_sec = 0.0
+        self.write_rows = 0
+
+    def _copy_rows(self, cur, table_name:str, col_names:str, rows:list[tuple], upsert:bool = True, binary:bool = True,
+                   stage_table:str = None) -> int:
+        start_time = time.perf_counter()
+        try:
+            return super()._copy_rows(cur, table_name, col_names, rows, upsert, binary, stage_table)
+        finally:
+            self.write_sec += time.perf_counter() - start_time
+
+    def bulk_load(self, *args, **kwargs) -> int:
+        inserted_cnt = super().bulk_load(*args, **kwargs)
+        self.write_rows += inserted_cnt
+        return inserted_cnt
+
+    def replace_source_chunks(self, *args, **kwargs) -> tuple[int, int]:
+        inserted_cnt, deleted_cnt = super().replace_source_chunks(*args, **kwargs)
+        self.write_rows += inserted_cnt
+        return inserted_cnt, deleted_cnt
+
+    def replace_source_chunks_stream(self, *args, **kwargs) -> tuple[int, int]:
+        inserted_cnt, deleted_cnt = super().replace_source_chunks_stream(*args, **kwargs)
+        self.write_rows += inserted_cnt
+        return inserted_cnt, deleted_cnt
+
+
+'''**
+* 以指定的 batch size 轉換 Embedding, 並計算呼叫次數與時間
+* scanner 呼叫 get_embeddings(texts) 時使用預設的 embed_batch_size, 在此改為 benchmark 指定的值
+*'''
+class TimedEmbeddings(EmbeddingFunction.ConcurrentAzureOpenAIEmbeddings):
+
+    def __init__(self, batch_size:int, batch_tokens:int, **kwargs):
+        super().__init__(**kwargs)
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.embed_sec = 0.0
+        self.embed_calls = 0
+        self.embed_texts = 0
+        self.embed_fails = 0
+
+    def get_embeddings(self, texts, max_batch_size=None, max_batch_tokens=None) -> list:
+        start_time = time.perf_counter()
+        embeddings = super().get_embeddings(texts, max_batch_size or self.batch_size, max_batch_tokens or self.batch_tokens)
+        self.embed_sec += time.perf_counter() - start_time
+        self.embed_calls += 1
+        self.embed_texts += len(texts)
+        self.embed_fails += sum(embedding is None for embedding in embeddings)
+        return embeddings
+
+
+def server_request(server:str, path:str, method:str = "GET") -> dict:
+    request = urllib.request.Request(server.rstrip("/") + path, data=b"" if method == "POST" else None, method=method)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def start_fake_server(args) -> subprocess.Popen:
+    """以 subprocess 啟動 run_fake_embed_server.py, 與 benchmark 不共用 GIL"""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_fake_embed_server.py"),
+               "--port", str(args.port), "--latency_ms", str(args.latency_ms), "--per_input_ms", str(args.per_input_ms),
+               "--error_429", str(args.error_429), "--error_5xx", str(args.error_5xx),
+               "--retry_after", str(args.retry_after), "--seed", str(args.seed)]
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    server = f"http://127.0.0.1:{args.port}"
+    for _ in range(100):
+        try:
+            server_request(server, "/health")
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError(f"fake embedding server did not start on {server}")
+
+
+def reset_table(pg_vector, table_name:str):
+    """刪除 benchmark table 與其 manifest, 每次都完整轉換與寫入"""
+    pg_vector.create_manifest_table()
+    with pg_vector.get_connection() as conn, conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+        cur.execute("DELETE FROM ingest_manifest WHERE table_name = %s", (table_name,))
+        conn.commit()
+
+
+def run_pipeline(pg_vector, name:str, source:str, table_name:str, workers:int):
+    """執行與 run_spec.py / run_manual.py / run_wtk_benchmark.py 相同的流程 (不建立 ANN 索引)"""
+    if name == "spec":
+        pg_vector.create_spec_table(table_name=table_name)
+        manifest = IngestManifest(pg_vector, table_name, key_col="source", full_refresh=True)
+        run_spec.SpecScanner(directory=source, table_name=table_name).scan_folder_and_create_embed2pg(manifest, workers=workers)
+    elif name == "manual":
+        pg_vector.create_manual_table(table_name=table_name)
+        manifest = IngestManifest(pg_vector, table_name, key_col="filename", full_refresh=True)
+        run_manual.DEM(source, table_name).scan_folder_and_create_embed2pg(manifest, workers=workers)
+    else:
+        pg_vector.create_benchmark_table(table_name=table_name)
+        run_wtk_benchmark.Benchmark2PGVector(source, "Datasets100", table_name).write_benchmark_to_pgvector()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Ingestion throughput benchmark with a local fake embedding server')
+    parser.add_argument('-p', '--pipelines', type=str, default=",".join(PIPELINES), help='要執行的流程, e.g. spec,manual,benchmark')
+    parser.add_argument('-d', '--corpus', type=str, default="./ingest_benchmark_corpus", help='測試文件的資料夾')
+    parser.add_argument('--spec_files', type=int, default=50, help='spec datasheet 數')
+    parser.add_argument('--manual_files', type=int, default=5, help='manual 數')
+    parser.add_argument('--manual_paragraphs', type=int, default=400, help='每份 manual 的段落數')
+    parser.add_argument('--benchmark_rows', type=int, default=200, help='benchmark excel 筆數')
+    parser.add_argument('--regenerate', action='store_true', help='重新產生測試文件')
+    parser.add_argument('--table_prefix', type=str, default="ingest_bench_", help='benchmark table 名稱前綴')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='spec / manual 解析的 process 數')
+    # embedding client 參數
+    parser.add_argument('--batch_size', type=int, default=EmbeddingFunction.embed_batch_size, help='每個 request 最多 input 數')
+    parser.add_argument('--batch_tokens', type=int, default=EmbeddingFunction.embed_batch_tokens, help='每個 request 最多 token 數')
+    parser.add_argument('--concurrency', type=int, default=EmbeddingFunction.embed_concurrency, help='同時送出的 request 數')
+    parser.add_argument('--max_retries', type=int, default=EmbeddingFunction.embed_max_retries, help='可重試錯誤的重試次數')
+    parser.add_argument('--base_delay', type=float, default=1.0, help='重試 backoff 的基本秒數')
+    parser.add_argument('--rpm', type=int, default=0, help='requests per minute 限制 (0: 不限制)')
+    parser.add_argument('--tpm', type=int, default=0, help='tokens per minute 限制 (0: 不限制)')
+    # fake server 參數 (指定 --server 時不啟動)
+    parser.add_argument('--server', type=str, default=None, help='已啟動的 embedding 服務, e.g. http://127.0.0.1:8700')
+    parser.add_argument('--port', type=int, default=8700, help='啟動 fake server 的 port')
+    parser.add_argument('--latency_ms', type=float, default=50, help='fake server 每個 request 的延遲 (ms)')
+    parser.add_argument('--per_input_ms', type=float, default=0.2, help='fake server 每個 input 增加的延遲 (ms)')
+    parser.add_argument('--error_429', type=float, default=0.0, help='fake server 回傳 429 的比例')
+    parser.add_argument('--error_5xx', type=float, default=0.0, help='fake server 回傳 5xx 的比例')
+    parser.add_argument('--retry_after', type=float, default=1.0, help='fake server 429 的 retry-after 秒數')
+    parser.add_argument('--seed', type=int, default=42, help='測試文件與錯誤注入的 seed')
+    parser.add_argument('-o', '--output', type=str, default="ingest_benchmark.json", help='結果 JSON 檔')
+    args = parser.parse_args()
+
+    pipelines = [name for name in args.pipelines.split(",") if name.strip()]
+    unknown = [name for name in pipelines if name not in PIPELINES]
+    if unknown:
+        print(f"unsupported pipelines: {unknown}, use {list(PIPELINES)}")
+        sys.exit(1)
+
+    generator = CorpusGenerator(args.corpus, args.seed)
+    sources = {}
+    for name in pipelines:
+        if name == "spec":
+            sources[name] = os.path.join(args.corpus, "spec")
+            if args.regenerate or not os.path.isdir(sources[name]):
+                generator.spec(args.spec_files)
+        elif name == "manual":
+            sources[name] = os.path.join(args.corpus, "manual")
+            if args.regenerate or not os.path.isdir(sources[name]):
+                generator.manual(args.manual_files, args.manual_paragraphs)
+        else:
+            sources[name] = os.path.join(args.corpus, "benchmark.xlsx")
+            if args.regenerate or not os.path.exists(sources[name]):
+                generator.benchmark(args.benchmark_rows)
+
+    server_proc = None if args.server else start_fake_server(args)
+    server = args.server or f"http://127.0.0.1:{args.port}"
+    # 不使用 embedding cache, 每次都實際呼叫 embedding 服務
+    az_embed = TimedEmbeddings(args.batch_size, args.batch_tokens, endpoint=server, api_key="benchmark", cache=None,
+                               rpm=args.rpm, tpm=args.tpm, max_concurrency=args.concurrency,
+                               max_retries=args.max_retries, base_delay=args.base_delay)
+    pg_vector = TimedPGVector(DatabaseProcess.pg_setting, DatabaseProcess.pool_setting)
+    # scanner 使用各模組的 az_embed / pg_vector (見 init_clients)
+    for module in (run_spec, run_manual, run_wtk_benchmark):
+        module.az_embed, module.pg_vector = az_embed, pg_vector
+
+    report = {"config": vars(args), "server": server, "results": []}
+    try:
+        for name in pipelines:
+            table_name = args.table_prefix + name
+            reset_table(pg_vector, table_name)
+            server_request(server, "/reset", "POST")
+            az_embed.embed_sec = az_embed.embed_calls = az_embed.embed_texts = az_embed.embed_fails = 0
+            pg_vector.write_sec, pg_vector.write_rows = 0.0, 0
+            Metrics.metrics.reset()
+            print(f"\n==== {name}: {sources[name]} -> {table_name}")
+            start_time = time.perf_counter()
+            run_pipeline(pg_vector, name, sources[name], table_name, args.workers)
+            wall_sec = time.perf_counter() - start_time
+            with pg_vector.get_connection() as conn, conn.cursor() as cur:
+                cur.execute(f"SELECT count(*) FROM {table_name}")
+                chunk_cnt = cur.fetchone()[0]
+            result = {
+                "pipeline": name,
+                "chunks": chunk_cnt,
+                "wall_sec": wall_sec,
+                "chunks_per_sec": chunk_cnt / wall_sec if wall_sec else 0.0,
+                "embed": {"calls": az_embed.embed_calls, "texts": az_embed.embed_texts, "failed": az_embed.embed_fails,
+                          "sec": az_embed.embed_sec},
+                "api": server_request(server, "/stats"),
+                "db_write": {"rows": pg_vector.write_rows, "sec": pg_vector.write_sec},
+                # 各階段耗時與計數 (Metrics.MetricsRegistry.snapshot)
+                "stages": Metrics.metrics.snapshot()
+            }
+            report["results"].append(result)
+            api = result["api"]
+            print(f"{name}: {chunk_cnt} chunks in {wall_sec:.2f} sec ({result['chunks_per_sec']:.1f} chunks/sec), "
+                  f"api requests {api['requests']} (status {api['status']}), embed {az_embed.embed_sec:.2f} sec, "
+                  f"db write {pg_vector.write_sec:.2f} sec")
+    finally:
+        az_embed.close()
+        pg_vector.close()
+        if server_proc is not None:
+            server_proc.terminate()
+            server_proc.wait()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"result saved to {args.output}")
@@ -1,25 +1,61 @@
 # -*- coding: utf-8 -*-
 import os
-import time
+import re
 import chardet
 import argparse
 import requests
+import threading
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import Metrics
 import DatabaseProcess
 import EmbeddingFunction
-from bs4 import BeautifulSoup
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from IngestManifest import IngestManifest
+import DocumentStream
 
 
-az_embed = EmbeddingFunction.AzureOpenAIEmbeddings()
-pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting)
+# 參數檢查通過後才建立 (init_clients), --help 或參數錯誤時不需建立 embedding client 與連線 db
+az_embed = None
+pg_vector = None
+
+
+def init_clients():
+    global az_embed, pg_vector
+    az_embed = EmbeddingFunction.ConcurrentAzureOpenAIEmbeddings(cache=EmbeddingFunction.load_embedding_cache())
+    pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting, DatabaseProcess.pool_setting)
+
+
+# HTML 開頭的 <meta charset=...> 或 <meta http-equiv="Content-Type" content="...; charset=...">
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([A-Za-z0-9_\-]+)', re.IGNORECASE)
+
+
+'''**
+* 判斷網頁編碼: Content-Type header -> HTML meta charset -> chardet
+* 沒有 charset 的 text/* header 在 requests 中會被視為 ISO-8859-1, 因此只採用 header 中明確指定的 charset
+* @params: resp - requests.Response
+* @return: encoding
+*'''
+def detect_encoding(resp) -> str:
+    content_type = resp.headers.get("Content-Type", "")
+    if "charset=" in content_type.lower():
+        return requests.utils.get_encoding_from_headers(resp.headers)
+    match = META_CHARSET_RE.search(resp.content[:4096])
+    if match:
+        return match.group(1).decode("ascii")
+    return chardet.detect(resp.content)['encoding']
 
 
 class JsSDKScanner:
     
-    def __init__(self,root_url = "https://dl.weintek.com/public/Document/JS_Object_SDK/Current/", table_name = "jssdk"):
+    def __init__(self,root_url = "https://dl.weintek.com/public/Document/JS_Object_SDK/Current/", table_name = "jssdk",
+                 workers = 8, timeout = (5, 30)):
         # pg table name
         self.table_name = table_name
+        # 同時抓取的網頁數; timeout - (connect, read) 秒數
+        self.workers = workers
+        self.timeout = timeout
+        # 每個 thread 一個 requests.Session, 重複使用連線 (keep-alive)
+        self._local = threading.local()
         # 紀錄每一個網站分頁的詳細資訊
         self.metadatas = [
                     {"source": "index.html", "url": root_url + "index.html", "root_url": root_url, "class_name": "Home", "description": "JS Object was first released in EasyBuilder Pro v6.05.01 in 2020. Its goal is to help create user‑customizable widgets."},
@@ -70,67 +106,98 @@ class JsSDKScanner:
             "HomeHome (Chinese)ntsMouseArea#clickMouseArea#mousedownMouseArea#mousemoveMouseArea#mouseupNamespacesdrivergetDatasetDatasetStringDatadriver.promisesgetDatasetDatasetStringDatanet.CurlinfooshostnamenetworkInterfacesplatformTutorialsChart.js DemoMemo Board DemoSOAP Client DemoMouse AreaWebinar (Dec 10, 2020)Web RequestTutorial 1: Retrieve configTutorial 2: Create a ButtonTutorial 3: Read AddressTutorial 4: Use SubscriptionTutorial 5: Write AddressTutorial 6: Build a Toggle SwitchTutorial 7: Switch with ModesGlobalcancelAnimationFrameclearIntervalclearTimeoutconsoleglobalThisnetrequestAnimationFramerequiresetIntervalsetTimeoutwindow"
             ]
     
+    def get_session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+    
+    '''**
+    * 抓取單一網頁, 帶上次的 ETag / Last-Modified 進行 conditional GET
+    * @params: metadata - self.metadatas 中的一筆; headers - IngestManifest.conditional_headers
+    * @return: (content_texts, validators), 網頁未改變 (304) 時 content_texts 為 None
+    *'''
+    def fetch_page(self, metadata:dict, headers:dict) -> tuple[str, dict]:
+        with Metrics.metrics.timer("fetch_page", scanner="jssdk"):
+            resp = self.get_session().get(metadata["url"], headers=headers, timeout=self.timeout)
+        Metrics.metrics.inc("pages_fetched", scanner="jssdk", status=resp.status_code)
+        if resp.status_code == 304:
+            return None, {}
+        resp.raise_for_status()
+        resp.encoding = detect_encoding(resp)
+        from bs4 import BeautifulSoup
+        with Metrics.metrics.timer("parse_page", scanner="jssdk"):
+            soup = BeautifulSoup(resp.text, 'html.parser')
+            content_texts = soup.get_text()
+        # remove each suffix
+        for replace in self.remove_text_list:
+            content_texts = content_texts.replace(replace,"")
+        validators = {"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified")}
+        return content_texts, validators
+    
     '''**
     * 掃描metadata進行爬蟲並存入pg
-    * @params: NA
+    * 1. 以 thread pool 同時抓取 (最多 self.workers 個), 未改變的網頁回傳 304, 不需下載與解析
+    * 2. 內容改變的網頁切割後一次批次轉換新 chunk 的 Embedding
+    * @params: manifest - IngestManifest, 網頁內容未改變則略過, 已移除的網頁會刪除其 chunks
     * @return: NA
     *'''
-    def scan_web_and_create_embed2pg(self):
-        # 建立 text splitter 
-        text_splitter_recur = RecursiveCharacterTextSplitter(
-            chunk_size = 1000,
-            chunk_overlap = 300,
-            length_function = len,
-            is_separator_regex=False
-        )
+    def scan_web_and_create_embed2pg(self, manifest):
+        # 建立 text splitter (依 token 數切割)
+        text_splitter_recur = DocumentStream.get_token_splitter(300, 90)
         
         print("start scaning....")
         total_chunk_cnt = 0
+        total_deleted_cnt = 0
+        not_modified_cnt = 0
         fail_list = []
-        # 掃描所有 url進行網頁爬蟲
-        for i, metadata in tqdm(enumerate(self.metadatas), 
-                            total=len(self.metadatas), 
-                            desc = "Processing JS Object URLs ", 
-                            unit="url"):
+        pending = [] # list of (source_key, fingerprint, metadata, chunks) 等待轉換 Embedding
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="jssdk-fetch") as executor:
+            futures = {}
+            for metadata in self.metadatas:
+                # 即使本次抓取失敗, 也不視為已移除的網頁
+                manifest.mark_seen(metadata["source"])
+                headers = manifest.conditional_headers(metadata["source"])
+                futures[executor.submit(self.fetch_page, metadata, headers)] = metadata
+            # 掃描所有 url進行網頁爬蟲
+            for future in tqdm(as_completed(futures),
+                               total=len(futures),
+                               desc = "Processing JS Object URLs ",
+                               unit="url"):
+                metadata = futures[future]
+                try:
+                    content_texts, validators = future.result()
+                    if content_texts is None:
+                        manifest.mark_not_modified(metadata["source"])
+                        not_modified_cnt += 1
+                        continue
+                    # 內容未改變則略過, 不需切割與轉換 Embedding
+                    changed, fingerprint = manifest.check_content(metadata["source"], content_texts, validators)
+                    if not changed:
+                        continue
+                    # 文字切割, 只有新 chunk 需轉換為Embedding
+                    pending.append((metadata["source"], fingerprint, metadata, text_splitter_recur.split_text(content_texts)))
+                except Exception as e:
+                    fail_list.append((metadata["url"], str(e)))
+        
+        if pending:
+            # 所有改變的網頁一次批次轉換, 舊 chunk 在同一個 transaction 內替換
             try:
-                # 網站爬蟲抓取文字資料
-                url = metadata["url"]
-                resp = requests.get(url)
-                encoding = chardet.detect(resp.content)['encoding']
-                resp.encoding = encoding
-                soup = BeautifulSoup(resp.text, 'html.parser')
-                content_texts = soup.get_text()
-                # remove each suffix
-                for replace in self.remove_text_list:
-                    content_texts = content_texts.replace(replace,"")
-                # 處理metadata格式以便插入pg, 外掛 chunk_context and embedding
-                data_keys = list(metadata.keys()) + ["chunk_context","embedding"]
-                col_names = ", ".join(data_keys)
-                
-                # 文字切割並轉換為Embedding、存入PG
-                for chunk in text_splitter_recur.split_text(content_texts):
-                    # 加入 chunk_context
-                    data_values = list(metadata.values())
-                    data_values.append(chunk)
-                    # 轉換Embedding, 失敗試三次
-                    for _ in range(3):
-                        chunk_embedding = az_embed.get_embedding(chunk)
-                        if chunk_embedding is not None:
-                            data_values.append(chunk_embedding)
-                            # 存入pg
-                            data_values = [tuple(data_values)]
-                            pg_vector.upsert_data(self.table_name, 
-                                                col_names, 
-                                                data_values)
-                            total_chunk_cnt += 1
-                            break
-                        else:
-                            time.sleep(10)
+                inserted_cnt, deleted_cnt, fails = manifest.sync_sources(pending, az_embed.get_embeddings)
+                total_chunk_cnt += inserted_cnt
+                total_deleted_cnt += deleted_cnt
+                fail_list.extend(fails)
             except Exception as e:
-                fail_list.append((metadata["url"], str(e)))
-                
+                fail_list.extend((source_key, str(e)) for source_key, _, _, _ in pending)
                 
+        # 已不在 metadatas 中的網頁: 刪除其 chunks
+        removed_list = manifest.remove_missing()
+        
         print("total len of chunks: ",total_chunk_cnt)
+        print("deleted chunks: ",total_deleted_cnt)
+        print("unchanged urls skipped: ",manifest.skipped_cnt, f"(not modified: {not_modified_cnt})")
+        print("removed urls: ",removed_list)
         print("fail list:\n",fail_list)
 
 
@@ -138,6 +205,11 @@ def main():
     
     parser = argparse.ArgumentParser(description='JS Object SDK')
     parser.add_argument('-t','--table_name', default="jssdk", type=str,help='創建Postgres Table名稱存入jssdk')
+    parser.add_argument('--full', action='store_true', help='忽略 manifest, 重新比對所有網頁')
+    parser.add_argument('-x', '--index', type=str, default="hnsw", choices=["hnsw", "ivfflat", "none"], help='寫入完成後在 embedding 建立的 ANN 索引')
+    parser.add_argument('--partial', action='store_true', help='依 class_name 的值建立 partial ANN 索引 (資料 >= 1000 筆的值)')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='同時抓取的網頁數')
+    parser.add_argument('--timeout', type=float, default=30, help='每個網頁的讀取 timeout 秒數')
     args = parser.parse_args()
     
     table_name = args.table_name
@@ -145,6 +217,7 @@ def main():
         print("table_name is empty")
         exit()
     
+    init_clients()
     print(f"Create table '{table_name}' if not exists....")
     ret_json = pg_vector.create_jssdk_table(table_name=table_name)
     if ret_json["status"] == "fail":
@@ -153,8 +226,20 @@ def main():
     
     
     print("start creating documents....")
-    scanner = JsSDKScanner(table_name=table_name)
-    scanner.scan_web_and_create_embed2pg()
+    scanner = JsSDKScanner(table_name=table_name, workers=args.workers, timeout=(5, args.timeout))
+    manifest = IngestManifest(pg_vector, table_name, key_col="source", full_refresh=args.full)
+    with Metrics.metrics.timer("ingest_scan", scanner="jssdk"):
+        scanner.scan_web_and_create_embed2pg(manifest)
+    
+    if args.index != "none":
+        print(f"Create {args.index} index on '{table_name}' if not exists....")
+        pg_vector.create_vector_index(table_name, index_type=args.index)
+        if args.partial:
+            pg_vector.create_filtered_vector_indexes(table_name, "class_name", index_type=args.index)
+    
+    if az_embed.cache is not None:
+        print("embedding cache:", az_embed.cache.stats())
+    Metrics.report(scanner="jssdk", table_name=table_name)
     print("done")
 
 
@@ -1,21 +1,32 @@
 # -*- coding: utf-8 -*-
 import os
-import time
 import argparse
 from tqdm import tqdm
+import Metrics
 import DatabaseProcess
 import EmbeddingFunction
+import DocumentStream
+from IngestManifest import IngestManifest
 from os import listdir, walk
 from os.path import basename, join, exists, dirname
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import Docx2txtLoader, PyPDFLoader
 
 
-az_embed = EmbeddingFunction.AzureOpenAIEmbeddings()
-pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting)
+# 參數檢查通過後才建立 (init_clients), --help 或參數錯誤時不需建立 embedding client 與連線 db
+az_embed = None
+pg_vector = None
+
+
+def init_clients():
+    global az_embed, pg_vector
+    az_embed = EmbeddingFunction.ConcurrentAzureOpenAIEmbeddings(cache=EmbeddingFunction.load_embedding_cache())
+    pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting, DatabaseProcess.pool_setting)
 
 
 class DEM:
+    # text splitter 參數 (token 數, 見 DocumentStream.get_token_splitter)
+    chunk_tokens = 300
+    overlap_tokens = 90
+    
     def __init__(self, directory, table_name):
         # 定義類別資訊
         self.info = {
@@ -58,16 +69,29 @@ class DEM:
                 end_text = end
         return isin_end, end_text
     
+    '''**
+    * 每累積一批 chunk 即轉換 Embedding, 並在同一個 transaction 內替換此檔案的舊 chunks
+    * @params: manifest - IngestManifest; fingerprint - 檔案 fingerprint; metadata - 檔案 metadata
+    *          chunks - iterable of chunk; fail_list - 記錄失敗的檔案
+    * @return: 成功寫入的 chunk 數
+    *'''
+    def embed_and_write_chunks(self, manifest, fingerprint:dict, metadata:dict, chunks, fail_list:list) -> int:
+        # 失敗的 sub-batch 由 get_embeddings 重試, 仍失敗者記錄在 fail_list
+        inserted_cnt, _, fails = manifest.sync_source_stream(metadata['filename'], fingerprint, metadata, chunks,
+                                                             az_embed.get_embeddings)
+        fail_list.extend(fails)
+        return inserted_cnt
+    
     '''**掃描檔案+建立metadaat
     * 1. 排除不正確的檔名+副檔名, 優先處理PDF格式
     * 2. 將可以處理的檔案一一建立metadata
-    * 3. 使用 RecursiveCharacterTextSplitter 切割文檔
-    * 4. 轉為Embedding
+    * 3. 逐頁讀取, 依 token 數切割文檔 (DocumentStream.get_token_splitter)
+    * 4. 轉為Embedding (只轉換新 chunk, 邊解析邊轉換)
     * 5. 插入PostgreSQL
-    * @params: None
+    * @params: manifest - IngestManifest, 未改變的檔案略過; workers - 見 process_files
     * @return: None
     *'''
-    def scan_folder_and_create_embed2pg(self):
+    def scan_folder_and_create_embed2pg(self, manifest, workers = 1):
         filenames = [] # 紀錄可以處理的檔案路徑+檔名
         prefix_filenames = []
         extension_list = []
@@ -92,21 +116,26 @@ class DEM:
                             extension_list.append(extension)
                         prefix_filenames.append(prefix_filename)
         
-        # text splitter
-        text_splitter_recur = RecursiveCharacterTextSplitter(
-            chunk_size = 1000,
-            chunk_overlap = 300,
-            length_function = len,
-            is_separator_regex=False
-        )
+        self.process_files(manifest, filenames, extension_list, workers)
+    
+    '''**
+    * 建立 metadata, 切割文檔並轉為 Embedding 插入 PostgreSQL
+    * workers > 1: 以 process pool 平行解析與切割整份文件, 依完成順序送回轉換 Embedding 與寫入
+    * workers = 1: 在主程式逐頁讀取與切割, 邊解析邊轉換 (記憶體只保留一頁與一批 chunk)
+    * @params: manifest - IngestManifest; filenames - 檔案路徑; extension_list - 對應的副檔名; workers - process 數
+    * @return: None
+    *'''
+    def process_files(self, manifest, filenames:list[str], extension_list:list[str], workers = 1):
         print("start scaning....")
         total_chunk_cnt = 0
         fail_list = []
-        for i, filename in tqdm(enumerate(filenames),
-                                desc="Process Manual Documents ",
-                                total=len(filenames),
-                                unit="pcs"):
+        files = {} # filename -> (fingerprint, metadata)
+        for i, filename in enumerate(filenames):
             try:
+                # 檔案未改變則略過 (manual 以完整路徑 filename 作為來源)
+                changed, fingerprint = manifest.check_file(filename, filename)
+                if not changed:
+                    continue
                 # 建立metadata
                 metadata = {
                     'source':basename(filename),
@@ -116,41 +145,30 @@ class DEM:
                     'class_name':self.info['class_name'],
                     'class_desc':self.info['class_desc']
                     }
-                # 處理metadata格式以便插入pg, 外掛 chunk_context and embedding
-                data_keys = list(metadata.keys()) + ["chunk_context","embedding"]
-                col_names = ", ".join(data_keys)
-                # 不同副檔 -> 不同處理方式
-                content_texts = ""
-                if extension_list[i].lower() == 'docx':
-                    loader = Docx2txtLoader(filename)
-                    data = loader.load() # 只有一個document包含全部內容
-                    content_texts = data[0].page_content #取出內容
-                else: # pdf
-                    loader = PyPDFLoader(filename)
-                    pages = loader.load_and_split() # page by page data
-                    for page in pages:
-                        content_texts += (page.page_content + " ")
-                        
+                files[filename] = (fingerprint, metadata)
+            except Exception as e:
+                fail_list.append((filename, str(e)))
+        
+        # 不同副檔 -> 不同處理方式 (見 DocumentStream.iter_document_pages)
+        tasks = [(filename, (filename, metadata['extension'], self.chunk_tokens, self.overlap_tokens))
+                 for filename, (_, metadata) in files.items()]
+        if workers > 1:
+            parsed = DocumentStream.parse_in_pool(DocumentStream.chunk_document, tasks, workers)
+        else:
+            # 解析在背景 thread 進行, 與 Embedding 轉換同時執行
+            parsed = ((filename, DocumentStream.prefetch(DocumentStream.iter_document_chunks(*args)), None)
+                      for filename, args in tasks)
+        for filename, chunks, error in tqdm(parsed,
+                                            desc="Process Manual Documents ",
+                                            total=len(tasks),
+                                            unit="pcs"):
+            if error is not None:
+                fail_list.append((filename, error))
+                continue
+            try:
+                fingerprint, metadata = files[filename]
                 # split and add metadata
-                for chunk in text_splitter_recur.split_text(content_texts):
-                    # 加入 chunk_context
-                    data_values = list(metadata.values())
-                    data_values.append(chunk)
-                    # 轉換Embedding, 失敗試三次
-                    for _ in range(3):
-                        chunk_embedding = az_embed.get_embedding(chunk)
-                        if chunk_embedding is not None:
-                            data_values.append(chunk_embedding)
-                            # 存入pg
-                            data_values = [tuple(data_values)]
-                            pg_vector.upsert_data(self.table_name, 
-                                                  col_names, 
-                                                  data_values)
-                            total_chunk_cnt += 1
-                            break
-                        else:
-                            time.sleep(10)    
-                    
+                total_chunk_cnt += self.embed_and_write_chunks(manifest, fingerprint, metadata, chunks, fail_list)
             except Exception as e:
                 fail_list.append((filename, str(e)))
             
@@ -189,72 +207,12 @@ class EBP(DEM):
         }
         self.table_name = table_name
     
-    def scan_folder_and_create_embed2pg(self):
+    def scan_folder_and_create_embed2pg(self, manifest, workers = 1):
         # 規定只能處理的檔案+副檔名
         files = ['EasyBuilder-Pro-V61001-UserManual-cht.pdf','EasyBuilder-Pro-V61001-UserManual-eng.pdf']
         filenames = [(self.info['path'] + '/' + f) for f in files]
         extension_list = ['pdf','pdf']
-        
-        # text splitter
-        text_splitter_recur = RecursiveCharacterTextSplitter(
-            chunk_size = 1000,
-            chunk_overlap = 300,
-            length_function = len,
-            is_separator_regex=False
-        )
-        print("start scaning....")
-        total_chunk_cnt = 0
-        fail_list = []
-        for i, filename in tqdm(enumerate(filenames),
-                                desc="Process Manual Documents ",
-                                total=len(filenames),
-                                unit="pcs"):
-            try:
-                # 建立metadata
-                metadata = {'source':basename(filename),
-                            'filename':filename,
-                            'parent_folder':basename(dirname(filename)),
-                            'extension':extension_list[i],
-                            'class_name':self.info['class_name'],
-                            'class_desc':self.info['class_desc']}
-                # 處理metadata格式以便插入pg, 外掛 chunk_context and embedding
-                data_keys = list(metadata.keys()) + ["chunk_context","embedding"]
-                col_names = ", ".join(data_keys)
-                # 不同副檔 -> 不同處理方式
-                content_texts = ""
-                if extension_list[i] == 'docx':
-                    loader = Docx2txtLoader(filename)
-                    data = loader.load() # 只有一個document包含全部內容
-                    content_texts = data[0].page_content #取出內容
-                else: # pdf
-                    loader = PyPDFLoader(filename)
-                    pages = loader.load_and_split() # page by page data
-                    for page in pages:
-                        content_texts += (page.page_content + " ")
-                # split and add metadata
-                for chunk in text_splitter_recur.split_text(content_texts):
-                    # 加入 chunk_context
-                    data_values = list(metadata.values())
-                    data_values.append(chunk)
-                    # 轉換Embedding, 失敗試三次
-                    for _ in range(3):
-                        chunk_embedding = az_embed.get_embedding(chunk)
-                        if chunk_embedding is not None:
-                            data_values.append(chunk_embedding)
-                            # 存入pg
-                            data_values = [tuple(data_values)]
-                            pg_vector.upsert_data(self.table_name, 
-                                                  col_names, 
-                                                  data_values)
-                            total_chunk_cnt += 1
-                            break
-                        else:
-                            time.sleep(10)  
-            except Exception as e:
-                fail_list.append((filename, str(e)))
-            
-        print("total len of chunks: ",total_chunk_cnt)
-        print("fail list:\n",fail_list) 
+        self.process_files(manifest, filenames, extension_list, workers)
         
 
 
@@ -305,6 +263,11 @@ def main():
     parser = argparse.ArgumentParser(description='FAE Manual Document')
     parser.add_argument('-t','--table_name', type=str, default="manual", help='創建Postgres Table名稱存入manual')
     parser.add_argument('-s', '--src', type=str, default="./SVN_manual", help='User Guide Manual 資料夾位置')
+    parser.add_argument('--full', action='store_true', help='忽略 manifest, 重新比對所有檔案')
+    parser.add_argument('-x', '--index', type=str, default="hnsw", choices=["hnsw", "ivfflat", "none"], help='寫入完成後在 embedding 建立的 ANN 索引')
+    parser.add_argument('--partial', action='store_true', help='依 class_name 的值建立 partial ANN 索引 (資料 >= 1000 筆的值)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='解析與切割檔案的 process 數 (1: 逐頁串流處理)')
+    parser.add_argument('-q', '--quantize', type=str, default="none", choices=["none", "binary"], help='binary: 索引建立在 binary_quantize(embedding), 以 --strategy binary 查詢')
     args = parser.parse_args()
     
     table_name = args.table_name
@@ -318,6 +281,7 @@ def main():
         exit()
     
     
+    init_clients()
     print(f"Create table '{table_name}' if not exists....")
     ret_json = pg_vector.create_manual_table(table_name=table_name)
     if ret_json["status"] == "fail":
@@ -325,41 +289,64 @@ def main():
         exit()
     
     print("start creating manual documents....")
+    # 所有 scanner 寫入同一個 table, 共用同一份 manifest
+    manifest = IngestManifest(pg_vector, table_name, key_col="filename", full_refresh=args.full)
     
     # for dem scanner
     print("\nstart dem scanning....")
     dem_scanner = DEM(args.src, args.table_name)
-    dem_scanner.scan_folder_and_create_embed2pg()
+    with Metrics.metrics.timer("ingest_scan", scanner="dem"):
+        dem_scanner.scan_folder_and_create_embed2pg(manifest, workers=args.workers)
     print("dem done\n")
     
     
     # for faq scanner
     print("\nstart faq scanning....")
     faq_scanner = FAQ(args.src, args.table_name)
-    faq_scanner.scan_folder_and_create_embed2pg()
+    with Metrics.metrics.timer("ingest_scan", scanner="faq"):
+        faq_scanner.scan_folder_and_create_embed2pg(manifest, workers=args.workers)
     print("faq done\n")
     
     
     # for ebp scanner
     print("\nstart ebp scanning....")
     ebp_scanner = EBP(args.src, args.table_name)
-    ebp_scanner.scan_folder_and_create_embed2pg()
+    with Metrics.metrics.timer("ingest_scan", scanner="ebp"):
+        ebp_scanner.scan_folder_and_create_embed2pg(manifest, workers=args.workers)
     print("ebp done\n")
     
     
     # for um0 scanner
     print("\nstart um0 scanning....")
     um0_scanner = UM0(args.src, args.table_name)
-    um0_scanner.scan_folder_and_create_embed2pg()
+    with Metrics.metrics.timer("ingest_scan", scanner="um0"):
+        um0_scanner.scan_folder_and_create_embed2pg(manifest, workers=args.workers)
     print("um0 done\n")
     
     
     # for FBA scanner
     print("\nstart fba scanning....")
     fba_scanner = FBA(args.src, args.table_name)
-    fba_scanner.scan_folder_and_create_embed2pg()
+    with Metrics.metrics.timer("ingest_scan", scanner="fba"):
+        fba_scanner.scan_folder_and_create_embed2pg(manifest, workers=args.workers)
     print("fba done\n")
     
+    # 已從 SVN 刪除的檔案: 刪除其 chunks
+    removed_list = manifest.remove_missing()
+    print("unchanged files skipped: ", manifest.skipped_cnt)
+    print("removed files: ", removed_list)
+    
+    if args.index != "none":
+        column = "embedding_binary" if args.quantize == "binary" else DatabaseProcess.default_index_column
+        print(f"Create {args.index} index on '{table_name}' ({column}) if not exists....")
+        pg_vector.create_vector_index(table_name, index_type=args.index, column=column)
+        if args.partial:
+            pg_vector.create_filtered_vector_indexes(table_name, "class_name", index_type=args.index, column=column)
+    
+    if az_embed.cache is not None:
+        print("embedding cache:", az_embed.cache.stats())
+    Metrics.report(scanner="manual", table_name=table_name)
+    
     print("\nall done")        
     
         
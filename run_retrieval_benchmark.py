@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import DatabaseProcess
+import EmbeddingFunction
+from IngestManifest import chunk_hash
+
+
+# 各查詢模式使用的索引欄位 (exact 不使用索引)
+MODE_COLUMNS = {
+    "ann": "embedding",
+    "two_stage": "embedding_short",
+    "binary": "embedding_binary",
+    "hybrid": "embedding_short" if DatabaseProcess.embed_short_dim else "embedding"
+}
+
+
+'''**
+* 離線產生的測試資料: 以 n_clusters 個中心加上雜訊產生單位向量 (與 embedding 相同, 相似的 chunk 聚集)
+* chunk_context 由該群的關鍵字組成, hybrid 查詢的文字取同一群的關鍵字
+* 相同 seed 產生相同資料; 資料分批產生, 記憶體與 rows 無關
+*'''
+class SyntheticCorpus:
+
+    def __init__(self, dim:int, n_clusters:int = 100, spread:float = 1.0, seed:int = 42):
+        self.dim = dim
+        self.n_clusters = n_clusters
+        self.spread = spread
+        self.seed = seed
+        self.centers = np.random.default_rng(seed).standard_normal((n_clusters, dim)).astype(np.float32)
+
+    def _sample(self, rng, count:int) -> tuple[np.ndarray, np.ndarray]:
+        clusters = rng.integers(0, self.n_clusters, count)
+        vecs = self.centers[clusters] + self.spread * rng.standard_normal((count, self.dim), dtype=np.float32)
+        return vecs / np.linalg.norm(vecs, axis=1, keepdims=True), clusters
+
+    def _words(self, rng, cluster:int, count:int) -> str:
+        words = [f"topic{cluster}term{j}" for j in rng.integers(0, 20, count)]
+        words += [f"common{j}" for j in rng.integers(0, 50, count)]
+        return " ".join(words)
+
+    def iter_rows(self, rows:int, batch_size:int = 5000):
+        """產生 (source, chunk_context, chunk_hash, embedding), 與 jssdk table 的欄位對應"""
+        for start in range(0, rows, batch_size):
+            rng = np.random.default_rng([self.seed, 0, start])
+            vecs, clusters = self._sample(rng, min(batch_size, rows - start))
+            for offset, (vec, cluster) in enumerate(zip(vecs, clusters)):
+                chunk_context = self._words(rng, int(cluster), 8)
+                yield f"doc-{start + offset}", chunk_context, chunk_hash(chunk_context), vec
+
+    def queries(self, count:int) -> tuple[np.ndarray, list[str]]:
+        rng = np.random.default_rng([self.seed, 1, 0])
+        vecs, clusters = self._sample(rng, count)
+        return vecs, [self._words(rng, int(cluster), 2) for cluster in clusters]
+
+
+'''**
+* 已快取的 embedding (.npy, rows x dim): 前 rows 筆寫入 table, 之後的 queries 筆作為查詢 (不在 table 中)
+* 沒有原文, chunk_context 為編號, 不支援 hybrid
+*'''
+class CachedCorpus:
+
+    def __init__(self, path:str):
+        self.embeddings = np.load(path, mmap_mode="r")
+        self.dim = self.embeddings.shape[1]
+
+    def iter_rows(self, rows:int, batch_size:int = 5000):
+        for start in range(0, rows, batch_size):
+            batch = np.asarray(self.embeddings[start:min(rows, start + batch_size)], dtype=np.float32)
+            for offset, vec in enumerate(batch):
+                chunk_context = f"cached embedding {start + offset}"
+                yield f"doc-{start + offset}", chunk_context, chunk_hash(chunk_context), vec
+
+    def queries(self, count:int, rows:int) -> tuple[np.ndarray, list[str]]:
+        if len(self.embeddings) >= rows + count:
+            vecs = np.asarray(self.embeddings[rows:rows + count], dtype=np.float32)
+        else:
+            print(f"only {len(self.embeddings)} cached embeddings, use {count} loaded rows as queries")
+            picked = np.random.default_rng(0).choice(rows, count, replace=False)
+            vecs = np.asarray(self.embeddings[np.sort(picked)], dtype=np.float32)
+        return vecs, [None] * count
+
+
+def percentile_ms(latencies:list[float]) -> dict:
+    values = np.asarray(latencies) * 1000.0
+    return {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)),
+            "p99": float(np.percentile(values, 99)), "mean": float(values.mean())}
+
+
+'''**
+* 量測延遲與吞吐量: clients 個 thread 同時不停地送出查詢 (每次一個查詢, 與線上查詢相同)
+* @params: search_kwargs - query_nearest 的查詢參數 (strategy, ef_search, probes)
+* @return: dict(clients, latency_ms: {p50, p95, p99, mean}, qps)
+*'''
+def measure_latency(pg_vector, table_name:str, vecs, texts:list, top_k:int, clients:int, search_kwargs:dict) -> dict:
+    latencies = [0.0] * len(vecs)
+
+    def run_query(idx:int):
+        start_time = time.perf_counter()
+        pg_vector.query_nearest(vecs[idx], "id", table_name, top_k, query_text=texts[idx], **search_kwargs)
+        latencies[idx] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients, thread_name_prefix="bench-client") as executor:
+        list(executor.map(run_query, range(len(vecs))))
+    wall_time = time.perf_counter() - start_time
+    return {"clients": clients, "latency_ms": percentile_ms(latencies), "qps": len(vecs) / wall_time}
+
+
+def recall_at_k(results:list[list[dict]], ground_truth:list[set], top_k:int) -> float:
+    """與 exact 查詢結果相比, 每個查詢取回的 top_k 中正確的比例 (平均)"""
+    hits = [len({row["id"] for row in rows[:top_k]} & truth) / max(1, len(truth))
+            for rows, truth in zip(results, ground_truth)]
+    return float(np.mean(hits))
+
+
+def prepare_table(pg_vector, corpus, table_name:str, rows:int, metric:str, rebuild:bool) -> dict:
+    """建立 table 並寫入資料; 已有相同筆數且未指定 rebuild 時沿用"""
+    if rebuild and pg_vector.table_exists(table_name):
+        with pg_vector.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"DROP TABLE {table_name}")
+            conn.commit()
+    ret_json = pg_vector.create_jssdk_table(embed_dim=corpus.dim, table_name=table_name, metric=metric)
+    if ret_json["status"] == "fail":
+        raise RuntimeError(ret_json["error_reason"])
+    # 重建的 table 使用本次指定的 metric
+    pg_vector.set_table_metric(table_name, metric, overwrite=rebuild)
+    with pg_vector.get_connection() as conn, conn.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM {table_name}")
+        existing_rows = cur.fetchone()[0]
+    load_sec = 0.0
+    if existing_rows != rows:
+        if existing_rows:
+            raise RuntimeError(f"{table_name} has {existing_rows} rows, use --rebuild to reload {rows} rows")
+        print(f"load {rows} rows ({corpus.dim} dims) into '{table_name}'....")
+        start_time = time.perf_counter()
+        pg_vector.bulk_load(table_name, "source, chunk_context, chunk_hash, embedding", corpus.iter_rows(rows),
+                            upsert=False)
+        load_sec = time.perf_counter() - start_time
+    with pg_vector.get_connection() as conn, conn.cursor() as cur:
+        cur.execute(f"ANALYZE {table_name}")
+        conn.commit()
+    return {"rows": rows, "dim": corpus.dim, "metric": pg_vector.get_table_metric(table_name), "load_sec": load_sec}
+
+
+def build_index(pg_vector, table_name:str, index_type:str, columns:set, dim:int, args) -> list[dict]:
+    """刪除舊索引後建立 index_type 索引, 回傳每個欄位的建立時間與大小"""
+    builds = []
+    for column in MODE_COLUMNS.values():
+        for old_type in ("hnsw", "ivfflat"):
+            pg_vector.drop_vector_index(table_name, old_type, column)
+    for column in sorted(columns):
+        print(f"create {index_type} index on {table_name}.{column}....")
+        start_time = time.perf_counter()
+        ret_json = pg_vector.create_vector_index(table_name, index_type, embed_dim=dim, m=args.m,
+                                                 ef_construction=args.ef_construction, lists=args.lists,
+                                                 maintenance_work_mem=args.maintenance_work_mem, column=column)
+        build = {"index_type": index_type, "column": column, "status": ret_json["status"],
+                 "build_sec": time.perf_counter() - start_time, "size_mb": None}
+        if ret_json["status"] == "success":
+            with pg_vector.get_connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT pg_relation_size(to_regclass(%s))", (ret_json["index_name"],))
+                build["size_mb"] = cur.fetchone()[0] / (1 << 20)
+        else:
+            build["error"] = ret_json["error_reason"]
+        builds.append(build)
+    return builds
+
+
+def run_mode(pg_vector, table_name:str, vecs, texts, ground_truth, args, index_type:str, mode:str, param:dict) -> list[dict]:
+    """一個查詢模式與參數: 先以批次查詢計算 recall, 再依 clients 量測延遲"""
+    search_kwargs = dict(strategy=mode, overfetch=args.overfetch, **param)
+    label = " ".join(f"{name}={value}" for name, value in param.items())
+    base = {"index_type": index_type, "mode": mode, "params": param, "overfetch": args.overfetch}
+    try:
+        results = pg_vector.query_nearest_batch(vecs, "id", table_name, args.top_k,
+                                                query_texts=texts if mode == "hybrid" else None, **search_kwargs)
+        recall = recall_at_k(results, ground_truth, args.top_k)
+        # 暖機: 讓索引頁進入 shared_buffers
+        measure_latency(pg_vector, table_name, vecs[:args.warmup], texts[:args.warmup], args.top_k, 1, search_kwargs)
+    except Exception as e:
+        print(f"{index_type:8} {mode:10} {label:16} fail because {e}")
+        return [dict(base, error=str(e))]
+    runs = []
+    for clients in args.clients:
+        run = dict(base, recall=recall, **measure_latency(pg_vector, table_name, vecs, texts, args.top_k, clients,
+                                                          search_kwargs))
+        latency = run["latency_ms"]
+        print(f"{index_type:8} {mode:10} {label:16} clients={clients:<3} recall@{args.top_k}={recall:.3f} "
+              f"p50={latency['p50']:.2f}ms p95={latency['p95']:.2f}ms p99={latency['p99']:.2f}ms qps={run['qps']:.1f}")
+        runs.append(run)
+    return runs
+
+
+def int_list(value:str) -> list[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Retrieval latency / recall benchmark (offline, local Postgres)')
+    parser.add_argument('-t', '--table_name', type=str, default="retrieval_benchmark", help='測試用 table (不可為正式 table)')
+    parser.add_argument('-r', '--rows', type=int, default=100000, help='寫入的資料筆數')
+    parser.add_argument('-d', '--dim', type=int, default=int(EmbeddingFunction.embed_dim), help='向量維度 (synthetic 資料)')
+    parser.add_argument('-e', '--embeddings', type=str, default=None, help='改用已快取的 embedding (.npy, rows x dim)')
+    parser.add_argument('-q', '--queries', type=int, default=200, help='查詢數')
+    parser.add_argument('-k', '--top_k', type=int, default=10, help='top k')
+    parser.add_argument('--metric', type=str, default=DatabaseProcess.default_metric, choices=list(DatabaseProcess.METRIC_OPS))
+    parser.add_argument('-x', '--index', type=str, default="hnsw,ivfflat", help='要比較的索引, e.g. hnsw,ivfflat')
+    parser.add_argument('--modes', type=str, default=None, help='查詢模式, e.g. ann,two_stage,binary,hybrid (預設: ann, 有短向量時加上 two_stage)')
+    parser.add_argument('--ef_search', type=str, default="40,100,200", help='HNSW 的 hnsw.ef_search, 逗號分隔')
+    parser.add_argument('--probes', type=str, default="1,10,40", help='IVFFlat 的 ivfflat.probes, 逗號分隔')
+    parser.add_argument('--overfetch', type=int, default=None, help='two_stage / binary / hybrid 的 overfetch')
+    parser.add_argument('-c', '--clients', type=str, default="1,4,8", help='同時查詢的 client 數, 逗號分隔')
+    parser.add_argument('--m', type=int, default=16, help='HNSW m')
+    parser.add_argument('--ef_construction', type=int, default=64, help='HNSW ef_construction')
+    parser.add_argument('--lists', type=int, default=None, help='IVFFlat lists (預設依筆數估算)')
+    parser.add_argument('--maintenance_work_mem', type=str, default=None, help='建立索引時的 maintenance_work_mem, e.g. 2GB')
+    parser.add_argument('--clusters', type=int, default=100, help='synthetic 資料的群數')
+    parser.add_argument('--seed', type=int, default=42, help='synthetic 資料的 seed')
+    parser.add_argument('--warmup', type=int, default=20, help='每個模式量測前的暖機查詢數')
+    parser.add_argument('--rebuild', action='store_true', help='刪除並重新寫入測試 table')
+    parser.add_argument('-o', '--output', type=str, default="retrieval_benchmark.json", help='結果 JSON 檔')
+    args = parser.parse_args()
+
+    modes = (args.modes.split(",") if args.modes
+             else ["ann", "two_stage"] if DatabaseProcess.embed_short_dim else ["ann"])
+    unknown = [mode for mode in modes if mode not in MODE_COLUMNS]
+    if unknown:
+        print(f"unsupported modes: {unknown}, use {list(MODE_COLUMNS)} (exact is the ground truth)")
+        sys.exit(1)
+    args.clients = int_list(args.clients)
+    index_types = [index_type for index_type in args.index.split(",") if index_type.strip()]
+    sweeps = {"hnsw": [{"ef_search": value} for value in int_list(args.ef_search)],
+              "ivfflat": [{"probes": value} for value in int_list(args.probes)]}
+
+    if args.embeddings:
+        corpus = CachedCorpus(args.embeddings)
+        args.rows = min(args.rows, len(corpus.embeddings))
+        vecs, texts = corpus.queries(args.queries, args.rows)
+        if "hybrid" in modes:
+            print("cached embeddings have no text, skip hybrid")
+            modes.remove("hybrid")
+    else:
+        corpus = SyntheticCorpus(args.dim, args.clusters, seed=args.seed)
+        vecs, texts = corpus.queries(args.queries)
+    args.warmup = min(args.warmup, len(vecs))
+
+    pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting, DatabaseProcess.pool_setting)
+    max_clients = max(args.clients)
+    if DatabaseProcess.pool_setting and max_clients > DatabaseProcess.pool_setting["maxconn"]:
+        print(f"clients {max_clients} > POSTGRES_POOL maxconn {DatabaseProcess.pool_setting['maxconn']}, "
+              "extra clients wait for a connection")
+    report = {"config": {key: value for key, value in vars(args).items()}, "modes": modes,
+              "pool": DatabaseProcess.pool_setting, "builds": [], "results": []}
+    try:
+        with pg_vector.get_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT version(), (SELECT extversion FROM pg_extension WHERE extname = 'vector')")
+            report["postgres"], report["pgvector"] = cur.fetchone()
+        report["table"] = prepare_table(pg_vector, corpus, args.table_name, args.rows, args.metric, args.rebuild)
+        print(f"table: {report['table']}, pgvector {report['pgvector']}")
+
+        # ground truth: 完整精度逐筆比對 (不使用索引)
+        start_time = time.perf_counter()
+        exact_results = pg_vector.query_nearest_batch(vecs, "id", args.table_name, args.top_k, strategy="exact")
+        ground_truth = [{row["id"] for row in rows} for rows in exact_results]
+        print(f"exact ground truth for {len(vecs)} queries: {time.perf_counter() - start_time:.2f} sec")
+        report["results"] += run_mode(pg_vector, args.table_name, vecs, texts, ground_truth, args, "none", "exact", {})
+
+        for index_type in index_types:
+            if index_type not in sweeps:
+                print(f"unsupported index: {index_type}")
+                continue
+            report["builds"] += build_index(pg_vector, args.table_name, index_type,
+                                            {MODE_COLUMNS[mode] for mode in modes}, corpus.dim, args)
+            for mode in modes:
+                for param in sweeps[index_type]:
+                    report["results"] += run_mode(pg_vector, args.table_name, vecs, texts, ground_truth, args,
+                                                  index_type, mode, param)
+    finally:
+        pg_vector.close()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False, default=str)
+    print(f"result saved to {args.output}")
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import json
+import asyncio
+import argparse
+import Metrics
+import DatabaseProcess
+import EmbeddingFunction
+import RetrievalService
+
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+# /search 可指定的查詢參數
+SEARCH_PARAMS = ("ef_search", "probes", "strategy", "overfetch", "filter_value")
+
+
+'''**
+* 常駐 retrieval server (HTTP/JSON, 僅供本機或內網使用)
+* POST /search  body: {"scope": "jssdk|spec|manual|benchmark", "query": "...", "top_k": 10, "identity": "customer",
+*                      "ef_search": null, "probes": null, "strategy": null, "overfetch": null, "filter_value": null}
+*               filter_value: 單一值或 list 套用在 scope 的 metadata 欄位; scope 為 all 時須為 {"spec": "...", "manual": [...]}
+*               回傳: {"scope", "query", "results", "working_context", "embed_sec", "search_sec"}
+* GET  /stats   回傳 embedding 批次、query cache 與 connection pool 統計
+* GET  /metrics 各階段耗時與計數 (Prometheus text format, 見 Metrics.MetricsRegistry)
+* GET  /health  回傳 {"status": "ok"}
+*'''
+class RetrievalServer:
+
+    def __init__(self, service:RetrievalService.RetrievalService):
+        self.service = service
+
+    async def route(self, method:str, path:str, body:bytes) -> tuple[int, dict | str]:
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/stats":
+            return 200, self.service.stats()
+        if path == "/metrics":
+            return 200, Metrics.metrics.to_prometheus()
+        if path != "/search":
+            return 404, {"error": f"unknown path: {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST /search"}
+        try:
+            request = json.loads(body or b"{}")
+            scope = request["scope"]
+            query = request["query"]
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {"error": f"invalid request: {e}"}
+        if not str(query).strip():
+            return 400, {"error": "query is empty"}
+        search_kwargs = {name: request[name] for name in SEARCH_PARAMS if request.get(name) is not None}
+        try:
+            return 200, await self.service.search(scope, query, int(request.get("top_k", 10)),
+                                                  request.get("identity") or "customer", **search_kwargs)
+        except ValueError as e:
+            return 400, {"error": str(e)}
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path = request_line.decode("latin-1").split()[:2]
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+            status, payload = await self.route(method.upper(), path.split("?")[0], body)
+        except Exception as e:
+            print(f"request fail because {e}")
+            status, payload = 500, {"error": str(e)}
+        if isinstance(payload, str):
+            data = payload.encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            # distance 等數值可能為 numpy 型別
+            data = json.dumps(payload, ensure_ascii=False, default=float).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        writer.write((f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                      f"Content-Type: {content_type}\r\n"
+                      f"Content-Length: {len(data)}\r\n"
+                      "Connection: close\r\n\r\n").encode("latin-1") + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+async def serve(host:str, port:int, batch_wait_ms:float, max_batch:int):
+    # client 在 event loop 內建立, 所有查詢共用同一個 http client 與 connection pool
+    pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting, DatabaseProcess.pool_setting)
+    async_embed = EmbeddingFunction.AsyncAzureOpenAIEmbeddings(cache=EmbeddingFunction.load_embedding_cache())
+    query_cache = EmbeddingFunction.load_query_cache()
+    max_workers = DatabaseProcess.pool_setting["maxconn"] if DatabaseProcess.pool_setting else 10
+    service = RetrievalService.RetrievalService(pg_vector, async_embed, query_cache, batch_wait_ms, max_batch, max_workers)
+    server = await asyncio.start_server(RetrievalServer(service).handle, host, port)
+    print(f"retrieval server listening on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+        await async_embed.client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Retrieval server')
+    parser.add_argument('--host', type=str, default=RetrievalService.server_host, help='listen host')
+    parser.add_argument('-p', '--port', type=int, default=RetrievalService.server_port, help='listen port')
+    parser.add_argument('--batch_wait_ms', type=float, default=RetrievalService.batch_wait_ms, help='合併查詢 embedding 的等待時間 (ms)')
+    parser.add_argument('--max_batch', type=int, default=RetrievalService.batch_max_size, help='每個 embedding request 最多查詢數')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.batch_wait_ms, args.max_batch))
+    except KeyboardInterrupt:
+        print("\nserver stopped")
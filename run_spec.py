@@ -1,18 +1,25 @@
 # -*- coding: utf-8 -*-
 import os
 import glob
-import docx
-import time
 import argparse
 from tqdm import tqdm
+import Metrics
 import DatabaseProcess
 import EmbeddingFunction
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import DocumentStream
+from IngestManifest import IngestManifest
 
 
 
-az_embed = EmbeddingFunction.AzureOpenAIEmbeddings()
-pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting)
+# 參數檢查通過後才建立 (init_clients), --help 或參數錯誤時不需建立 embedding client 與連線 db
+az_embed = None
+pg_vector = None
+
+
+def init_clients():
+    global az_embed, pg_vector
+    az_embed = EmbeddingFunction.ConcurrentAzureOpenAIEmbeddings(cache=EmbeddingFunction.load_embedding_cache())
+    pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting, DatabaseProcess.pool_setting)
 
 
 '''**
@@ -52,51 +59,77 @@ class SpecScanner:
     * @return: text_and_tables - 檔案特定格式的chunk text
     *'''
     def read_docx_file(self, file_path:str) -> str:
-        doc = docx.Document(file_path)
-        text_and_tables = ""
-        text_and_tables += 'This is the '+ str(self.get_filename_without_extension(file_path)) +' Specification datasheet.'+ "\n"
-        
-        # Read paragraphs
-        for para in doc.paragraphs:
-            text_and_tables += para.text + "\n"
-
-        # Read tables
-        for table in doc.tables:
-            text_and_tables += "Table: \n"
-            for row in table.rows:
-                row_data = "\t".join(cell.text for cell in row.cells)
-                text_and_tables += row_data + "\n"
-
-        return text_and_tables
+        return DocumentStream.read_spec_docx(file_path)
+    
+    @staticmethod
+    def parse_in_order(tasks:list[tuple]):
+        """依序在主程式解析, 回傳格式與 DocumentStream.parse_in_pool 相同"""
+        for docx_file, args in tasks:
+            try:
+                yield docx_file, DocumentStream.chunk_spec_docx(*args), None
+            except Exception as e:
+                yield docx_file, None, str(e)
+    
+    '''**
+    * 批次轉換 Embedding 並寫入 PostgreSQL, 每個檔案的舊 chunk 在同一個 transaction 內替換
+    * 個別檔案寫入失敗由 sync_sources 記錄; 寫入任何檔案前整批失敗時 (例如 Embedding 或 db 連線中斷)
+    * 將批次內每個檔案記錄為 batch aborted, 不中斷掃描; 無論成功與否都清空 pending
+    * @params: manifest - IngestManifest; pending - list of (source_key, fingerprint, metadata, chunks); fail_list - 記錄轉換失敗的檔案
+    * @return: (寫入 chunk 數, 刪除 chunk 數)
+    *'''
+    def embed_and_write_chunks(self, manifest, pending:list[tuple], fail_list:list) -> tuple[int, int]:
+        try:
+            inserted_cnt, deleted_cnt, fails = manifest.sync_sources(pending, az_embed.get_embeddings)
+            fail_list.extend(fails)
+            return inserted_cnt, deleted_cnt
+        except Exception as e:
+            fail_list.extend((source_key, f"batch aborted before write because {e}") for source_key, *_ in pending)
+            return 0, 0
+        finally:
+            pending.clear()
     
     '''**
     * 建立 doc and docx 附檔名的列表
-    * @params: NA
+    * @params: manifest - IngestManifest, 未改變的檔案略過, 已刪除的檔案會刪除其 chunks
+    *          workers - 解析與切割檔案的 process 數 (1: 在主程式依序處理)
     * @return: NA
-    * 有些文檔token數~15000 > 8192, 則split
+    * 有些文檔token數~15000 > 8192, 則split (見 DocumentStream.chunk_spec_docx)
     *'''
-    def scan_folder_and_create_embed2pg(self):
-        # 建立 text splitter 
-        text_splitter_recur = RecursiveCharacterTextSplitter(
-            chunk_size = 6000,
-            chunk_overlap = 1200,
-            length_function = len,
-            is_separator_regex=False
-        )
+    def scan_folder_and_create_embed2pg(self, manifest, workers = 1):
         # 獲取兩種不同附檔名的Word (此範例不處理doc_files)
         doc_files, docx_files = self.get_file_lists(self.directory)
         total_chunk_cnt = 0
+        total_deleted_cnt = 0
         fail_list = []
-        for idx, docx_file in tqdm(enumerate(docx_files), 
-                                   desc="Process spec ",
-                                   total=len(docx_files),
-                                   unit="files"):
+        # 檔案未改變則略過, 不需讀取與轉換 Embedding
+        changed_files = {} # docx_file -> fingerprint
+        for docx_file in docx_files:
+            try:
+                changed, fingerprint = manifest.check_file(docx_file, os.path.basename(docx_file))
+                if changed:
+                    changed_files[docx_file] = fingerprint
+            except Exception as e:
+                fail_list.append((docx_file, str(e)))
+        
+        tasks = [(docx_file, (docx_file,)) for docx_file in changed_files]
+        if workers > 1:
+            # 解析與切割在 process pool 執行, 依完成順序送回
+            parsed = DocumentStream.parse_in_pool(DocumentStream.chunk_spec_docx, tasks, workers)
+        else:
+            parsed = self.parse_in_order(tasks)
+        pending = [] # list of (source_key, fingerprint, metadata, chunks) 等待轉換 Embedding
+        pending_chunk_cnt = 0
+        for docx_file, chunk_list, error in tqdm(parsed,
+                                                 desc="Process spec ",
+                                                 total=len(tasks),
+                                                 unit="files"):
+            if error is not None:
+                fail_list.append((docx_file, error))
+                continue
             try:
-                text_and_tables = self.read_docx_file(docx_file)
-                # 計算token數
-                num_tokens = EmbeddingFunction.num_tokens_from_string_embed(text_and_tables)
-                # 建立meta
                 file_basename = os.path.basename(docx_file)
+                fingerprint = changed_files[docx_file]
+                # 建立meta
                 split_key_word = '_Datasheet'
                 if split_key_word not in file_basename:
                     split_key_word = '-Datasheet'
@@ -105,35 +138,30 @@ class SpecScanner:
                     'source': file_basename,
                     "model": hmi_model_name
                 }
-                # 處理metadata格式以便插入pg, 外掛 chunk_context and embedding
-                data_keys = list(metadata.keys()) + ["chunk_context","embedding"]
-                col_names = ", ".join(data_keys)
-                # 當token數過大則split
-                chunk_list = text_splitter_recur.split_text(text_and_tables) if num_tokens > 8192 else [text_and_tables]
-                for chunk in chunk_list:
-                    # 加入 chunk_context
-                    data_values = list(metadata.values())
-                    data_values.append(chunk)
-                    # 轉換Embedding, 失敗試三次
-                    for _ in range(3):
-                        chunk_embedding = az_embed.get_embedding(chunk)
-                        if chunk_embedding is not None:
-                            data_values.append(chunk_embedding)
-                            # 存入pg
-                            data_values = [tuple(data_values)]
-                            pg_vector.upsert_data(self.table_name, 
-                                                col_names, 
-                                                data_values)
-                            total_chunk_cnt += 1
-                            break
-                        else:
-                            time.sleep(10)
-                
+                # 多數 datasheet 只有一個 chunk, 累積多個檔案後再批次轉換 Embedding
+                pending.append((file_basename, fingerprint, metadata, chunk_list))
+                pending_chunk_cnt += len(chunk_list)
             except Exception as e:
                 fail_list.append((docx_file, str(e)))
-            
+                continue
+            if pending_chunk_cnt >= EmbeddingFunction.embed_batch_size:
+                # 失敗時由 embed_and_write_chunks 記錄批次內所有檔案並清空 pending
+                inserted_cnt, deleted_cnt = self.embed_and_write_chunks(manifest, pending, fail_list)
+                total_chunk_cnt += inserted_cnt
+                total_deleted_cnt += deleted_cnt
+                pending_chunk_cnt = 0
+        
+        if pending:
+            inserted_cnt, deleted_cnt = self.embed_and_write_chunks(manifest, pending, fail_list)
+            total_chunk_cnt += inserted_cnt
+            total_deleted_cnt += deleted_cnt
+        # 已從資料夾刪除的 datasheet: 刪除其 chunks
+        removed_list = manifest.remove_missing()
             
         print("total len of chunks: ",total_chunk_cnt)
+        print("deleted chunks: ",total_deleted_cnt)
+        print("unchanged files skipped: ",manifest.skipped_cnt)
+        print("removed files: ",removed_list)
         print("fail list:\n",fail_list)
     
 
@@ -142,6 +170,10 @@ def main():
     parser = argparse.ArgumentParser(description='Spec document')
     parser.add_argument('-t', '--table_name', type=str, default="spec", help='創建Postgres Table名稱存入spec')
     parser.add_argument('-s', '--src', type=str, default="./SVN_datasheet", help='Data Sheet 資料夾位置')
+    parser.add_argument('--full', action='store_true', help='忽略 manifest, 重新比對所有檔案')
+    parser.add_argument('-x', '--index', type=str, default="hnsw", choices=["hnsw", "ivfflat", "none"], help='寫入完成後在 embedding 建立的 ANN 索引')
+    parser.add_argument('--partial', action='store_true', help='依 model 的值建立 partial ANN 索引 (資料 >= 1000 筆的值)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='解析與切割檔案的 process 數')
     args = parser.parse_args()
     
     table_name = args.table_name
@@ -154,6 +186,7 @@ def main():
         print("directory is empty")
         exit()
     
+    init_clients()
     print(f"Create table '{table_name}' if not exists....")
     ret_json = pg_vector.create_spec_table(table_name=table_name)
     if ret_json["status"] == "fail":
@@ -163,7 +196,19 @@ def main():
     
     print("start creating datasheets....")
     scanner = SpecScanner(directory=directory, table_name=table_name)
-    scanner.scan_folder_and_create_embed2pg()
+    manifest = IngestManifest(pg_vector, table_name, key_col="source", full_refresh=args.full)
+    with Metrics.metrics.timer("ingest_scan", scanner="spec"):
+        scanner.scan_folder_and_create_embed2pg(manifest, workers=args.workers)
+    
+    if args.index != "none":
+        print(f"Create {args.index} index on '{table_name}' if not exists....")
+        pg_vector.create_vector_index(table_name, index_type=args.index)
+        if args.partial:
+            pg_vector.create_filtered_vector_indexes(table_name, "model", index_type=args.index)
+    
+    if az_embed.cache is not None:
+        print("embedding cache:", az_embed.cache.stats())
+    Metrics.report(scanner="spec", table_name=table_name)
     print("done")
     
         
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+
+# 量測的模組與 CLI (CLI 只執行 --help, 不會連線 db 或呼叫 embedding API)
+MODULES = ["ConfigLoader", "Metrics", "IngestManifest", "DocumentStream", "EmbeddingFunction", "DatabaseProcess", "RetrievalService"]
+SCRIPTS = ["run_spec.py", "run_manual.py", "run_jssdk.py", "run_wtk_benchmark.py",
+           "run_inference.py", "run_server.py"]
+# target 以相對名稱執行, 一律在本檔所在的目錄執行 (可從其他目錄啟動 benchmark)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+'''**
+* 解析 python -X importtime 的輸出
+* 每一行格式: "import time: self [us] | cumulative | imported package", 子模組以縮排表示
+* @params: stderr - -X importtime 寫入 stderr 的文字
+* @return: list of dict(module, self_ms, cumulative_ms, depth)
+*'''
+def parse_importtime(stderr:str) -> list[dict]:
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3:
+            continue
+        name = fields[2].rstrip()
+        imports.append({
+            "module": name.strip(),
+            "self_ms": int(fields[0]) / 1000.0,
+            "cumulative_ms": int(fields[1]) / 1000.0,
+            "depth": (len(name) - len(name.lstrip())) // 2
+        })
+    return imports
+
+
+'''**
+* 以新的 python process 執行 target 多次, 量測啟動時間
+* 執行失敗 (exit code 非 0) 時提早結束的時間不代表啟動時間: 停止量測, 回傳 wall_ms 為 None 與錯誤訊息
+* @params: command - python 參數, e.g. ["-c", "import DatabaseProcess"] or ["run_spec.py", "--help"]
+*          repeat - 執行次數; top - 回傳 cumulative 最久的前 top 個 import
+* @return: dict(target, wall_ms: {min, median, max} | None, import_ms, top_imports, returncode, error)
+*'''
+def measure(command:list[str], repeat:int = 5, top:int = 10) -> dict:
+    wall_times = []
+    imports = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime"] + command, capture_output=True, text=True, cwd=BASE_DIR)
+        elapsed_ms = (time.perf_counter() - start_time) * 1000.0
+        if proc.returncode != 0:
+            # stderr 中 importtime 以外的最後一行即為例外訊息
+            errors = [line for line in proc.stderr.splitlines() if line.strip() and not line.startswith("import time:")]
+            return {"target": " ".join(command), "wall_ms": None, "import_ms": None, "top_imports": [],
+                    "returncode": proc.returncode, "error": errors[-1] if errors else ""}
+        wall_times.append(elapsed_ms)
+        imports = parse_importtime(proc.stderr)
+    # 最上層 import 的 cumulative 總和即為 import 所花的時間
+    import_ms = sum(item["cumulative_ms"] for item in imports if item["depth"] == 0)
+    top_imports = sorted(imports, key=lambda item: item["cumulative_ms"], reverse=True)[:top]
+    return {
+        "target": " ".join(command),
+        "wall_ms": {"min": min(wall_times), "median": statistics.median(wall_times), "max": max(wall_times)},
+        "import_ms": import_ms,
+        "top_imports": [{"module": item["module"], "cumulative_ms": item["cumulative_ms"]} for item in top_imports],
+        "returncode": 0,
+        "error": None
+    }
+
+
+def print_result(result:dict, top:int):
+    if result["returncode"] != 0:
+        print(f"{result['target']}  FAILED (exit code {result['returncode']}): {result['error']}")
+        return
+    wall = result["wall_ms"]
+    print(result["target"])
+    print(f"    wall: median {wall['median']:.0f} ms (min {wall['min']:.0f}, max {wall['max']:.0f}), imports {result['import_ms']:.0f} ms")
+    for item in result["top_imports"][:top]:
+        print(f"    {item['cumulative_ms']:>8.1f} ms  {item['module']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Startup time benchmark (python -X importtime)')
+    parser.add_argument('-m', '--modules', type=str, nargs='*', default=MODULES, help='要量測 import 時間的模組')
+    parser.add_argument('-s', '--scripts', type=str, nargs='*', default=SCRIPTS, help='要量測 --help 啟動時間的 CLI')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='每個目標執行次數 (取中位數)')
+    parser.add_argument('--top', type=int, default=5, help='顯示 cumulative 最久的 import 數量')
+    parser.add_argument('--max_ms', type=float, default=None, help='任一目標的中位數超過此值 (ms) 時以 exit code 1 結束 (任一目標執行失敗時一律以 exit code 1 結束)')
+    parser.add_argument('-o', '--output', type=str, default=None, help='結果輸出為 JSON 檔')
+    args = parser.parse_args()
+
+    results = []
+    for module in args.modules:
+        results.append(measure(["-c", f"import {module}"], args.repeat, args.top))
+        print_result(results[-1], args.top)
+    for script in args.scripts:
+        results.append(measure([script, "--help"], args.repeat, args.top))
+        print_result(results[-1], args.top)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version, "repeat": args.repeat, "results": results}, f, indent=2)
+        print(f"result saved to {args.output}")
+
+    # 執行失敗的目標不列入時間比較, 但一律視為 gate 失敗
+    failed = [result["target"] for result in results if result["returncode"] != 0]
+    if failed:
+        print(f"targets failed: {failed}")
+    slow = []
+    if args.max_ms is not None:
+        slow = [result["target"] for result in results
+                if result["returncode"] == 0 and result["wall_ms"]["median"] > args.max_ms]
+        if slow:
+            print(f"startup slower than {args.max_ms:.0f} ms: {slow}")
+    if failed or slow:
+        sys.exit(1)
@@ -1,18 +1,20 @@
 # -*- coding: utf-8 -*-
-import time
 import argparse
 from tqdm import tqdm
-import pandas as pd
-import configparser
+import Metrics
 import DatabaseProcess
 import EmbeddingFunction
 
-config=configparser.ConfigParser()
-config.read("Config.ini")
 
+# 參數檢查通過後才建立 (init_clients), --help 或參數錯誤時不需建立 embedding client 與連線 db
+az_embed = None
+pg_vector = None
 
-az_embed = EmbeddingFunction.AzureOpenAIEmbeddings()
-pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting)
+
+def init_clients():
+    global az_embed, pg_vector
+    az_embed = EmbeddingFunction.ConcurrentAzureOpenAIEmbeddings(cache=EmbeddingFunction.load_embedding_cache())
+    pg_vector = DatabaseProcess.PGVector(DatabaseProcess.pg_setting, DatabaseProcess.pool_setting)
 
 
 class Benchmark2PGVector:
@@ -27,6 +29,8 @@ class Benchmark2PGVector:
         self.benchmark_df = self.preprocess_benchmark_df()
     
     def preprocess_benchmark_df(self):
+        # pandas 載入較慢, 只在讀取 excel 時 import
+        import pandas as pd
         # read excel
         benchmark_df=pd.read_excel(self.benchmark_file_path, 
                                    sheet_name=self.benchmark_sheet_name,
@@ -47,6 +51,8 @@ class Benchmark2PGVector:
     def write_benchmark_to_pgvector(self):
         doc_cnt = 0
         fail_list = []
+        col_names = ""
+        pending = [] # list of (_id, [metadata values..., chunk_context]) 等待批次轉換 Embedding
         for idx , row in tqdm(self.benchmark_df.iterrows(), 
                               total=len(self.benchmark_df),
                               desc="Processing chunks: ",
@@ -78,23 +84,24 @@ class Benchmark2PGVector:
                 # 加入 chunk_context
                 data_values = list(metadata.values())
                 data_values.append(chunk_context)
-                # 轉換Embedding, 失敗試三次
-                for _ in range(3):
-                    chunk_embedding = az_embed.get_embedding(chunk_context)
-                    if chunk_embedding is not None:
-                        data_values.append(chunk_embedding)
-                        # 存入pg
-                        data_values = [tuple(data_values)]
-                        pg_vector.upsert_data(self.pg_table_name, 
-                                              col_names, 
-                                              data_values)
-                        doc_cnt += 1
-                        break
-                    else:
-                        time.sleep(10)
+                pending.append((_id, data_values))
             except Exception as e:
                 fail_list.append((_id, str(e)))
         
+        # 批次轉換Embedding (失敗的 sub-batch 會重試), 再一次存入pg
+        chunk_embeddings = az_embed.get_embeddings([data_values[-1] for _, data_values in pending])
+        rows = []
+        for (_id, data_values), chunk_embedding in zip(pending, chunk_embeddings):
+            if chunk_embedding is None:
+                fail_list.append((_id, "chunk failed to embed"))
+                continue
+            rows.append(tuple(data_values + [chunk_embedding]))
+        if rows:
+            # COPY binary 寫入, 向量不需轉成 SQL 文字
+            doc_cnt = pg_vector.bulk_load(self.pg_table_name, 
+                                          col_names, 
+                                          rows)
+        
         print(f"There are {doc_cnt} added")
         print("fail list:\n",fail_list)
 
@@ -104,6 +111,8 @@ if __name__ == "__main__":
     parser.add_argument('-t', '--table_name', type=str, default="wtk_benchmark", help='創建Postgres Table名稱存入benchmark')
     parser.add_argument('-s', '--sheet_name', type=str, default="Datasets100", help='參考的Sheet名稱')
     parser.add_argument('-d', '--doc_path', type=str, default="./Weinbot_Benchmark.xlsx", help='Benchmark Excel 資料夾位置')
+    parser.add_argument('-x', '--index', type=str, default="hnsw", choices=["hnsw", "ivfflat", "none"], help='寫入完成後在 embedding 建立的 ANN 索引')
+    parser.add_argument('--partial', action='store_true', help='依 customer_flag / distributor_flag 建立 partial ANN 索引')
     args = parser.parse_args()
     
     table_name = args.table_name
@@ -122,6 +131,7 @@ if __name__ == "__main__":
         exit()
         
         
+    init_clients()
     print(f"Create table '{table_name}' if not exists....")
     ret_json = pg_vector.create_benchmark_table(table_name=table_name)
     if ret_json["status"] == "fail":
@@ -133,5 +143,18 @@ if __name__ == "__main__":
     benchmark_writter = Benchmark2PGVector(benchmark_file_path = doc_path, 
                                            benchmark_sheet_name = sheet_name, 
                                            pg_table_name = table_name)
-    benchmark_writter.write_benchmark_to_pgvector()
+    with Metrics.metrics.timer("ingest_scan", scanner="benchmark"):
+        benchmark_writter.write_benchmark_to_pgvector()
+    
+    if args.index != "none":
+        print(f"Create {args.index} index on '{table_name}' if not exists....")
+        pg_vector.create_vector_index(table_name, index_type=args.index)
+        if args.partial:
+            # 與 query_benchmark_nearest_by_identity 的條件相同
+            pg_vector.create_filtered_vector_indexes(table_name, "customer_flag", values=[1], index_type=args.index)
+            pg_vector.create_filtered_vector_indexes(table_name, "distributor_flag", values=[1], index_type=args.index)
+    
+    if az_embed.cache is not None:
+        print("embedding cache:", az_embed.cache.stats())
+    Metrics.report(scanner="benchmark", table_name=table_name)
     print("done for end cust")
\ No newline at end of file